@@ -0,0 +1,451 @@
+# coding:UTF-8
+
+import os
+import sys
+import glob
+import json
+import time
+import signal
+import multiprocessing
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+from glafic import glafic as gf
+reload(gf)
+import fitsdata
+reload(fitsdata)
+import glean as gl
+reload(gl)
+
+
+class BatchError(Exception):
+    def __init__(self, msg, code=2):
+        self.msg  = msg
+        self.code = code
+
+    def __str__(self):
+        return self.msg
+
+
+class Batch(object):
+    """
+    Runs GLEAN without prompts from a config file, for workflow engines.
+
+    The config is YAML, or JSON if PyYAML is not installed:
+
+        glafic:    path of glafic
+        data:      2D or 3D FITS
+        masks:     [2D FITS, ...]                  (optional)
+        header:    {BMAJ: .., REDSHIFT: .., ...}   (optional, overrides the FITS header)
+        overwrite: error, overwrite or resume       (default error)
+        params:    {gain: .., ...}                 (GleanParams)
+        image:     {pix_ext: .., ...}              (params of glafic for the image plane)
+        source:    {xmin: .., ...}                 (params of glafic for the source plane)
+        models:    [[lens, sie, ...], ...]         (as the arguments of append)
+        njobs:     1
+        bank:      false                           (build the bank before the run)
+        log:       glean_out/glean_run.log
+        summary:   glean_out/summary.json
+        jobs:      [{name: .., data: .., masks: .., header: .., params: ..}, ...]
+
+    The log of the run goes to log; a JSON summary is printed to stdout and
+    written to summary, and run returns the exit status. A config with jobs
+    is run by Queue instead, and data, masks and header are given per job.
+    """
+    EXIT_OK         = 0
+    EXIT_FAILED     = 1
+    EXIT_CONFIG     = 2
+    EXIT_EXISTS     = 3
+    OVERWRITE       = {'error', 'overwrite', 'resume'}
+    KEYS            = {'glafic', 'data', 'masks', 'header', 'overwrite', 'params', 'image', 'source', 'models',
+                       'njobs', 'bank', 'log', 'summary', 'jobs'}
+    JOB_KEYS        = {'name', 'data', 'masks', 'header', 'params'}
+    DEFAULT_LOG     = gl.Glean.OUT_DIR + 'glean_run.log'
+    DEFAULT_SUMMARY = gl.Glean.OUT_DIR + 'summary.json'
+
+    def __init__(self, configname):
+        self.configname = configname
+        self.summary    = {'config': configname, 'status': 'error', 'exit_code': Batch.EXIT_CONFIG, 'message': '',
+                           'outputs': [], 'channels': []}
+
+    @classmethod
+    def load_config(cls, configname):
+        try:
+            with open(configname) as f:
+                text = f.read()
+        except IOError:
+            raise BatchError('{} cannot be opened.'.format(configname))
+
+        if yaml is not None:
+            try:
+                config = yaml.safe_load(text)
+            except yaml.YAMLError as e:
+                raise BatchError('{} is not valid YAML: {}'.format(configname, e))
+        else:
+            try:
+                config = json.loads(text)
+            except ValueError:
+                raise BatchError('{} is not valid JSON; install PyYAML for YAML configs.'.format(configname))
+
+        if not isinstance(config, dict):
+            raise BatchError('{} should hold a mapping.'.format(configname))
+        unknown = set(config) - Batch.KEYS
+        if unknown:
+            raise BatchError('Unknown keys in {}: {}'.format(configname, ', '.join(sorted(unknown))))
+        for key in ['glafic'] if 'jobs' in config else ['glafic', 'data']:
+            if key not in config:
+                raise BatchError('{} does not have "{}".'.format(configname, key))
+        for key in ['models', 'jobs']:
+            if not isinstance(config.get(key) or [], list):
+                raise BatchError('{} should be a list.'.format(key))
+        for job in config.get('jobs') or []:
+            if not isinstance(job, dict) or 'data' not in job or set(job) - Batch.JOB_KEYS:
+                raise BatchError('Each job should be a mapping with data and only {}.'.format(', '.join(sorted(Batch.JOB_KEYS))))
+        for section in [config] + (config.get('jobs') or []):
+            for key in ['header', 'params', 'image', 'source']:
+                if not isinstance(section.get(key) or {}, dict):
+                    raise BatchError('{} should be a mapping.'.format(key))
+            if not isinstance(section.get('masks') or [], list):
+                raise BatchError('masks should be a list.')
+        if config.get('overwrite', 'error') not in Batch.OVERWRITE:
+            raise BatchError('overwrite should be one of {}.'.format(', '.join(sorted(Batch.OVERWRITE))))
+        njobs = config.get('njobs', 1)
+        if isinstance(njobs, bool) or not isinstance(njobs, (int, long)) or njobs < 1:
+            raise BatchError('{} is not a suitable number of jobs.'.format(njobs))
+
+        return config
+
+    def _load_data(self, config):
+        """ the cube and the mask, with the header overrides and without prompts """
+        header = dict((str(k).upper(), v) for k, v in (config.get('header') or {}).iteritems())
+        try:
+            fits_dim = fitsdata.FITSData.check_dimension(config['data'])
+            if fits_dim == 2:
+                fitscls = fitsdata.FITSData2D.initbyname(config['data'])
+                fitscls.append_header(header)
+                fitscls.check_header(interactive=False)
+                fitscls = fitscls.extendto3D()
+            elif fits_dim == 3:
+                fitscls = fitsdata.FITSData3D.initbyname(config['data'])
+                fitscls.append_header(header)
+                fitscls.check_header(interactive=False)
+            else:
+                raise BatchError('FITS data should be 2D or 3D.')
+
+            maskcls = None
+            for maskname in config.get('masks') or []:
+                if fitsdata.FITSData.check_dimension(maskname) != 2:
+                    raise BatchError('Mask data should be 2D.')
+                submask = fitsdata.FITSData2D.initbyname(maskname)
+                maskcls = submask if maskcls is None else maskcls * submask
+        except fitsdata.FITSDataError as e:
+            raise BatchError(e.msg)
+        except IOError as e:
+            raise BatchError(str(e))
+
+        if maskcls is not None and fitscls.data[0].shape != maskcls.data.shape:
+            raise BatchError('Image sizes of data and mask should be the same.')
+
+        return fitscls, maskcls
+
+    @classmethod
+    def _merge(cls, config, job):
+        """ the data, masks and header of job, with the header of config under it """
+        header = dict(config.get('header') or {})
+        header.update(job.get('header') or {})
+
+        return {'data': job['data'], 'masks': job.get('masks'), 'header': header}
+
+    def _set_params(self, glean, config, job={}):
+        """ set the params of config and then those of job, as the interpreter does, but a rejected value is fatal """
+        glean.params.reset('all')
+        for params, sections, error_code in [(glean.params, [config.get('params'), job.get('params')], gl.GleanParams.ERROR_CODE),
+                                             (glean.glafic_i.params, [config.get('image')], gf.GlaficParams.ERROR_CODE),
+                                             (glean.glafic_s.params, [config.get('source')], gf.GlaficParams.ERROR_CODE)]:
+            for section in sections:
+                for key, value in (section or {}).iteritems():
+                    if params.__setitem__(key, str(value)) == error_code:
+                        raise BatchError('{} = {} is not accepted.'.format(key, value))
+
+    def _setup(self, config, job=None):
+        """ a Glean for the data of job (or of config) with the params and models of config """
+        fitscls, maskcls = self._load_data(config if job is None else Batch._merge(config, job))
+        if job is None and maskcls is not None:
+            maskcls.write_fits(gl.Glean.OUT_DIR + 'mask.fits')
+
+        glafic_i = gf.Glafic('one_image.input', config['glafic'])
+        glafic_s = gf.Glafic('one_source.input', config['glafic'])
+        glean    = gl.Glean(glafic_i, glafic_s, fitscls, maskcls)
+
+        self._set_params(glean, config, job or {})
+        for model in config.get('models') or []:
+            if not isinstance(model, list) or len(model) == 0:
+                raise BatchError('Each model should be a list of the arguments of append.')
+            for glafic in [glafic_i, glafic_s]:
+                if glafic.models.append(str(model[0]), [str(v) for v in model[1:]]) == gf.GlaficModels.ERROR_CODE:
+                    raise BatchError('{} is not accepted as a model.'.format(' '.join(str(v) for v in model)))
+
+        return glean
+
+    def _channels(self, glean):
+        """ iterations and components of each channel, from the component tables """
+        channels = []
+        for name in sorted(glob.glob(glean.comps_name.replace('{}', '*'))):
+            comps = fitsdata.FITSTable.initbyname(name, gl.Glean.COMPONENT_COLUMNS)
+            rows  = comps.rows
+            channels.append({'table': name, 'iterations': int(max([row[0] for row in rows] or [0])),
+                             'components': len(rows), 'last_sb_max': rows[-1][4] if rows else None})
+
+        return channels
+
+    def run(self):
+        start       = time.time()
+        summaryname = Batch.DEFAULT_SUMMARY
+        try:
+            config      = Batch.load_config(self.configname)
+            summaryname = config.get('summary', summaryname)
+            self.summary['log'] = config.get('log', Batch.DEFAULT_LOG)
+            njobs       = config.get('njobs', 1)
+
+            if not os.path.exists(gl.Glean.OUT_DIR):
+                os.mkdir(gl.Glean.OUT_DIR)
+
+            stdout     = sys.stdout
+            sys.stdout = open(self.summary['log'], 'w')
+            try:
+                glean = self._setup(config)
+
+                policy = config.get('overwrite', 'error')
+                if policy == 'error' and glean.existing_outputs():
+                    raise BatchError('Output files already exist.', Batch.EXIT_EXISTS)
+                glean.overwrite = True
+
+                if config.get('bank', False) and not glean.build_bank(njobs=njobs):
+                    raise BatchError('The bank was not built.', Batch.EXIT_FAILED)
+                finished = glean.execute(phase=1, njobs=njobs, resume=policy == 'resume')
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+
+            self.summary['outputs']  = glean.existing_outputs()
+            self.summary['channels'] = self._channels(glean)
+            if finished:
+                self.summary['status'], self.summary['exit_code'] = 'finished', Batch.EXIT_OK
+            else:
+                self.summary['status'], self.summary['exit_code'] = 'unfinished', Batch.EXIT_FAILED
+                self.summary['message'] = 'Not every channel was finished; see the log.'
+        except BatchError as e:
+            self.summary['status']    = 'exists' if e.code == Batch.EXIT_EXISTS else 'error'
+            self.summary['exit_code'] = e.code
+            self.summary['message']   = e.msg
+        except (gl.GleanError, gf.GlaficError) as e:
+            self.summary['exit_code'] = Batch.EXIT_FAILED
+            self.summary['message']   = str(e)
+        except Exception as e:
+            # anything else, like a header value of the wrong type, is reported as well
+            self.summary['exit_code'] = Batch.EXIT_FAILED
+            self.summary['message']   = '{}: {}'.format(e.__class__.__name__, e)
+        except KeyboardInterrupt:
+            self.summary['status'], self.summary['exit_code'] = 'unfinished', Batch.EXIT_FAILED
+            self.summary['message'] = 'Keyboard Interrupted.'
+        self.summary['time'] = time.time() - start
+
+        with open(summaryname, 'w') as f:
+            json.dump(self.summary, f, indent=2, sort_keys=True)
+        print json.dumps(self.summary, sort_keys=True)
+
+        return self.summary['exit_code']
+
+
+class Queue(Batch):
+    """
+    Runs the jobs of a config, FITS files sharing one lens model, on a pool of
+    njobs worker processes.
+
+    The lens products (lens maps, ray-traced grids and image finders) of every
+    distinct lens fingerprint are built once in the parent, before the workers
+    are forked, so the workers share them; glafic replies and templates are
+    kept by each worker across its jobs. Jobs are started in decreasing order
+    of their estimated cost (channels x pixels x iterations), so that the
+    longest ones do not end up last. Each job writes its outputs with its name
+    as the prefix and its log to glean_out/(name).log.
+    """
+    # iterations assumed for the cost of a job without a limit
+    COST_LIMIT = 1000
+
+    def _jobs(self, config):
+        jobs = []
+        for k, job in enumerate(config['jobs']):
+            job = dict(job, name=str(job.get('name', 'job{}'.format(k + 1))))
+            jobs.append(job)
+        if len(set(job['name'] for job in jobs)) != len(jobs):
+            raise BatchError('Names of jobs should be unique.')
+
+        return jobs
+
+    def _cost(self, glean):
+        zmin, zmax = glean.params['zmin'], glean.params['zmax']
+        nchannels  = len([j for j in xrange(len(glean.default_fitscls.data)) if zmin <= j and (zmax == -1 or j <= zmax)])
+        limit      = glean.params['limit']
+
+        return nchannels * glean.default_fitscls.data[0].size * (limit if limit != -1 else Queue.COST_LIMIT)
+
+    def _load(self, glean, config, job):
+        """ set glean to the data, params and output names of job """
+        fitscls, maskcls = self._load_data(Batch._merge(config, job))
+        glean.load(fitscls, maskcls)
+        self._set_params(glean, config, job)
+        glean.glafic_i.params['prefix'] = job['name']
+        glean.glafic_s.params['prefix'] = job['name']
+
+    def _run_job(self, glean, config, job):
+        """ run job on glean and return its summary """
+        start   = time.time()
+        summary = {'name': job['name'], 'status': 'error', 'exit_code': Batch.EXIT_CONFIG, 'message': '',
+                   'log': gl.Glean.OUT_DIR + job['name'] + '.log', 'outputs': [], 'channels': []}
+
+        stdout = sys.stdout
+        try:
+            sys.stdout = open(summary['log'], 'w')
+            self._load(glean, config, job)
+            policy = config.get('overwrite', 'error')
+            if policy == 'error' and glean.existing_outputs():
+                raise BatchError('Output files already exist.', Batch.EXIT_EXISTS)
+            glean.overwrite = True
+
+            if glean.execute(phase=1, njobs=1, resume=policy == 'resume'):
+                summary['status'], summary['exit_code'] = 'finished', Batch.EXIT_OK
+            else:
+                summary['status'], summary['exit_code'] = 'unfinished', Batch.EXIT_FAILED
+                summary['message'] = 'Not every channel was finished; see the log.'
+            summary['outputs']  = glean.existing_outputs()
+            summary['channels'] = self._channels(glean)
+        except BatchError as e:
+            summary['status']    = 'exists' if e.code == Batch.EXIT_EXISTS else 'error'
+            summary['exit_code'] = e.code
+            summary['message']   = e.msg
+        except (gl.GleanError, gf.GlaficError) as e:
+            summary['exit_code'] = Batch.EXIT_FAILED
+            summary['message']   = str(e)
+        except Exception as e:
+            # a job that fails in any other way fails alone, and the queue goes on
+            summary['exit_code'] = Batch.EXIT_FAILED
+            summary['message']   = '{}: {}'.format(e.__class__.__name__, e)
+        finally:
+            if sys.stdout is not stdout:
+                sys.stdout.close()
+            sys.stdout = stdout
+        summary['time'] = time.time() - start
+
+        return summary
+
+    def run(self):
+        global _pool_queue
+
+        start       = time.time()
+        summaryname = Batch.DEFAULT_SUMMARY
+        try:
+            config      = Batch.load_config(self.configname)
+            summaryname = config.get('summary', summaryname)
+            self.summary['log'] = config.get('log', Batch.DEFAULT_LOG)
+            njobs       = config.get('njobs', 1)
+            jobs = self._jobs(config)
+
+            if not os.path.exists(gl.Glean.OUT_DIR):
+                os.mkdir(gl.Glean.OUT_DIR)
+
+            # the lens products of all jobs are built up front, and the costs
+            # are known once the data are read
+            stdout     = sys.stdout
+            sys.stdout = open(self.summary['log'], 'w')
+            try:
+                glean = self._setup(config, jobs[0])
+                glean.max_lens_products = len(jobs)
+                costs = {}
+                for job in jobs:
+                    self._load(glean, config, job)
+                    costs[job['name']] = self._cost(glean)
+                    if config.get('bank', False) and not glean.build_bank(njobs=njobs):
+                        raise BatchError('The bank was not built.', Batch.EXIT_FAILED)
+                    glean.prepare()
+                glean.default_fitscls, glean.maskcls = None, None
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+
+            order   = sorted(jobs, key=lambda job: -costs[job['name']])
+            results = {}
+            if njobs > 1:
+                # the children of glafic sessions must not be shared with the workers
+                glean.glafic_i.close()
+                glean.glafic_s.close()
+                _pool_queue = (self, glean, config)
+                pool = multiprocessing.Pool(njobs, _pool_init)
+                try:
+                    for summary in pool.imap_unordered(_pool_job, order):
+                        results[summary['name']] = summary
+                finally:
+                    pool.terminate()
+                    pool.join()
+                    _pool_queue = None
+            else:
+                for job in order:
+                    results[job['name']] = self._run_job(glean, config, job)
+
+            self.summary['jobs'] = [dict(results[job['name']], cost=costs[job['name']]) for job in jobs]
+            if all(summary['exit_code'] == Batch.EXIT_OK for summary in self.summary['jobs']):
+                self.summary['status'], self.summary['exit_code'] = 'finished', Batch.EXIT_OK
+            else:
+                self.summary['status'], self.summary['exit_code'] = 'unfinished', Batch.EXIT_FAILED
+                self.summary['message'] = 'Not every job was finished; see the jobs.'
+        except BatchError as e:
+            self.summary['status']    = 'exists' if e.code == Batch.EXIT_EXISTS else 'error'
+            self.summary['exit_code'] = e.code
+            self.summary['message']   = e.msg
+        except (gl.GleanError, gf.GlaficError) as e:
+            self.summary['exit_code'] = Batch.EXIT_FAILED
+            self.summary['message']   = str(e)
+        except Exception as e:
+            # anything else, like a header value of the wrong type, is reported as well
+            self.summary['exit_code'] = Batch.EXIT_FAILED
+            self.summary['message']   = '{}: {}'.format(e.__class__.__name__, e)
+        except KeyboardInterrupt:
+            self.summary['status'], self.summary['exit_code'] = 'unfinished', Batch.EXIT_FAILED
+            self.summary['message'] = 'Keyboard Interrupted.'
+        self.summary['time'] = time.time() - start
+
+        with open(summaryname, 'w') as f:
+            json.dump(self.summary, f, indent=2, sort_keys=True)
+        print json.dumps(self.summary, sort_keys=True)
+
+        return self.summary['exit_code']
+
+
+_pool_queue = None
+
+
+def _pool_init():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _pool_job(job):
+    queue, glean, config = _pool_queue
+
+    return queue._run_job(glean, config, job)
+
+
+def main(argv):
+    """ glean run config: run GLEAN from config and exit with its status """
+    if len(argv) != 1:
+        print >> sys.stderr, 'usage: glean run config.yaml'
+        return Batch.EXIT_CONFIG
+
+    # the config is checked again, and errors reported, by run
+    try:
+        queue = 'jobs' in Batch.load_config(argv[0])
+    except BatchError:
+        queue = False
+
+    return (Queue if queue else Batch)(argv[0]).run()
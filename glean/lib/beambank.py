@@ -0,0 +1,124 @@
+# coding:UTF-8
+
+import os
+import signal
+import multiprocessing
+import numpy as np
+
+
+class BeamBankError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+
+class BeamBank(object):
+    """
+    Image-plane responses of a unit source on a lattice of source positions.
+
+    The responses are stored as one .npy array of shape (ny, nx) + image shape
+    and opened read-only memory-mapped, so runs on the same lens model share
+    the pages through the page cache. The response at any source position is
+    interpolated bilinearly between the four surrounding nodes.
+    """
+    PREFIX       = 'bank_'
+    SUFFIX       = '.npy'
+    DTYPE        = np.float32
+    POOL_TIMEOUT = 1e7
+
+    def __init__(self, path, xmin, ymin, step):
+        self.path = path
+        self.xmin = xmin
+        self.ymin = ymin
+        self.step = step
+        try:
+            self.data = np.load(path, mmap_mode='r')
+        except IOError:
+            raise BeamBankError('{} cannot be opened.'.format(path))
+        self.ny, self.nx = self.data.shape[:2]
+
+    @classmethod
+    def filename(cls, directory, fp):
+        return os.path.join(directory, BeamBank.PREFIX + fp + BeamBank.SUFFIX)
+
+    @classmethod
+    def lattice(cls, xmin, xmax, ymin, ymax, step):
+        """ return the x and y coordinates of the nodes """
+        nx = int(np.floor((xmax - xmin) / step + 1e-9)) + 1
+        ny = int(np.floor((ymax - ymin) / step + 1e-9)) + 1
+
+        return xmin + np.arange(nx) * step, ymin + np.arange(ny) * step
+
+    @classmethod
+    def nbytes(cls, xnodes, ynodes, shape):
+        """ the size of a bank of the nodes with responses of shape """
+        return len(xnodes) * len(ynodes) * shape[0] * shape[1] * np.dtype(BeamBank.DTYPE).itemsize
+
+    @classmethod
+    def build(cls, path, xnodes, ynodes, shape, response, njobs=1):
+        """
+        render response(x, y) for every node into the bank at path, a row of
+        nodes per task; the file only appears under path once it is complete
+        """
+        global _pool_bank
+
+        tmpname = '{}.{}.tmp'.format(path, os.getpid())
+        bank    = np.lib.format.open_memmap(tmpname, mode='w+', dtype=BeamBank.DTYPE,
+                                            shape=(len(ynodes), len(xnodes)) + tuple(shape))
+        del bank
+
+        _pool_bank = (tmpname, xnodes, ynodes, response)
+        try:
+            if njobs > 1:
+                pool = multiprocessing.Pool(njobs, _pool_init)
+                try:
+                    results = pool.imap_unordered(_pool_row, xrange(len(ynodes)))
+                    for _ in xrange(len(ynodes)):
+                        results.next(BeamBank.POOL_TIMEOUT)
+                finally:
+                    pool.terminate()
+                    pool.join()
+            else:
+                for iy in xrange(len(ynodes)):
+                    _pool_row(iy)
+            os.rename(tmpname, path)
+        finally:
+            _pool_bank = None
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+
+    def response(self, x, y):
+        fx = np.clip((x - self.xmin) / self.step, 0, self.nx - 1)
+        fy = np.clip((y - self.ymin) / self.step, 0, self.ny - 1)
+        ix = min(int(fx), self.nx - 2) if self.nx > 1 else 0
+        iy = min(int(fy), self.ny - 2) if self.ny > 1 else 0
+        tx = fx - ix
+        ty = fy - iy
+
+        out = (1 - tx) * (1 - ty) * self.data[iy, ix].astype(float)
+        if tx > 0:
+            out += tx * (1 - ty) * self.data[iy, ix + 1]
+        if ty > 0:
+            out += (1 - tx) * ty * self.data[iy + 1, ix]
+        if tx > 0 and ty > 0:
+            out += tx * ty * self.data[iy + 1, ix + 1]
+
+        return out
+
+
+_pool_bank = None
+
+
+def _pool_init():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _pool_row(iy):
+    tmpname, xnodes, ynodes, response = _pool_bank
+    bank = np.load(tmpname, mmap_mode='r+')
+    for ix, x in enumerate(xnodes):
+        bank[iy, ix] = response(x, ynodes[iy])
+    bank.flush()
+    del bank
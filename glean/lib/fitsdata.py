@@ -1,6 +1,8 @@
 # coding: UTF-8
 
+import os
 import sys
+import mmap
 import numpy as np
 # import numpy.ma as ma
 from astropy.io import fits
@@ -104,12 +106,22 @@ class FITSData(object):
         return cls(data, header, check)
 
     @classmethod
-    def initbyshape(cls, shape, mode=0):
-        if mode == 0:
-            data   = np.zeros(shape)
+    def initbyshape(cls, shape, mode=0, shared=False, dtype=np.float64):
+        """
+        shared: place data in anonymous shared memory, so that processes forked
+        afterwards write into the same array
+        """
+        if shared:
+            size = int(np.prod(shape))
+            data = np.frombuffer(mmap.mmap(-1, max(size, 1) * np.dtype(dtype).itemsize), dtype=dtype)[:size].reshape(shape)
+            if mode == 1:
+                data[...] = 1.
+            header = fits.Header()
+        elif mode == 0:
+            data   = np.zeros(shape, dtype=dtype)
             header = fits.Header()
         elif mode == 1:
-            data   = np.ones(shape)
+            data   = np.ones(shape, dtype=dtype)
             header = fits.Header()
 
         return cls(data, header)
@@ -127,53 +139,84 @@ class FITSData(object):
 
         return self.__class__.initbydata(data, header)
 
-    def __add__(self, obj):
-        """ addition is not commutative! """
+    def _operand(self, obj, verb):
         if isinstance(obj, (int, float)):
-            data   = self.data + obj
-            header = self.header
+            return obj
         elif isinstance(obj, FITSData):
-            data   = self.data + obj.data
-            header = self.header
+            return obj.data
         else:
-            raise FITSDataError('These two arguments cannot be added.')
+            raise FITSDataError('These two arguments cannot be {}.'.format(verb))
 
-        return self.__class__.initbydata(data, header)
+    def _apply(self, ufunc, obj, out, verb):
+        """
+        ufunc of self and obj into out, a new instance if out is None; the
+        header of self is shared with the result
+        """
+        other = self._operand(obj, verb)
+        if out is None:
+            return self.__class__.initbydata(ufunc(self.data, other), self.header)
+
+        # an array of another type, or one still shared read-only, is replaced
+        if out.data.flags.writeable and np.result_type(self.data, other) == out.data.dtype:
+            ufunc(self.data, other, out=out.data)
+        else:
+            out.data = ufunc(self.data, other)
+        out.header = self.header
+
+        return out
+
+    def add(self, obj, out=None):
+        return self._apply(np.add, obj, out, 'added')
+
+    def sub(self, obj, out=None):
+        return self._apply(np.subtract, obj, out, 'subtracted')
+
+    def mul(self, obj, out=None):
+        return self._apply(np.multiply, obj, out, 'multiplied')
+
+    def __add__(self, obj):
+        """ addition is not commutative! """
+        return self.add(obj)
 
     def __sub__(self, obj):
         """ subtraction is not commutative! """
-        return self.__add__(-obj)
+        return self.sub(obj)
 
     def __mul__(self, obj):
         """ multiplication is not commutative! """
-        if isinstance(obj, (int, float)):
-            data   = self.data * obj
-            header = self.header
-        elif isinstance(obj, FITSData):
-            data   = self.data * obj.data
-            header = self.header
-        else:
-            raise FITSDataError('These two arguments cannot be multiplied.')
+        return self.mul(obj)
 
-        return self.__class__.initbydata(data, header)
+    def __iadd__(self, obj):
+        return self.add(obj, out=self)
+
+    def __isub__(self, obj):
+        return self.sub(obj, out=self)
+
+    def __imul__(self, obj):
+        return self.mul(obj, out=self)
 
-    def check_header(self):
-        if 'BMAJ' not in self.header:
-            print 'FITS header does not have a keyword of "BMAJ".'
-            bmaj = float(raw_input('BMAJ (deg): '))
-            self.append_header({'BMAJ': bmaj})
-        if 'BMIN' not in self.header:
-            print 'FITS header does not have a keyword of "BMIN".'
-            bmin = float(raw_input('BMIN (deg): '))
-            self.append_header({'BMIN': bmin})
-        if 'BPA' not in self.header:
-            print 'FITS header does not have a keyword of "BPA".'
-            bpa = float(raw_input('BPA (deg): '))
-            self.append_header({'BPA': bpa})
-        if 'REDSHIFT' not in self.header:
-            print 'FITS header does not have a keyword of "REDSHIFT".'
-            redshift = float(raw_input('REDSHIFT: '))
-            self.append_header({'REDSHIFT': redshift})
+    def copy(self):
+        return self.__class__(self.data.copy(), self.header)
+
+    def view(self):
+        """
+        a copy-on-write view: the data are shared read-only until an in-place
+        operation replaces them with a private copy
+        """
+        data = self.data.view()
+        data.flags.writeable = False
+
+        return self.__class__(data, self.header.copy())
+
+    def check_header(self, interactive=True):
+        """ ask for the keywords GLEAN needs that the header lacks, or raise if not interactive """
+        for key, prompt in [('BMAJ', 'BMAJ (deg): '), ('BMIN', 'BMIN (deg): '), ('BPA', 'BPA (deg): '),
+                            ('REDSHIFT', 'REDSHIFT: ')]:
+            if key not in self.header:
+                if not interactive:
+                    raise FITSDataError('FITS header does not have a keyword of "{}".'.format(key))
+                print 'FITS header does not have a keyword of "{}".'.format(key)
+                self.append_header({key: float(raw_input(prompt))})
 
     def set_header(self, header):
         if isinstance(header, dict):
@@ -217,15 +260,66 @@ class FITSData2D(FITSData):
             return self.__class__(data, header)
         
     def findmax(self, maskcls=None):
-        if maskcls is None:
-            maskedcls = self
-        else:
-            maskedcls = self * maskcls
-        maskedcls.data = np.ma.masked_equal(maskedcls.data, 0, copy=False)
-        
-        ind_max = np.unravel_index(maskedcls.data.argmax(), maskedcls.data.shape)
-        sb_max  = maskedcls.data[ind_max]
+        # without a mask the data must not be replaced by the masked array
+        data = self.data if maskcls is None else self.data * maskcls.data
+        data = np.ma.masked_equal(data, 0, copy=False)
+
+        ind_max = np.unravel_index(data.argmax(), data.shape)
+        sb_max  = data[ind_max]
+
+        return sb_max, self._centroid(ind_max, sb_max)
+
+    def noise(self, maskcls=None):
+        """ robust standard deviation (1.4826 times the MAD) of the unmasked data """
+        data = self.data if maskcls is None else self.data[maskcls.data != 0]
+        if data.size == 0:
+            raise FITSDataError('No data to estimate the noise.')
+        med = np.median(data)
+
+        return 1.4826 * np.median(np.abs(data - med))
 
+    def findpeaks(self, maskcls=None, npeaks=1, separation=0., frac=0., peak=None):
+        """
+        the maximum found by findmax (or peak, if already known) followed by up
+        to npeaks - 1 local maxima brighter than frac times it, each at least
+        separation pixels away from the brighter peaks kept; return a list of
+        (sb, position)
+        """
+        sb_max, pos = self.findmax(maskcls) if peak is None else peak
+        peaks       = [(sb_max, pos)]
+        if npeaks <= 1:
+            return peaks
+
+        data = self.data if maskcls is None else self.data * maskcls.data
+        data = np.where(data == 0, -np.inf, data)
+        ny, nx = data.shape
+
+        # local maxima off the edges, brightest first (first occurrence on ties);
+        # a pixel already kept is skipped whatever the separation
+        inner  = data[1:-1, 1:-1]
+        is_max = inner > -np.inf
+        for dy in [-1, 0, 1]:
+            for dx in [-1, 0, 1]:
+                if dy != 0 or dx != 0:
+                    is_max &= inner >= data[1+dy:ny-1+dy, 1+dx:nx-1+dx]
+        iy, ix = np.nonzero(is_max & (inner >= frac * sb_max))
+        iy, ix = iy + 1, ix + 1
+        sb     = data[iy, ix]
+        order  = np.lexsort((iy * nx + ix, -sb))
+
+        ind_max = np.unravel_index(np.ma.masked_equal(data, -np.inf).argmax(), data.shape)
+        kept    = [ind_max]
+        for k in order:
+            if len(peaks) == npeaks:
+                break
+            if (iy[k], ix[k]) not in kept and all(np.hypot(iy[k] - _iy, ix[k] - _ix) >= separation for _iy, _ix in kept):
+                kept.append((iy[k], ix[k]))
+                peaks.append((sb[k], self._centroid((iy[k], ix[k]), sb[k])))
+
+        return peaks
+
+    def _centroid(self, ind_max, sb_max):
+        """ the position of the peak at ind_max weighted with its four neighbours """
         try:
             ind_up    = ind_max[0] + 1, ind_max[1]
             sb_up     = self.data[ind_up]
@@ -252,7 +346,7 @@ class FITSData2D(FITSData):
         pos_x = (ind_cog[1] + 1 - self.header['CRPIX1']) * self.header['CDELT1'] + self.header['CRVAL1']
         pos_y = (ind_cog[0] + 1 - self.header['CRPIX2']) * self.header['CDELT2'] + self.header['CRVAL2']
         
-        return sb_max, (pos_x, pos_y)
+        return pos_x, pos_y
 
     # def findnthmax(self, maskcls=None, n=2):
     #     if maskcls is None:
@@ -353,12 +447,73 @@ class FITSData2D(FITSData):
         return result
 
 
+class PeakIndex(object):
+    """
+    Maxima of tiles of a masked 2D residual.
+
+    findmax gives the same result as FITSData2D.findmax, but after a change
+    only the tiles touched have to be searched again, and the global maximum
+    is taken over the tile maxima. Ties are broken by the first occurrence in
+    row-major order as in numpy.argmax.
+    """
+    TILE = 16
+
+    def __init__(self, fitscls, maskcls=None, tile=TILE):
+        self.maskcls = maskcls
+        self.tile    = tile
+        self.shape   = fitscls.data.shape
+        self.ntiles  = (-(-self.shape[0] // tile), -(-self.shape[1] // tile))
+        self.dtype   = fitscls.data.dtype if maskcls is None else np.result_type(fitscls.data, maskcls.data)
+        self.masked  = np.full((self.ntiles[0] * tile, self.ntiles[1] * tile), -np.inf, dtype=self.dtype)
+        self.amax    = np.zeros(self.ntiles, dtype=int)
+        self.vmax    = np.full(self.ntiles, -np.inf, dtype=self.dtype)
+        self.update(fitscls)
+
+    def touched(self, windows):
+        """ tiles overlapping any of windows, pairs of slices of the frame """
+        tiles = np.zeros(self.ntiles, dtype=bool)
+        for wy, wx in windows:
+            tiles[wy.start // self.tile:-(-wy.stop // self.tile), wx.start // self.tile:-(-wx.stop // self.tile)] = True
+
+        return tiles
+
+    def update(self, fitscls, tiles=None):
+        """ search again the tiles of fitscls marked in tiles (all by default) """
+        t            = self.tile
+        self.fitscls = fitscls
+        if tiles is None:
+            tiles   = np.ones(self.ntiles, dtype=bool)
+            windows = [(slice(0, self.shape[0]), slice(0, self.shape[1]))]
+        else:
+            windows = [(slice(_ty * t, (_ty + 1) * t), slice(_tx * t, (_tx + 1) * t)) for _ty, _tx in zip(*np.nonzero(tiles))]
+        for window in windows:
+            data = fitscls.data[window] if self.maskcls is None else fitscls.data[window] * self.maskcls.data[window]
+            self.masked[window][:data.shape[0], :data.shape[1]] = np.where(data == 0, -np.inf, data)
+
+        ty, tx = np.nonzero(tiles)
+        blocks = self.masked.reshape(self.ntiles[0], t, self.ntiles[1], t).transpose(0, 2, 1, 3)[ty, tx].reshape(len(ty), t * t)
+        arg    = blocks.argmax(axis=1)
+        self.vmax[ty, tx] = blocks[np.arange(len(ty)), arg]
+        self.amax[ty, tx] = (ty * t + arg // t) * self.shape[1] + tx * t + arg % t
+
+    def findmax(self):
+        sb_max = self.vmax.max()
+        if not np.isfinite(sb_max):
+            return self.fitscls.findmax(self.maskcls)
+
+        ind_max = np.unravel_index(self.amax[self.vmax == sb_max].min(), self.shape)
+        sb_max  = self.masked[ind_max]
+
+        return sb_max, self.fitscls._centroid(ind_max, sb_max)
+
+
 class FITSData3D(FITSData):
     def __init__(self, data, header, check=False):
         super(self.__class__, self).__init__(data, header, check)
         if not self.data.ndim == 3:
             raise FITSDataError('This FITS data is not 3D.')
-        self._i = 0
+        self._i      = 0
+        self._buffer = None
 
     ##### is this needed??? #####
     # def __mul__(self, obj):
@@ -387,10 +542,214 @@ class FITSData3D(FITSData):
 
         return sub
 
+    def _capacity(self):
+        # self.data is a view of the first frames of self._buffer unless it has
+        # been replaced since the last append
+        if self._buffer is not None and self.data.base is self._buffer:
+            return self._buffer.shape[0]
+
+        return self.data.shape[0]
+
+    def reserve(self, nframes):
+        """ preallocate room for nframes frames in total so that append_data does not copy """
+        if nframes <= self._capacity():
+            return
+
+        n            = self.data.shape[0]
+        self._buffer = np.empty((nframes, ) + self.data.shape[1:], dtype=self.data.dtype)
+        self._buffer[:n] = self.data
+        self.data    = self._buffer[:n]
+
     def append_data(self, data):
-        if isinstance(data, np.ndarray):
-            self.data = np.append(self.data, np.expand_dims(data, axis=0), axis=0)
-        elif isinstance(data, FITSData2D):
-            self.data = np.append(self.data, np.expand_dims(data.data, axis=0), axis=0)
-        else:
+        if isinstance(data, FITSData2D):
+            data = data.data
+        elif not isinstance(data, np.ndarray):
             raise FITSDataError('Appended data should be numpy.ndarray or fitsdata.FITSData2D.')
+        if data.shape != self.data.shape[1:]:
+            raise FITSDataError('Appended data should have the shape of a frame.')
+
+        # the buffer grows geometrically, so appending costs O(1) on average
+        n = self.data.shape[0]
+        if n == self._capacity():
+            self.reserve(max(2 * n, 1))
+        self._buffer[n] = data
+        self.data       = self._buffer[:n+1]
+
+
+class FITSCubeWriter(object):
+    """
+    Writes a 3D FITS file frame by frame, so that memory does not grow with
+    the number of frames.
+
+    Frames go straight to fitsname behind reserve blank header blocks; write_fits
+    fills the reserved blocks with the header and the final NAXIS3. The methods
+    mirror FITSData3D, so a writer can stand in for a cube that is only appended
+    to and written.
+    """
+    BLOCK   = 2880
+    RESERVE = 8
+    BITPIX  = {np.dtype('>f4'): -32, np.dtype('>f8'): -64}
+
+    def __init__(self, fitsname, shape, header=None, dtype=np.float64, reserve=RESERVE):
+        self.fitsname = fitsname
+        self.shape    = tuple(shape)
+        self.header   = fits.Header() if header is None else header
+        self.dtype    = np.dtype(dtype).newbyteorder('>')
+        self.reserve  = reserve * FITSCubeWriter.BLOCK
+        self.nframes  = 0
+        if self.dtype not in FITSCubeWriter.BITPIX:
+            raise FITSDataError('Frames should be written as float32 or float64.')
+
+        self.f = open(fitsname, 'wb')
+        self.f.write(' ' * self.reserve)
+
+    @classmethod
+    def reopen(cls, fitsname, shape, nframes, dtype=np.float64):
+        """
+        continue writing fitsname after its first nframes frames, whether or not
+        write_fits was called on it; later frames are dropped
+        """
+        writer          = cls.__new__(cls)
+        writer.fitsname = fitsname
+        writer.shape    = tuple(shape)
+        writer.header   = fits.Header()
+        writer.dtype    = np.dtype(dtype).newbyteorder('>')
+        writer.nframes  = nframes
+
+        # a finished file starts with its header, an unfinished one with blanks
+        try:
+            with open(fitsname, 'rb') as f:
+                block = f.read(FITSCubeWriter.BLOCK)
+                if block.startswith('SIMPLE'):
+                    writer.reserve = FITSCubeWriter.BLOCK
+                    while 'END'.ljust(80) not in [block[k:k+80] for k in xrange(0, len(block), 80)]:
+                        block = f.read(FITSCubeWriter.BLOCK)
+                        if len(block) < FITSCubeWriter.BLOCK:
+                            raise FITSDataError('{} has no END card.'.format(fitsname))
+                        writer.reserve += FITSCubeWriter.BLOCK
+                else:
+                    writer.reserve = FITSCubeWriter.RESERVE * FITSCubeWriter.BLOCK
+        except IOError:
+            raise FITSDataError('{} cannot be opened.'.format(fitsname))
+
+        size = writer.reserve + nframes * writer.shape[0] * writer.shape[1] * writer.dtype.itemsize
+        if os.path.getsize(fitsname) < size:
+            raise FITSDataError('{} has fewer than {} frames.'.format(fitsname, nframes))
+        writer.f = open(fitsname, 'r+b')
+        writer.f.truncate(size)
+        writer.f.seek(size)
+
+        return writer
+
+    def flush(self):
+        if self.f is not None:
+            self.f.flush()
+
+    def append_data(self, data):
+        if isinstance(data, FITSData2D):
+            data = data.data
+        elif not isinstance(data, np.ndarray):
+            raise FITSDataError('Appended data should be numpy.ndarray or fitsdata.FITSData2D.')
+        if data.shape != self.shape:
+            raise FITSDataError('Appended data should have the shape of a frame.')
+        if self.f is None:
+            raise FITSDataError('{} is already closed.'.format(self.fitsname))
+
+        self.f.write(np.ascontiguousarray(data, dtype=self.dtype).tostring())
+        self.nframes += 1
+
+    def set_header(self, header):
+        if isinstance(header, dict):
+            self.header = fits.Header(header.items())
+        elif isinstance(header, fits.Header):
+            self.header = header
+        else:
+            raise FITSDataError('Header should be dictionary or astropy.io.fits.Header.')
+
+    def _final_header(self):
+        header = fits.Header([('SIMPLE', True), ('BITPIX', FITSCubeWriter.BITPIX[self.dtype]), ('NAXIS', 3),
+                              ('NAXIS1', self.shape[1]), ('NAXIS2', self.shape[0]), ('NAXIS3', self.nframes)])
+        for card in self.header.cards:
+            if card.keyword not in {'SIMPLE', 'BITPIX', 'NAXIS', 'NAXIS1', 'NAXIS2', 'NAXIS3', 'EXTEND'}:
+                header.append(card)
+
+        return header.tostring(endcard=False, padding=False)
+
+    def write_fits(self, fitsname=None, clobber=True):
+        """ pad the data, write the header and move the file to fitsname """
+        if self.f is not None:
+            nbytes = self.nframes * self.shape[0] * self.shape[1] * self.dtype.itemsize
+            self.f.write('\0' * (-nbytes % FITSCubeWriter.BLOCK))
+
+            cards = self._final_header()
+            if len(cards) + 80 <= self.reserve:
+                self.f.seek(0)
+                self.f.write(cards + ' ' * (self.reserve - len(cards) - 80) + 'END'.ljust(80))
+                self.f.close()
+            else:
+                # the header outgrew the reserved blocks; rewrite the whole file
+                self.f.close()
+                with open(self.fitsname, 'rb') as f:
+                    f.seek(self.reserve)
+                    data = f.read()
+                header = cards + 'END'.ljust(80)
+                with open(self.fitsname, 'wb') as f:
+                    f.write(header + ' ' * (-len(header) % FITSCubeWriter.BLOCK) + data)
+            self.f = None
+
+        if fitsname is not None and fitsname != self.fitsname:
+            os.rename(self.fitsname, fitsname)
+            self.fitsname = fitsname
+
+
+class FITSTable(object):
+    """
+    Rows of named columns collected in memory and written as a FITS binary
+    table. A column holds floats, or lists of floats that are written as a
+    variable-length array column and read back as lists, even when empty or
+    of a single value.
+    """
+    def __init__(self, names):
+        self.names = list(names)
+        self.rows  = []
+
+    @classmethod
+    def initbyname(cls, fitsname, names):
+        """ read the rows of a table written by write_fits """
+        try:
+            data = fits.getdata(fitsname, 1)
+        except IOError:
+            raise FITSDataError('{} cannot be opened.'.format(fitsname))
+
+        # tables of earlier versions have lists padded with nan to a fixed width
+        lists = set(name for name in names if data.columns[name].format[0] in 'PQ')
+        table = cls(names)
+        for row in data:
+            table.rows.append(tuple([float(v) for v in row[name]] if name in lists else
+                                    float(row[name]) if np.ndim(row[name]) == 0 else
+                                    [float(v) for v in row[name] if not np.isnan(v)] for name in names))
+
+        return table
+
+    def __len__(self):
+        return len(self.rows)
+
+    def append(self, **row):
+        if set(row) != set(self.names):
+            raise FITSDataError('Rows should have the columns {}.'.format(', '.join(self.names)))
+        self.rows.append(tuple(row[name] for name in self.names))
+
+    def write_fits(self, fitsname, header={}, clobber=True):
+        columns = []
+        for k, name in enumerate(self.names):
+            values = [row[k] for row in self.rows]
+            if any(isinstance(v, list) for v in values):
+                array = np.empty(len(values), dtype=object)
+                for n, v in enumerate(values):
+                    array[n] = np.array(v, dtype=float)
+                columns.append(fits.Column(name=name, format='PD()', array=array))
+            else:
+                columns.append(fits.Column(name=name, format='D', array=np.array(values, dtype=float)))
+
+        hdu = fits.BinTableHDU.from_columns(columns, header=fits.Header(header.items()) if isinstance(header, dict) else header)
+        hdu.writeto(fitsname, clobber=clobber)
@@ -1,7 +1,14 @@
 # coding:UTF-8
 
+import os
+import time
+import atexit
+import select
+import hashlib
+import weakref
 import numpy as np
 from subprocess import Popen, PIPE
+from distutils.spawn import find_executable
 from collections import OrderedDict
 from copy import deepcopy
 
@@ -13,6 +20,8 @@ import pointmodel
 reload(pointmodel)
 import psfmodel
 reload(psfmodel)
+import lrucache
+reload(lrucache)
 
 class GlaficError(Exception):
     def __init__(self, message):
@@ -22,6 +31,14 @@ class GlaficError(Exception):
         return self.message
 
 
+class GlaficCrashError(GlaficError):
+    pass
+
+
+class GlaficTimeoutError(GlaficError):
+    pass
+
+
 class GlaficParams(object):
     GREEN_COLOR  = '\033[92m'
     YELLOW_COLOR = '\033[93m'
@@ -251,6 +268,219 @@ class GlaficModels(object):
         self.sets[key][0].append(model)
 
 
+class GlaficSession(object):
+    """
+    A long-lived glafic child process for one input file.
+
+    Commands are written to the stdin of glafic and each reply is read up to the
+    echo of a sentinel command that glafic does not know. The child is restarted
+    whenever the content of the input file changes.
+
+    If glafic reports the sentinel on stdout, replies can be told apart without
+    waiting, so a batch of commands is pipelined in blocks of BLOCK commands.
+
+    A reply that takes longer than timeout seconds kills the child. Children
+    are terminated on KeyboardInterrupt and at exit of the interpreter.
+    """
+    SENTINEL = 'glean_sentinel'
+    LINEBUF  = ['stdbuf', '-oL', '-eL']
+    CHUNK    = 65536
+    BLOCK    = 256
+    GRACE    = 1.
+
+    sessions = weakref.WeakSet()
+
+    def __init__(self, path, inputname, timeout=None):
+        self.path      = path
+        self.inputname = inputname
+        self.timeout   = timeout
+        self.proc      = None
+        self.digest    = None
+        self.banner    = ''
+        self.buffers   = {}
+        self.pipelined = False
+
+    def _digest(self):
+        try:
+            with open(self.inputname, 'rb') as f:
+                return hashlib.md5(f.read()).hexdigest()
+        except IOError:
+            raise GlaficError('{} does not exist.'.format(self.inputname))
+
+    def is_alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def start(self):
+        self.close()
+        if self.path is None:
+            raise GlaficError('The path of glafic is not set.')
+
+        command = [self.path, self.inputname]
+        if find_executable(GlaficSession.LINEBUF[0]) is not None:
+            command = GlaficSession.LINEBUF + command
+
+        self.digest  = self._digest()
+        self.proc    = Popen(command, stdin=PIPE, stdout=PIPE, stderr=PIPE, close_fds=True)
+        self.buffers = {self.proc.stdout.fileno(): '', self.proc.stderr.fileno(): ''}
+        GlaficSession.sessions.add(self)
+        self._write([])
+        self.banner  = self._read_reply()
+
+    def _write(self, commands):
+        lines = []
+        for command in commands:
+            lines.extend([command, GlaficSession.SENTINEL])
+        if not lines:
+            lines.append(GlaficSession.SENTINEL)
+        try:
+            self.proc.stdin.write('\n'.join(lines) + '\n')
+            self.proc.stdin.flush()
+        except IOError:
+            self.kill()
+            raise GlaficCrashError('glafic exited unexpectedly.')
+
+    def _split(self, fd):
+        """ cut the buffer of fd at the line echoing the sentinel """
+        buf   = self.buffers[fd]
+        index = buf.find(GlaficSession.SENTINEL)
+        if index < 0:
+            return None
+        head  = buf.rfind('\n', 0, index) + 1
+        tail  = buf.find('\n', index)
+        self.buffers[fd] = '' if tail < 0 else buf[tail+1:]
+
+        return buf[:head]
+
+    def _read_reply(self):
+        out_fd, err_fd = self.proc.stdout.fileno(), self.proc.stderr.fileno()
+        deadline       = None if not self.timeout else time.time() + self.timeout
+        try:
+            while True:
+                out = self._split(out_fd)
+                if out is not None:
+                    self.pipelined = True
+                    return out
+                if self._split(err_fd) is not None:
+                    self.pipelined = False
+                    # glafic complained on stderr; stdout was flushed before that
+                    while select.select([out_fd], [], [], 0)[0]:
+                        chunk = os.read(out_fd, GlaficSession.CHUNK)
+                        if not chunk:
+                            break
+                        self.buffers[out_fd] += chunk
+                    out, self.buffers[out_fd] = self.buffers[out_fd], ''
+                    return out
+
+                if deadline is None:
+                    ready = select.select([out_fd, err_fd], [], [])[0]
+                else:
+                    ready = select.select([out_fd, err_fd], [], [], max(deadline - time.time(), 0))[0]
+                    if not ready:
+                        self.kill()
+                        raise GlaficTimeoutError('glafic did not reply within {} s.'.format(self.timeout))
+                for fd in ready:
+                    chunk = os.read(fd, GlaficSession.CHUNK)
+                    if not chunk:
+                        self.kill()
+                        raise GlaficCrashError('glafic exited unexpectedly.')
+                    self.buffers[fd] += chunk
+        except KeyboardInterrupt:
+            self.kill()
+            raise
+
+    def communicate(self, command):
+        """ return what a one-shot run of glafic would print for command """
+        return self.communicate_many([command])[0]
+
+    def communicate_many(self, commands):
+        if not self.is_alive() or self.digest != self._digest():
+            self.start()
+
+        step    = GlaficSession.BLOCK if self.pipelined else 1
+        replies = []
+        for i in xrange(0, len(commands), step):
+            block = commands[i:i+step]
+            self._write(block)
+            for command in block:
+                replies.append(self.banner + self._read_reply())
+
+        return replies
+
+    def _wait(self, seconds):
+        deadline = time.time() + seconds
+        while self.proc.poll() is None and time.time() < deadline:
+            time.sleep(0.01)
+
+        return self.proc.poll() is not None
+
+    def kill(self):
+        """ terminate the child, and kill it if it is still alive after GRACE seconds """
+        if self.proc is not None:
+            if self.proc.poll() is None:
+                self.proc.terminate()
+                if not self._wait(GlaficSession.GRACE):
+                    self.proc.kill()
+            self.proc.wait()
+            for f in [self.proc.stdin, self.proc.stdout, self.proc.stderr]:
+                try:
+                    f.close()
+                except IOError:
+                    pass
+            self.proc = None
+        GlaficSession.sessions.discard(self)
+
+    def close(self):
+        if self.is_alive():
+            try:
+                self.proc.stdin.write('quit\n')
+                self.proc.stdin.close()
+            except IOError:
+                pass
+            self._wait(GlaficSession.GRACE)
+        self.kill()
+
+    @classmethod
+    def close_all(cls):
+        for session in list(cls.sessions):
+            session.close()
+
+
+atexit.register(GlaficSession.close_all)
+
+
+class GlaficStats(object):
+    """ wall time of glafic commands by command type """
+    def __init__(self):
+        self.table = OrderedDict()
+
+    def record(self, kind, ncommands, seconds):
+        """ a call of kind that sent ncommands commands to glafic in seconds """
+        calls, commands, total, longest = self.table.get(kind, (0, 0, 0., 0.))
+        self.table[kind] = (calls + 1, commands + ncommands, total + seconds, max(longest, seconds))
+
+    def reset(self):
+        self.table = OrderedDict()
+
+    def rows(self):
+        """ (kind, calls, commands, total [s], mean per command [s], longest call [s]) """
+        return [(kind, calls, commands, total, total / max(commands, 1), longest)
+                for kind, (calls, commands, total, longest) in self.table.iteritems()]
+
+
+class GlaficCache(lrucache.LRUCache):
+    """
+    A bounded LRU cache of glafic replies.
+
+    Values are tuples of strings (the reply and, for commands writing a file,
+    its content); the newest entry is kept even if it exceeds maxbytes.
+    """
+    KEEP = 1
+
+    @classmethod
+    def _nbytes(cls, value):
+        return sum(map(len, value))
+
+
 class Glafic(object):
     OUT_DIR = 'glean_out/'
 
@@ -275,17 +505,127 @@ class Glafic(object):
     X_INDEX     = 2
     Y_INDEX     = 5
 
-    path = None
+    SRCINFO_KEYS = ['kappa', 'gamma1', 'gamma2', 'gamma', 'phi', 'mag', 'xsrc', 'ysrc']
+
+    path    = None
+    timeout = None
+    retries = 1
 
-    def __init__(self, inputname):
+    def __init__(self, inputname, path=None):
+        self.basename  = inputname
         self.inputname = Glafic.OUT_DIR + inputname
+        self.workspace = None
         self.params    = GlaficParams()
         self.models    = GlaficModels()
+        self.session   = None
+        self.cache     = GlaficCache()
+        self.cache_fp  = None
+        self.stats     = GlaficStats()
+        if path is not None:
+            self.path = path
+
+    def communicate(self, command, kind=None):
+        return self.communicate_many([command], kind)[0]
+
+    def communicate_many(self, commands, kind=None):
+        """
+        send commands to the session, restarting glafic up to retries times if
+        it crashes; the wall time is recorded under kind (default: the first
+        word of the first command)
+        """
+        if self.session is None or self.session.path != self.path:
+            self.close()
+            self.session = GlaficSession(self.path, self.inputname)
+        self.session.timeout = self.timeout
+
+        if kind is None and commands:
+            kind = commands[0].split()[0]
+        start = time.time()
+        for attempt in xrange(self.retries + 1):
+            try:
+                replies = self.session.communicate_many(commands)
+                break
+            except GlaficCrashError:
+                if attempt == self.retries:
+                    raise
+                print GlaficParams.YELLOW_COLOR + 'Warning: ' + GlaficParams.CLEAR_COLOR + 'glafic crashed; restart it.'
+        self.stats.record(kind, len(commands), time.time() - start)
+
+        return replies
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+
+    def set_workspace(self, workspace):
+        """ keep the input file and the outputs of glafic in workspace (None: OUT_DIR) """
+        self.close()
+        self.session   = None
+        self.workspace = workspace
+        if workspace is None:
+            self.inputname = Glafic.OUT_DIR + self.basename
+        else:
+            self.inputname = workspace.join(self.basename)
+
+    def scratch_prefix(self):
+        """ the prefix of the files glafic writes """
+        if self.workspace is None:
+            return self.params['prefix']
+
+        return self.workspace.join(os.path.basename(self.params['prefix']))
+
+    def _fingerprint(self, keys, params=False):
+        md5 = hashlib.md5()
+        if params:
+            md5.update(repr(self.params['all'].items()))
+        for key in keys:
+            for model in self.models[key]:
+                md5.update(str(model))
+
+        return md5.hexdigest()
+
+    def communicate_cached(self, commands, depends=(), outname=None):
+        """
+        communicate_many through the LRU cache
+
+        Replies are keyed by the fingerprint of params and the lens and PSF
+        models, the models listed in depends and the command as sent to glafic.
+        A change of params, lens or PSF models drops every entry. When outname
+        is given, the file written by a single command is cached along with the
+        reply and written back on a hit.
+        """
+        fp = self._fingerprint(['lens', 'psf'], params=True)
+        if fp != self.cache_fp:
+            self.cache.clear()
+            self.cache_fp = fp
+
+        query   = self._fingerprint(depends)
+        values  = [self.cache.get((query, command)) for command in commands]
+        missing = [i for i, value in enumerate(values) if value is None]
+        if missing:
+            replies = self.communicate_many([commands[i] for i in missing])
+            for i, reply in zip(missing, replies):
+                if outname is None:
+                    values[i] = (reply, )
+                elif os.path.exists(outname):
+                    with open(outname, 'rb') as f:
+                        values[i] = (reply, f.read())
+                else:
+                    values[i] = (reply, )
+                    continue
+                self.cache.put((query, commands[i]), values[i])
+        elif outname is not None and len(values[0]) > 1:
+            with open(outname, 'wb') as f:
+                f.write(values[0][1])
+
+        return [value[0] for value in values]
 
     def create_input(self):
         with open(self.inputname, 'w') as f:
             f.write('### primary parameters ###\n')
             for k, v in self.params['primary'].iteritems():
+                if k == 'prefix':
+                    v = self.scratch_prefix()
                 f.write('{0:7}\t{1}\n'.format(k, v))
             f.write('\n')
 
@@ -358,28 +698,58 @@ class Glafic(object):
             f.write('start_command')
 
     def calcimage(self, redshift, ximg, yimg):
-        proc     = Popen([self.path, self.inputname], stdin=PIPE, stdout=PIPE, stderr=PIPE)
-        out, err = proc.communicate('calcimage {0} {1} {2}\nquit'.format(redshift, ximg, yimg))
-
-        kappa               = float(out.split('\n')[Glafic.KAPPA_INDEX].split()[2])
-        gamma1              = float(out.split('\n')[Glafic.GAMMA1_INDEX].split()[2])
-        gamma2              = float(out.split('\n')[Glafic.GAMMA2_INDEX].split()[2])
-        gamma               = float(out.split('\n')[Glafic.GAMMA_INDEX].split()[2])
-        if gamma2 / gamma >= 0:
-            phi = 1. / 2 * np.arccos(gamma1 / gamma)
-        else:
-            phi = -1. / 2 * np.arccos(gamma1 / gamma)
-        mag                 = np.abs(float(out.split('\n')[Glafic.MAG_INDEX].split()[2]))
-        xsrc                = float(out.split('\n')[Glafic.XSRC_INDEX].split()[2])
-        ysrc                = float(out.split('\n')[Glafic.YSRC_INDEX].split()[2])
-        srcinfo             = {'kappa':kappa, 'gamma1':gamma1, 'gamma2':gamma2, 'gamma':gamma,
-                               'phi':phi, 'mag':mag, 'xsrc':xsrc, 'ysrc':ysrc}
+        srcinfo = self.calcimage_batch(redshift, ximg, yimg)
+
+        return dict((key, float(srcinfo[key])) for key in Glafic.SRCINFO_KEYS)
+
+    def calcimage_batch(self, redshift, ximg, yimg):
+        """
+        ximg, yimg: arrays of image positions with the same shape
+        return: structured array of SRCINFO_KEYS with the shape of ximg
+
+        glafic has no batch command, so this sends one calcimage per position.
+        They cost one round trip per GlaficSession.BLOCK positions only when the
+        session pipelines them, i.e. when glafic reports unknown commands on
+        stdout; otherwise every position waits for its own reply.
+        """
+        ximg, yimg = np.broadcast_arrays(np.asarray(ximg, dtype=float), np.asarray(yimg, dtype=float))
+        commands   = ['calcimage {0} {1} {2}'.format(redshift, float(_x), float(_y))
+                      for _x, _y in zip(ximg.ravel(), yimg.ravel())]
+        outs       = self.communicate_cached(commands)
+
+        indices = [Glafic.KAPPA_INDEX, Glafic.GAMMA1_INDEX, Glafic.GAMMA2_INDEX, Glafic.GAMMA_INDEX,
+                   Glafic.MAG_INDEX, Glafic.XSRC_INDEX, Glafic.YSRC_INDEX]
+        values  = np.array([[lines[index].split()[2] for index in indices]
+                            for lines in (out.split('\n') for out in outs)], dtype=float).reshape(-1, len(indices))
+        kappa, gamma1, gamma2, gamma, mag, xsrc, ysrc = values.T
+
+        return Glafic.make_srcinfo(kappa, gamma1, gamma2, gamma, mag, xsrc, ysrc).reshape(ximg.shape)
+
+    def deflection(self, redshift, x, y):
+        x, y    = np.broadcast_arrays(np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+        srcinfo = self.calcimage_batch(redshift, x, y)
+
+        return x - srcinfo['xsrc'], y - srcinfo['ysrc']
+
+    @classmethod
+    def make_srcinfo(cls, kappa, gamma1, gamma2, gamma, mag, xsrc, ysrc):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            phi = np.where(gamma2 / gamma >= 0, 1., -1.) / 2 * np.arccos(gamma1 / gamma)
+
+        srcinfo           = np.empty(np.shape(kappa), dtype=[(key, float) for key in Glafic.SRCINFO_KEYS])
+        srcinfo['kappa']  = kappa
+        srcinfo['gamma1'] = gamma1
+        srcinfo['gamma2'] = gamma2
+        srcinfo['gamma']  = gamma
+        srcinfo['phi']    = phi
+        srcinfo['mag']    = np.abs(mag)
+        srcinfo['xsrc']   = xsrc
+        srcinfo['ysrc']   = ysrc
 
         return srcinfo
 
     def findimg(self):
-        proc     = Popen([Glafic.path, self.inputname], stdin=PIPE, stdout=PIPE, stderr=PIPE)
-        out, err = proc.communicate('findimg\nquit')
+        out = self.communicate_cached(['findimg'], ['point'])[0]
 
         n_img  = int(out.split('\n')[Glafic.N_IMG_INDEX].split()[2])
         x, y = [], []
@@ -391,27 +761,24 @@ class Glafic(object):
         return imginfo
 
     def writeimage(self, params):
-        proc = Popen([Glafic.path, self.inputname], stdin=PIPE, stdout=PIPE, stderr=PIPE)
-        proc.communicate('writeimage {0} {1}\nquit'.format(*params))
+        self.communicate_cached(['writeimage {0} {1}'.format(*params)], ['extend', 'point'],
+                                self.scratch_prefix() + Glafic.IMG_SUFFIX)
 
     def writeimage_ori(self, params):
-        proc = Popen([Glafic.path, self.inputname], stdin=PIPE, stdout=PIPE, stderr=PIPE)
-        proc.communicate('writeimage_ori {0} {1}\nquit'.format(*params))
+        self.communicate_cached(['writeimage_ori {0} {1}'.format(*params)], ['extend', 'point'],
+                                self.scratch_prefix() + Glafic.SRC_SUFFIX)
 
     def writelens(self, params):
-        proc = Popen([Glafic.path, self.inputname], stdin=PIPE, stdout=PIPE, stderr=PIPE)
-        proc.communicate('writelens {0}\nquit'.format(*params))
+        self.communicate('writelens {0}'.format(*params))
 
     def writecrit(self, params):
-        proc = Popen([Glafic.path, self.inputname], stdin=PIPE, stdout=PIPE, stderr=PIPE)
-        proc.communicate('writecrit {0}\nquit'.format(*params))
+        self.communicate('writecrit {0}'.format(*params))
 
     def optimize_p(self, params):
-        proc = Popen([Glafic.path, self.inputname], stdin=PIPE, stdout=PIPE, stderr=PIPE)
-        proc.communicate('readobs_point {}\nparprior {}\noptpoint\nquit'.format(*params))
+        self.communicate('readobs_point {}\nparprior {}\noptpoint'.format(*params), 'optimize_p')
 
     def readopt_e(self):
-        optname = self.params['prefix'] + Glafic.OPT_E_SUFFIX
+        optname = self.scratch_prefix() + Glafic.OPT_E_SUFFIX
         with open(optname, 'r') as f:
             data = f.readlines()
             chi2 = float(data[3].split()[2])
@@ -421,7 +788,7 @@ class Glafic(object):
         return tx, ty, chi2
 
     def readopt_p(self):
-        optname = self.params['prefix'] + Glafic.OPT_P_SUFFIX
+        optname = self.scratch_prefix() + Glafic.OPT_P_SUFFIX
         with open(optname, 'r') as f:
             data = f.readlines()
             chi2 = float(data[3].split()[2])
@@ -0,0 +1,141 @@
+# coding:UTF-8
+
+import numpy as np
+
+
+class ImageFinder(object):
+    """
+    Finds multiple images of point sources without glafic.
+
+    The nodes of an image-plane grid are mapped to the source plane once, each
+    grid cell is split into two triangles and the lensed triangles are stored
+    in a grid of buckets over the source plane. A query only tests the
+    triangles of one bucket, and the images found are refined by at most
+    max_newton Newton iterations with the Jacobian of backend.
+
+    Each iteration is one calcimage_batch of backend, i.e. one round trip when
+    backend is glafic. An in-process refiner (e.g. LensEngine on the same lens
+    models) then does most of the iterations, and backend only polishes the
+    images.
+    """
+    EPS          = 1e-10
+    MAX_NEWTON   = 20
+    TRI_PER_SIDE = 2.
+
+    def __init__(self, backend, redshift, xmin, xmax, ymin, ymax, pix, refiner=None, max_newton=None):
+        self.backend    = backend
+        self.redshift   = redshift
+        self.pix        = pix
+        self.tol        = 1e-6 * pix
+        self.refiner    = refiner
+        self.max_newton = ImageFinder.MAX_NEWTON if max_newton is None else max_newton
+
+        nx = int(round((xmax - xmin) / pix))
+        ny = int(round((ymax - ymin) / pix))
+        X, Y   = np.meshgrid(xmin + np.arange(nx + 1) * pix, ymin + np.arange(ny + 1) * pix)
+        ax, ay = backend.deflection(redshift, X, Y)
+        SX, SY = X - ax, Y - ay
+
+        # two triangles per cell: (00, 10, 11) and (00, 11, 01)
+        v00 = (slice(0, ny), slice(0, nx))
+        v10 = (slice(0, ny), slice(1, nx + 1))
+        v11 = (slice(1, ny + 1), slice(1, nx + 1))
+        v01 = (slice(1, ny + 1), slice(0, nx))
+        corners = [(v00, v10, v11), (v00, v11, v01)]
+
+        self.img = np.concatenate([np.stack([np.stack([X[v].ravel(), Y[v].ravel()], axis=-1) for v in c], axis=1)
+                                   for c in corners])
+        self.src = np.concatenate([np.stack([np.stack([SX[v].ravel(), SY[v].ravel()], axis=-1) for v in c], axis=1)
+                                   for c in corners])
+
+        # triangles on a singular node (e.g. the centre of an SIS) cannot be indexed
+        finite   = np.all(np.isfinite(self.src), axis=(1, 2))
+        self.img = self.img[finite]
+        self.src = self.src[finite]
+        self._build_index()
+
+    def _build_index(self):
+        lo = self.src.min(axis=1)
+        hi = self.src.max(axis=1)
+
+        self.origin = lo.min(axis=0)
+        extent      = np.maximum(hi.max(axis=0) - self.origin, self.pix)
+        self.nb     = max(int(np.sqrt(len(self.src)) / ImageFinder.TRI_PER_SIDE), 1)
+        self.bsize  = extent / self.nb
+
+        b0     = self._bucket(lo)
+        b1     = self._bucket(hi)
+        span   = b1 - b0 + 1
+        count  = span[:, 0] * span[:, 1]
+        tri    = np.repeat(np.arange(len(self.src)), count)
+        k      = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+        bx     = np.repeat(b0[:, 0], count) + k % np.repeat(span[:, 0], count)
+        by     = np.repeat(b0[:, 1], count) + k // np.repeat(span[:, 0], count)
+        bucket = by * self.nb + bx
+
+        order      = np.argsort(bucket, kind='mergesort')
+        self.index = tri[order]
+        self.start = np.searchsorted(bucket[order], np.arange(self.nb**2 + 1))
+
+    def _bucket(self, pos):
+        return np.clip(((pos - self.origin) / self.bsize).astype(int), 0, self.nb - 1)
+
+    def find_triangles(self, xs, ys):
+        """ return the indices of triangles containing (xs, ys) and their barycentric coordinates """
+        p = np.array([xs, ys], dtype=float)
+        if np.any(p < self.origin) or np.any(p > self.origin + self.nb * self.bsize):
+            return np.zeros(0, dtype=int), np.zeros((0, 2))
+
+        bx, by = self._bucket(p)
+        cand   = self.index[self.start[by * self.nb + bx]:self.start[by * self.nb + bx + 1]]
+        a      = self.src[cand, 0]
+        v0     = self.src[cand, 1] - a
+        v1     = self.src[cand, 2] - a
+        v2     = p - a
+        den    = v0[:, 0] * v1[:, 1] - v1[:, 0] * v0[:, 1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            l1 = (v2[:, 0] * v1[:, 1] - v1[:, 0] * v2[:, 1]) / den
+            l2 = (v0[:, 0] * v2[:, 1] - v2[:, 0] * v0[:, 1]) / den
+        inside = (den != 0) & (l1 >= -ImageFinder.EPS) & (l2 >= -ImageFinder.EPS) & (l1 + l2 <= 1 + ImageFinder.EPS)
+
+        return cand[inside], np.stack([l1[inside], l2[inside]], axis=-1)
+
+    def _newton(self, backend, xs, ys, x, y, rounds):
+        for _ in xrange(rounds):
+            srcinfo = backend.calcimage_batch(self.redshift, x, y)
+            dbx     = xs - srcinfo['xsrc']
+            dby     = ys - srcinfo['ysrc']
+            a11     = 1 - srcinfo['kappa'] - srcinfo['gamma1']
+            a22     = 1 - srcinfo['kappa'] + srcinfo['gamma1']
+            a12     = -srcinfo['gamma2']
+            det     = a11 * a22 - a12**2
+            with np.errstate(divide='ignore', invalid='ignore'):
+                dx = np.clip((a22 * dbx - a12 * dby) / det, -self.pix, self.pix)
+                dy = np.clip((a11 * dby - a12 * dbx) / det, -self.pix, self.pix)
+            x, y = x + np.nan_to_num(dx), y + np.nan_to_num(dy)
+            if np.all(np.hypot(dbx, dby) < self.tol):
+                break
+        srcinfo   = backend.calcimage_batch(self.redshift, x, y)
+        converged = np.hypot(xs - srcinfo['xsrc'], ys - srcinfo['ysrc']) < self.tol * 10
+
+        return x, y, srcinfo['mag'], converged
+
+    def findimg(self, xs, ys):
+        tri, bary = self.find_triangles(xs, ys)
+        a  = self.img[tri, 0]
+        x0 = a + bary[:, :1] * (self.img[tri, 1] - a) + bary[:, 1:] * (self.img[tri, 2] - a)
+
+        x, y = x0[:, 0], x0[:, 1]
+        if self.refiner is not None:
+            x, y = self._newton(self.refiner, xs, ys, x, y, ImageFinder.MAX_NEWTON)[:2]
+        x, y, mag, converged = self._newton(self.backend, xs, ys, x, y, self.max_newton)
+        x, y, mag = x[converged], y[converged], mag[converged]
+
+        # neighbouring triangles may lead to the same image
+        images = []
+        for _x, _y, _mag in zip(x, y, mag):
+            if all(np.hypot(_x - __x, _y - __y) > 0.1 * self.pix for __x, __y, __mag in images):
+                images.append((float(_x), float(_y), float(_mag)))
+
+        return {'n_img': len(images), 'x': [img[0] for img in images],
+                'y': [img[1] for img in images], 'mag': [img[2] for img in images]}
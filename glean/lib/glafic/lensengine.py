@@ -0,0 +1,321 @@
+# coding:UTF-8
+
+import numpy as np
+
+import glafic as gf
+reload(gf)
+
+
+C_LIGHT    = 299792.458               # km/s
+RAD_ARCSEC = 180. / np.pi * 3600.
+FD_STEP    = 1e-5                     # arcsec, for models without analytic hessian
+N_COMOVING = 4097
+MAX_TERMS  = 500                      # hypergeometric series of pow
+
+
+class LensEngineError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+
+class Cosmology(object):
+    """ distances in units of c / H0 """
+    def __init__(self, omega, lambda_, weos, hubble):
+        self.omega   = omega
+        self.lambda_ = lambda_
+        self.weos    = weos
+        self.hubble  = hubble
+        self.omega_k = 1. - omega - lambda_
+
+    def ez(self, z):
+        return np.sqrt(self.omega * (1 + z)**3 + self.omega_k * (1 + z)**2 +
+                       self.lambda_ * (1 + z)**(3 * (1 + self.weos)))
+
+    def comoving(self, z):
+        zz = np.linspace(0., z, N_COMOVING)
+        return np.trapz(1. / self.ez(zz), zz)
+
+    def transverse(self, chi):
+        if self.omega_k > 0:
+            sk = np.sqrt(self.omega_k)
+            return np.sinh(sk * chi) / sk
+        elif self.omega_k < 0:
+            sk = np.sqrt(-self.omega_k)
+            return np.sin(sk * chi) / sk
+        else:
+            return chi
+
+    def dratio(self, zl, zs):
+        """ D_ls / D_s """
+        if zs <= zl:
+            return 0.
+        chi_l, chi_s = self.comoving(zl), self.comoving(zs)
+
+        return self.transverse(chi_s - chi_l) / self.transverse(chi_s)
+
+
+def _rotate(model, x, y, theta):
+    """ shift to the model centre and rotate by the position angle theta (deg) """
+    # position angles of glafic are measured counterclockwise from the y-axis
+    ang  = (theta + 90.) * np.pi / 180.
+    c, s = np.cos(ang), np.sin(ang)
+    dx   = x - model.x
+    dy   = y - model.y
+
+    return c * dx + s * dy, -s * dx + c * dy, c, s
+
+
+def _unrotate_deflection(ax, ay, c, s):
+    return c * ax - s * ay, s * ax + c * ay
+
+
+def _unrotate_hessian(pxx, pyy, pxy, c, s):
+    return (c**2 * pxx - 2 * c * s * pxy + s**2 * pyy,
+            s**2 * pxx + 2 * c * s * pxy + c**2 * pyy,
+            c * s * (pxx - pyy) + (c**2 - s**2) * pxy)
+
+
+def _multipole(x, y, amp, m, n, phase):
+    """ derivatives of psi = amp * r^n * cos(m * (phi - phase)) """
+    r     = np.hypot(x, y)
+    phi   = np.arctan2(y, x)
+    c, s  = np.cos(phi), np.sin(phi)
+    cosm  = np.cos(m * (phi - phase))
+    sinm  = np.sin(m * (phi - phase))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rn1 = np.where(r > 0, r**(n - 1), 0.)
+        rn2 = np.where(r > 0, r**(n - 2), 0.)
+
+    psi_r   = n * amp * rn1 * cosm
+    psi_p_r = -m * amp * rn1 * sinm                 # psi_phi / r
+    psi_rr  = n * (n - 1) * amp * rn2 * cosm
+    psi_r_r = n * amp * rn2 * cosm                  # psi_r / r
+    psi_rp  = -n * m * amp * rn2 * sinm             # psi_rphi / r
+    psi_pp  = -m**2 * amp * rn2 * cosm              # psi_phiphi / r^2
+    psi_p_2 = -m * amp * rn2 * sinm                 # psi_phi / r^2
+
+    ax  = c * psi_r - s * psi_p_r
+    ay  = s * psi_r + c * psi_p_r
+    tan = psi_r_r + psi_pp
+    mix = psi_rp - psi_p_2
+    pxx = c**2 * psi_rr + s**2 * tan - 2 * c * s * mix
+    pyy = s**2 * psi_rr + c**2 * tan + 2 * c * s * mix
+    pxy = c * s * (psi_rr - tan) + (c**2 - s**2) * mix
+
+    return ax, ay, pxx, pyy, pxy
+
+
+def _sie(model, engine, zs, x, y):
+    """ softened isothermal ellipsoid (Keeton 2001), normalised on the intermediate axis """
+    b  = 4 * np.pi * (model.sigma / C_LIGHT)**2 * engine.dratio(zs) * RAD_ARCSEC
+    q  = 1. - model.e
+    bq = b * np.sqrt(q)
+    sc = model.r_core
+
+    xr, yr, c, s = _rotate(model, x, y, model.theta_e)
+    psi = np.sqrt(q**2 * (sc**2 + xr**2) + yr**2)
+    if q < 1:
+        qq = np.sqrt(1 - q**2)
+        ax = bq / qq * np.arctan(qq * xr / (psi + sc))
+        ay = bq / qq * np.arctanh(qq * yr / (psi + q**2 * sc))
+    else:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ax = np.where(psi + sc > 0, bq * xr / (psi + sc), 0.)
+            ay = np.where(psi + sc > 0, bq * yr / (psi + sc), 0.)
+
+    ax, ay = _unrotate_deflection(ax, ay, c, s)
+
+    return ax, ay, None
+
+
+def _pert(model, engine, zs, x, y):
+    """ psi = kappa / 2 * r^2 - gamma / 2 * r^2 * cos(2 * (phi - theta_gamma)) """
+    scale = engine.scale(zs, model.z)
+    phase = (model.theta_gamma + 90.) * np.pi / 180.
+    dx    = x - model.x
+    dy    = y - model.y
+
+    ax, ay, pxx, pyy, pxy = _multipole(dx, dy, -model.gamma / 2., 2, 2, phase)
+    ax  = scale * (ax + model.kappa * dx)
+    ay  = scale * (ay + model.kappa * dy)
+    pxx = scale * (pxx + model.kappa)
+    pyy = scale * (pyy + model.kappa)
+    pxy = scale * pxy
+
+    return ax, ay, (pxx, pyy, pxy)
+
+
+def _clus3(model, engine, zs, x, y):
+    """ psi = delta / 3 * r^3 * cos(3 * (phi - theta_delta)) """
+    scale = engine.scale(zs, model.z)
+    phase = (model.theta_delta + 90.) * np.pi / 180.
+
+    ax, ay, pxx, pyy, pxy = _multipole(x - model.x, y - model.y, model.delta / 3., 3, 3, phase)
+
+    return scale * ax, scale * ay, (scale * pxx, scale * pyy, scale * pxy)
+
+
+def _mpole(model, engine, zs, x, y):
+    """ psi = epsilon / m * r^n * cos(m * (phi - theta_m)) """
+    scale = engine.scale(zs, model.z)
+    phase = (model.theta_m + 90.) * np.pi / 180.
+
+    ax, ay, pxx, pyy, pxy = _multipole(x - model.x, y - model.y, model.epsilon / model.m, model.m, model.n, phase)
+
+    return scale * ax, scale * ay, (scale * pxx, scale * pyy, scale * pxy)
+
+
+def _pow(model, engine, zs, x, y):
+    """
+    power-law ellipsoid, kappa = (3 - gamma) / 2 * (r_ein / R)^(gamma - 1) with
+    R = sqrt(q x^2 + y^2 / q), via the series of Tessore & Metcalf (2015)
+    """
+    scale = engine.scale(zs, model.z)
+    q     = 1. - model.e
+    t     = model.gamma - 1.
+    b     = model.r_ein * np.sqrt(q)
+    f     = (1. - q) / (1. + q)
+
+    xr, yr, c, s = _rotate(model, x, y, model.theta_e)
+    rr    = np.hypot(q * xr, yr)
+    eiphi = np.where(rr > 0, (q * xr + 1j * yr) / np.where(rr > 0, rr, 1.), 1.)
+    e2i   = eiphi**2
+
+    term  = eiphi.copy()
+    omega = eiphi.copy()
+    for k in xrange(1, MAX_TERMS):
+        term  = -f * (2 * k - (2 - t)) / (2 * k + (2 - t)) * e2i * term
+        omega = omega + term
+        if np.all(np.abs(term) < 1e-15):
+            break
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        alpha = np.where(rr > 0, 2 * b / (1 + q) * (b / np.where(rr > 0, rr, 1.))**(t - 1) * omega, 0.)
+    ax, ay = _unrotate_deflection(alpha.real, alpha.imag, c, s)
+
+    return scale * ax, scale * ay, None
+
+
+def _powpot(model, engine, zs, x, y):
+    """ psi = r_ein^(gamma - 1) / (3 - gamma) * xi^(3 - gamma), xi = sqrt(q x^2 + y^2 / q) """
+    scale = engine.scale(zs, model.z)
+    q     = 1. - model.e_p
+    p     = 3. - model.gamma
+    amp   = model.r_ein**(model.gamma - 1)
+
+    xr, yr, c, s = _rotate(model, x, y, model.theta_e)
+    xi  = np.sqrt(q * xr**2 + yr**2 / q)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        xi2 = np.where(xi > 0, xi**(p - 2), 0.)
+        xi4 = np.where(xi > 0, xi**(p - 4), 0.)
+    ax  = amp * xi2 * q * xr
+    ay  = amp * xi2 * yr / q
+    pxx = amp * ((p - 2) * xi4 * q**2 * xr**2 + xi2 * q)
+    pyy = amp * ((p - 2) * xi4 * yr**2 / q**2 + xi2 / q)
+    pxy = amp * (p - 2) * xi4 * xr * yr
+
+    ax, ay         = _unrotate_deflection(ax, ay, c, s)
+    pxx, pyy, pxy  = _unrotate_hessian(pxx, pyy, pxy, c, s)
+
+    return scale * ax, scale * ay, (scale * pxx, scale * pyy, scale * pxy)
+
+
+ENGINE_LIST = {'sie': _sie, 'pert': _pert, 'clus3': _clus3, 'mpole': _mpole, 'pow': _pow, 'powpot': _powpot}
+
+
+class LensEngine(object):
+    """
+    In-process lens equation solver for the models of lensmodel.MODEL_LIST.
+
+    It reads the cosmology and lens models of a Glafic instance and answers
+    calcimage queries in the same format as Glafic, so both can be used as a
+    backend of Glean.
+    """
+    def __init__(self, glafic):
+        self.glafic  = glafic
+        self.dratios = {}
+
+    def cosmology(self):
+        params = self.glafic.params
+        return Cosmology(params['omega'], params['lambda'], params['weos'], params['hubble'])
+
+    def dratio(self, zs):
+        params = self.glafic.params
+        key    = (params['omega'], params['lambda'], params['weos'], params['hubble'], params['zl'], zs)
+        if key not in self.dratios:
+            self.dratios[key] = self.cosmology().dratio(params['zl'], zs)
+
+        return self.dratios[key]
+
+    def scale(self, zs, zfid):
+        """ rescale a model normalised for a source at zfid to a source at zs """
+        dratio_fid = self.dratio(zfid)
+        if dratio_fid == 0:
+            raise LensEngineError('Source redshift {} of a lens model is not beyond zl.'.format(zfid))
+
+        return self.dratio(zs) / dratio_fid
+
+    def supports(self):
+        """ whether every lens model of glafic is supported """
+        return all(model.name in ENGINE_LIST for model in self.glafic.models['lens'])
+
+    def _models(self):
+        models = self.glafic.models['lens']
+        for model in models:
+            if model.name not in ENGINE_LIST:
+                raise LensEngineError('{} is not supported by the native engine.'.format(model.name))
+
+        return models
+
+    def deflection(self, redshift, x, y):
+        x, y   = np.broadcast_arrays(np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+        ax, ay = np.zeros(x.shape), np.zeros(x.shape)
+        for model in self._models():
+            _ax, _ay, _ = ENGINE_LIST[model.name](model, self, redshift, x, y)
+            ax += _ax
+            ay += _ay
+
+        return ax, ay
+
+    def hessian(self, redshift, x, y):
+        x, y = np.broadcast_arrays(np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+        pxx, pyy, pxy = np.zeros(x.shape), np.zeros(x.shape), np.zeros(x.shape)
+        for model in self._models():
+            function = ENGINE_LIST[model.name]
+            hessian  = function(model, self, redshift, x, y)[2]
+            if hessian is None:
+                # central differences of the analytic deflection
+                axp, ayp, _ = function(model, self, redshift, x + FD_STEP, y)
+                axm, aym, _ = function(model, self, redshift, x - FD_STEP, y)
+                bxp, byp, _ = function(model, self, redshift, x, y + FD_STEP)
+                bxm, bym, _ = function(model, self, redshift, x, y - FD_STEP)
+                hessian     = ((axp - axm) / (2 * FD_STEP), (byp - bym) / (2 * FD_STEP),
+                               ((ayp - aym) + (bxp - bxm)) / (4 * FD_STEP))
+            pxx += hessian[0]
+            pyy += hessian[1]
+            pxy += hessian[2]
+
+        return pxx, pyy, pxy
+
+    def calcimage_batch(self, redshift, ximg, yimg):
+        ximg, yimg    = np.broadcast_arrays(np.asarray(ximg, dtype=float), np.asarray(yimg, dtype=float))
+        ax, ay        = self.deflection(redshift, ximg, yimg)
+        pxx, pyy, pxy = self.hessian(redshift, ximg, yimg)
+
+        kappa  = (pxx + pyy) / 2
+        gamma1 = (pxx - pyy) / 2
+        gamma2 = pxy
+        gamma  = np.hypot(gamma1, gamma2)
+        with np.errstate(divide='ignore'):
+            mag = 1. / ((1 - kappa)**2 - gamma**2)
+
+        return gf.Glafic.make_srcinfo(kappa, gamma1, gamma2, gamma, mag, ximg - ax, yimg - ay)
+
+    def calcimage(self, redshift, ximg, yimg):
+        srcinfo = self.calcimage_batch(redshift, ximg, yimg)
+
+        return dict((key, float(srcinfo[key])) for key in gf.Glafic.SRCINFO_KEYS)
@@ -0,0 +1,109 @@
+# coding:UTF-8
+
+import numpy as np
+from collections import OrderedDict
+
+import glafic as gf
+reload(gf)
+
+
+class LensMap(object):
+    """
+    Deflection, kappa, shear and magnification maps on the pixel centres of an
+    image grid, built once from a calcimage backend (Glafic or LensEngine).
+
+    calcimage queries are answered by bilinear interpolation of the deflection,
+    kappa and shear maps; gamma, phi and the magnification are derived from the
+    interpolated values.
+    """
+    MAP_KEYS = ['alpha_x', 'alpha_y', 'kappa', 'gamma1', 'gamma2']
+
+    def __init__(self, backend, redshift, xmin, xmax, ymin, ymax, pix_ext):
+        self.redshift = redshift
+        self.xmin     = xmin
+        self.ymin     = ymin
+        self.pix_ext  = pix_ext
+        self.nx       = int(round((xmax - xmin) / pix_ext))
+        self.ny       = int(round((ymax - ymin) / pix_ext))
+        self.x        = xmin + (np.arange(self.nx) + 0.5) * pix_ext
+        self.y        = ymin + (np.arange(self.ny) + 0.5) * pix_ext
+
+        X, Y    = np.meshgrid(self.x, self.y)
+        srcinfo = backend.calcimage_batch(redshift, X, Y)
+
+        self.alpha_x = X - srcinfo['xsrc']
+        self.alpha_y = Y - srcinfo['ysrc']
+        self.kappa   = srcinfo['kappa']
+        self.gamma1  = srcinfo['gamma1']
+        self.gamma2  = srcinfo['gamma2']
+        self.gamma   = srcinfo['gamma']
+        self.phi     = srcinfo['phi']
+        self.mag     = srcinfo['mag']
+
+    def _weights(self, x, y):
+        fx = (np.asarray(x, dtype=float) - self.x[0]) / self.pix_ext
+        fy = (np.asarray(y, dtype=float) - self.y[0]) / self.pix_ext
+        # outside the outermost pixel centres the maps are extrapolated linearly
+        ix = np.clip(np.floor(fx).astype(int), 0, max(self.nx - 2, 0))
+        iy = np.clip(np.floor(fy).astype(int), 0, max(self.ny - 2, 0))
+
+        return ix, iy, fx - ix, fy - iy
+
+    def interpolate(self, maps, x, y):
+        ix, iy, tx, ty = self._weights(x, y)
+        ix1 = np.minimum(ix + 1, self.nx - 1)
+        iy1 = np.minimum(iy + 1, self.ny - 1)
+        w00 = (1 - tx) * (1 - ty)
+        w10 = tx * (1 - ty)
+        w01 = (1 - tx) * ty
+        w11 = tx * ty
+
+        return [w00 * m[iy, ix] + w10 * m[iy, ix1] + w01 * m[iy1, ix] + w11 * m[iy1, ix1] for m in maps]
+
+    def deflection(self, redshift, x, y):
+        self._check_redshift(redshift)
+        return tuple(self.interpolate([self.alpha_x, self.alpha_y], x, y))
+
+    def calcimage_batch(self, redshift, ximg, yimg):
+        self._check_redshift(redshift)
+        ximg, yimg = np.broadcast_arrays(np.asarray(ximg, dtype=float), np.asarray(yimg, dtype=float))
+        ax, ay, kappa, gamma1, gamma2 = self.interpolate([getattr(self, key) for key in LensMap.MAP_KEYS], ximg, yimg)
+
+        gamma = np.hypot(gamma1, gamma2)
+        with np.errstate(divide='ignore'):
+            mag = 1. / ((1 - kappa)**2 - gamma**2)
+
+        return gf.Glafic.make_srcinfo(kappa, gamma1, gamma2, gamma, mag, ximg - ax, yimg - ay)
+
+    def calcimage(self, redshift, ximg, yimg):
+        srcinfo = self.calcimage_batch(redshift, ximg, yimg)
+
+        return dict((key, float(srcinfo[key])) for key in gf.Glafic.SRCINFO_KEYS)
+
+    def _check_redshift(self, redshift):
+        if redshift != self.redshift:
+            raise gf.GlaficError('Lens maps are built for a source at z = {}.'.format(self.redshift))
+
+    def check(self, backend, npoints=100, seed=None):
+        """
+        compare interpolated lookups with direct calcimage of backend at random
+        points of the grid and return (median, max) of the errors for each
+        quantity (relative errors for mag)
+        """
+        rng = np.random.RandomState(seed)
+        x   = rng.uniform(self.x[0], self.x[-1], npoints)
+        y   = rng.uniform(self.y[0], self.y[-1], npoints)
+
+        direct = backend.calcimage_batch(self.redshift, x, y)
+        lookup = self.calcimage_batch(self.redshift, x, y)
+
+        errors = OrderedDict()
+        for key in ['xsrc', 'ysrc', 'kappa', 'gamma1', 'gamma2', 'mag']:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                if key == 'mag':
+                    error = np.abs(lookup[key] / direct[key] - 1)
+                else:
+                    error = np.abs(lookup[key] - direct[key])
+            errors[key] = (np.nanmedian(error), np.nanmax(error))
+
+        return errors
@@ -0,0 +1,58 @@
+# coding:UTF-8
+
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    A least recently used cache bounded by the bytes of its values.
+
+    The size of a value is told by _nbytes: the nbytes of an array, and 1 for
+    any other value unless a subclass says otherwise. Once the values held
+    exceed maxbytes, the oldest entries are evicted until KEEP entries are left.
+    """
+    MAXBYTES = 256 * 1024**2
+    KEEP     = 0
+
+    def __init__(self, maxbytes=MAXBYTES):
+        self.maxbytes = maxbytes
+        self.entries  = OrderedDict()
+        self.nbytes   = 0
+        self.hits     = 0
+        self.misses   = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    @classmethod
+    def _nbytes(cls, value):
+        return getattr(value, 'nbytes', 1)
+
+    def get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        value = self.entries.pop(key)
+        self.entries[key] = value
+
+        return value
+
+    def put(self, key, value):
+        if key in self.entries:
+            self.nbytes -= self._nbytes(self.entries.pop(key))
+        self.entries[key] = value
+        self.nbytes      += self._nbytes(value)
+
+        while self.nbytes > self.maxbytes and len(self.entries) > self.KEEP:
+            _, old = self.entries.popitem(last=False)
+            self.nbytes -= self._nbytes(old)
+
+    def clear(self):
+        self.entries = OrderedDict()
+        self.nbytes  = 0
+
+    def stats(self):
+        return OrderedDict([('hits', self.hits), ('misses', self.misses),
+                            ('entries', len(self.entries)), ('bytes', self.nbytes)])
@@ -0,0 +1,246 @@
+# coding:UTF-8
+
+import numpy as np
+
+
+def gauss_sb(model, x, y, flag_extnorm=0):
+    """
+    surface brightness of extendmodel.Gauss at (x, y)
+    flag_extnorm: 0 -> Sigma0 is the central surface brightness
+    flag_extnorm: 1 -> Sigma0 is the total flux
+    """
+    ang  = (model.theta_e + 90.) * np.pi / 180.
+    c, s = np.cos(ang), np.sin(ang)
+    q    = 1. - model.e
+    dx   = x - model.x
+    dy   = y - model.y
+    r2   = q * (c * dx + s * dy)**2 + (-s * dx + c * dy)**2 / q
+
+    if flag_extnorm == 0:
+        norm = model.Sigma0
+    else:
+        norm = model.Sigma0 / (2 * np.pi * model.sigma**2)
+
+    return norm * np.exp(-r2 / (2 * model.sigma**2))
+
+
+def _norm(sigma, flag_extnorm):
+    return 1. if flag_extnorm == 0 else 1. / (2 * np.pi * sigma**2)
+
+
+def gauss_sum(xs, ys, amps, sigma, x, y, flag_extnorm=0, chunk=2**22):
+    """
+    sum of circular Gaussians of sigma and Sigma0 amps centred at (xs, ys),
+    evaluated at the points (x, y); components are taken a chunk of values at
+    a time
+    """
+    xs, ys, amps = np.asarray(xs, dtype=float), np.asarray(ys, dtype=float), np.asarray(amps, dtype=float)
+    shape, x, y  = np.shape(x), np.ravel(x), np.ravel(y)
+    step         = max(chunk // max(len(x), 1), 1)
+
+    sb = np.zeros(len(x))
+    for k in xrange(0, len(xs), step):
+        r2  = (x - xs[k:k+step, None])**2 + (y - ys[k:k+step, None])**2
+        sb += np.dot(amps[k:k+step], np.exp(-r2 / (2 * sigma**2)))
+
+    return _norm(sigma, flag_extnorm) * sb.reshape(shape)
+
+
+class ImageRenderer(object):
+    """
+    Renders extended sources on an image grid without glafic.
+
+    The sub-pixel centres of the grid are ray-traced to the source plane once
+    through the deflection of backend; each render then only evaluates the
+    source at the cached positions and averages nsub x nsub sub-pixels. The
+    source positions are also bounded per tile of TILE x TILE pixels, so that
+    the footprint of a source is found without rendering the whole frame.
+    """
+    TILE = 8
+
+    def __init__(self, backend, redshift, xmin, xmax, ymin, ymax, pix_ext, nsub=1, flag_extnorm=0):
+        self.nx           = int(round((xmax - xmin) / pix_ext))
+        self.ny           = int(round((ymax - ymin) / pix_ext))
+        self.nsub         = int(nsub)
+        self.flag_extnorm = flag_extnorm
+
+        sub    = pix_ext / self.nsub
+        x      = xmin + (np.arange(self.nx * self.nsub) + 0.5) * sub
+        y      = ymin + (np.arange(self.ny * self.nsub) + 0.5) * sub
+        X, Y   = np.meshgrid(x, y)
+        ax, ay = backend.deflection(redshift, X, Y)
+
+        self.xsrc = X - ax
+        self.ysrc = Y - ay
+
+        step     = self.TILE * self.nsub
+        iy, ix   = np.arange(0, len(y), step), np.arange(0, len(x), step)
+        self.xlo = np.minimum.reduceat(np.minimum.reduceat(self.xsrc, iy, axis=0), ix, axis=1)
+        self.xhi = np.maximum.reduceat(np.maximum.reduceat(self.xsrc, iy, axis=0), ix, axis=1)
+        self.ylo = np.minimum.reduceat(np.minimum.reduceat(self.ysrc, iy, axis=0), ix, axis=1)
+        self.yhi = np.maximum.reduceat(np.maximum.reduceat(self.ysrc, iy, axis=0), ix, axis=1)
+
+    def render(self, model):
+        sb = gauss_sb(model, self.xsrc, self.ysrc, self.flag_extnorm)
+        if self.nsub == 1:
+            return sb
+
+        return sb.reshape(self.ny, self.nsub, self.nx, self.nsub).mean(axis=(1, 3))
+
+    def render_sum(self, xs, ys, amps, sigma):
+        """ the image of the circular Gaussian sources of gauss_sum, all at once """
+        sb = gauss_sum(xs, ys, amps, sigma, self.xsrc, self.ysrc, self.flag_extnorm)
+        if self.nsub == 1:
+            return sb
+
+        return sb.reshape(self.ny, self.nsub, self.nx, self.nsub).mean(axis=(1, 3))
+
+    def windows(self, xs, ys, radius, centres=(), pad=0):
+        """
+        windows of the frame outside of which no sub-pixel is ray-traced within
+        radius of (xs, ys), one per centre (pixel indices) holding the tiles
+        nearest to it, widened by pad pixels; overlapping windows are merged
+        """
+        t      = self.TILE
+        ty, tx = np.nonzero((self.xlo - radius <= xs) & (xs <= self.xhi + radius) &
+                            (self.ylo - radius <= ys) & (ys <= self.yhi + radius))
+        if len(ty) == 0:
+            return []
+
+        if len(centres) > 1:
+            c     = np.asarray(centres, dtype=float)
+            owner = np.argmin((ty[:, None] * t + (t - 1) / 2. - c[:, 0])**2 + (tx[:, None] * t + (t - 1) / 2. - c[:, 1])**2, axis=1)
+        else:
+            owner = np.zeros(len(ty), dtype=int)
+
+        boxes = []
+        for k in np.unique(owner):
+            _ty, _tx = ty[owner == k], tx[owner == k]
+            boxes.append([max(_ty.min() * t - pad, 0), min((_ty.max() + 1) * t + pad, self.ny),
+                          max(_tx.min() * t - pad, 0), min((_tx.max() + 1) * t + pad, self.nx)])
+
+        merged = True
+        while merged:
+            merged = False
+            for a, b in [(a, b) for a in xrange(len(boxes)) for b in xrange(a + 1, len(boxes))]:
+                box_a, box_b = boxes[a], boxes[b]
+                if box_a[0] < box_b[1] and box_b[0] < box_a[1] and box_a[2] < box_b[3] and box_b[2] < box_a[3]:
+                    boxes[a] = [min(box_a[0], box_b[0]), max(box_a[1], box_b[1]), min(box_a[2], box_b[2]), max(box_a[3], box_b[3])]
+                    del boxes[b]
+                    merged = True
+                    break
+
+        return [(slice(y0, y1), slice(x0, x1)) for y0, y1, x0, x1 in boxes]
+
+
+class Patch(object):
+    """ a rectangular window of a frame and the data inside it """
+    def __init__(self, window, data):
+        self.window = window
+        self.data   = data
+
+    def copy(self):
+        return Patch(self.window, self.data.copy())
+
+    def add_to(self, frame, scale=1.):
+        frame[self.window] += scale * self.data
+
+    def to_frame(self, shape):
+        frame = np.zeros(shape)
+        frame[self.window] = self.data
+
+        return frame
+
+
+def frame_of(patches, shape):
+    """ the sum of patches on a frame of shape """
+    frame = np.zeros(shape)
+    for patch in patches:
+        patch.add_to(frame)
+
+    return frame
+
+
+def patches_of(frame, tol=0., centres=()):
+    """
+    split the footprint of frame, where |frame| > tol * max |frame|, into one
+    patch per centre (pixel indices) holding the pixels nearest to it
+    """
+    absframe = np.abs(frame)
+    iy, ix   = np.nonzero(absframe > tol * absframe.max())
+    if len(iy) == 0:
+        return []
+
+    if len(centres) > 1:
+        c     = np.asarray(centres, dtype=float)
+        owner = np.argmin((iy[:, None] - c[:, 0])**2 + (ix[:, None] - c[:, 1])**2, axis=1)
+    else:
+        owner = np.zeros(len(iy), dtype=int)
+
+    patches = []
+    for k in np.unique(owner):
+        _iy, _ix = iy[owner == k], ix[owner == k]
+        y0, x0   = _iy.min(), _ix.min()
+        data     = np.zeros((_iy.max() + 1 - y0, _ix.max() + 1 - x0))
+        data[_iy - y0, _ix - x0] = frame[_iy, _ix]
+        patches.append(Patch((slice(y0, _iy.max() + 1), slice(x0, _ix.max() + 1)), data))
+
+    return patches
+
+
+class SourceRenderer(object):
+    """
+    Renders extended sources on a source grid, restricted to a box of nsigma
+    times the major-axis sigma around each source.
+    """
+    def __init__(self, xmin, xmax, ymin, ymax, pix_ext, nsub=1, flag_extnorm=0, nsigma=5.):
+        self.xmin         = xmin
+        self.ymin         = ymin
+        self.pix_ext      = pix_ext
+        self.nx           = int(round((xmax - xmin) / pix_ext))
+        self.ny           = int(round((ymax - ymin) / pix_ext))
+        self.nsub         = int(nsub)
+        self.flag_extnorm = flag_extnorm
+        self.nsigma       = nsigma
+
+    def window(self, model):
+        half = self.nsigma * model.sigma / np.sqrt(1. - model.e)
+        ix0  = int(np.clip(np.floor((model.x - half - self.xmin) / self.pix_ext), 0, self.nx))
+        ix1  = int(np.clip(np.ceil((model.x + half - self.xmin) / self.pix_ext), ix0, self.nx))
+        iy0  = int(np.clip(np.floor((model.y - half - self.ymin) / self.pix_ext), 0, self.ny))
+        iy1  = int(np.clip(np.ceil((model.y + half - self.ymin) / self.pix_ext), iy0, self.ny))
+
+        return slice(iy0, iy1), slice(ix0, ix1)
+
+    def render_patch(self, model):
+        window = self.window(model)
+        wy, wx = window
+        sub    = self.pix_ext / self.nsub
+        x      = self.xmin + wx.start * self.pix_ext + (np.arange((wx.stop - wx.start) * self.nsub) + 0.5) * sub
+        y      = self.ymin + wy.start * self.pix_ext + (np.arange((wy.stop - wy.start) * self.nsub) + 0.5) * sub
+        X, Y   = np.meshgrid(x, y)
+        sb     = gauss_sb(model, X, Y, self.flag_extnorm)
+        if self.nsub != 1:
+            sb = sb.reshape(wy.stop - wy.start, self.nsub, wx.stop - wx.start, self.nsub).mean(axis=(1, 3))
+
+        return Patch(window, sb)
+
+    def render(self, model):
+        return self.render_patch(model).to_frame((self.ny, self.nx))
+
+    def render_sum(self, xs, ys, amps, sigma):
+        """
+        the circular Gaussian sources of gauss_sum on the whole grid, as one
+        product of their separable x and y profiles
+        """
+        xs, ys = np.asarray(xs, dtype=float), np.asarray(ys, dtype=float)
+        sub    = self.pix_ext / self.nsub
+        x      = self.xmin + (np.arange(self.nx * self.nsub) + 0.5) * sub
+        y      = self.ymin + (np.arange(self.ny * self.nsub) + 0.5) * sub
+        gx     = np.exp(-(x - xs[:, None])**2 / (2 * sigma**2))
+        gy     = np.exp(-(y - ys[:, None])**2 / (2 * sigma**2))
+        sb     = _norm(sigma, self.flag_extnorm) * np.dot(gy.T, np.asarray(amps, dtype=float)[:, None] * gx)
+        if self.nsub != 1:
+            sb = sb.reshape(self.ny, self.nsub, self.nx, self.nsub).mean(axis=(1, 3))
+
+        return sb
@@ -0,0 +1,35 @@
+# coding:UTF-8
+
+import os
+import shutil
+import tempfile
+
+
+class Workspace(object):
+    """
+    A scratch directory private to one run.
+
+    glafic input files and the files glafic writes for single components are
+    kept here, so runs sharing an output directory do not overwrite each other.
+    With shm=True the directory is made on a RAM-backed filesystem if there is
+    a writable one.
+    """
+    SHM_DIR = '/dev/shm'
+    PREFIX  = 'glean_'
+
+    def __init__(self, root=None, shm=False):
+        if root is None and shm and os.path.isdir(Workspace.SHM_DIR) and os.access(Workspace.SHM_DIR, os.W_OK):
+            root = Workspace.SHM_DIR
+        self.path = tempfile.mkdtemp(prefix=Workspace.PREFIX, dir=root)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.cleanup()
+
+    def join(self, name):
+        return os.path.join(self.path, name)
+
+    def cleanup(self):
+        shutil.rmtree(self.path, ignore_errors=True)
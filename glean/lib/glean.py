@@ -1,10 +1,17 @@
 # coding:UTF-8
 
 import os
+import sys
 import glob
+import shutil
+import signal
+import hashlib
+import contextlib
+import multiprocessing
 import numpy as np
+from cStringIO import StringIO
+from astropy.io import fits
 from collections import OrderedDict
-from copy import deepcopy
 
 from glafic import glafic as gf
 reload(gf)
@@ -12,6 +19,20 @@ from glafic import extendmodel
 reload(extendmodel)
 from glafic import pointmodel
 reload(pointmodel)
+from glafic import lensengine
+reload(lensengine)
+from glafic import lensmap
+reload(lensmap)
+from glafic import render
+reload(render)
+from glafic import imagefinder
+reload(imagefinder)
+from glafic import workspace
+reload(workspace)
+from glafic import lrucache
+reload(lrucache)
+import beambank
+reload(beambank)
 import fitsdata
 reload(fitsdata)
 import beammodel
@@ -38,7 +59,14 @@ class GleanParams(object):
         self.default_all_params = OrderedDict([('gain', 0.1), ('threshold', 3e-4),
                                                ('limit', 50), ('zmin', 0), ('zmax', -1), ('imgstep', 10),
                                                ('resstep', 10), ('sigma', 3e-3), ('flag_sconv', 1),
-                                               ('flag_iconv', 1), ('uncertainty', 0.005)])
+                                               ('flag_iconv', 1), ('uncertainty', 0.005), ('flag_native', 0),
+                                               ('flag_lensmap', 0), ('flag_render', 0), ('flag_finder', 0),
+                                               ('flag_shm', 0), ('glafic_timeout', 0.), ('glafic_retries', 1),
+                                               ('flag_stream', 0), ('npeaks', 1), ('peak_frac', 0.5),
+                                               ('template_quantum', 0.), ('template_mb', 256.), ('flag_bank', 0),
+                                               ('bank_step', 2.), ('bank_mb', 4096.), ('footprint_tol', 0.), ('precision', 64),
+                                               ('checkpoint_step', 0), ('nsigma_stop', 0.), ('flux_tol', 0.),
+                                               ('noise_step', 10), ('gain_max', 0.), ('flag_snapshot', 1)])
         self.all_params         = OrderedDict(self.default_all_params)
 
     @classmethod
@@ -67,11 +95,26 @@ class GleanParams(object):
     def _check_params(self, key, value):
         if key in {'gain', }:
             return 0 < value <= 1
-        elif key in {'threshold', 'resstep', 'imgstep', 'sigma', 'uncertainty'}:
+        elif key in {'gain_max', }:
+            return 0 <= value <= 1
+        elif key in {'threshold', 'resstep', 'imgstep', 'sigma', 'uncertainty', 'noise_step'}:
             return 0 < value
         elif key in {'limit', 'zmax'}:
             return -1 <= value
-        elif key in {'zmin', 'flag_sconv', 'flag_iconv'}:
+        elif key in {'glafic_timeout', 'glafic_retries', 'template_quantum', 'checkpoint_step', 'nsigma_stop', 'flux_tol'}:
+            return 0 <= value
+        elif key in {'template_mb', 'bank_step', 'bank_mb'}:
+            return 0 < value
+        elif key in {'precision', }:
+            return value in {32, 64}
+        elif key in {'footprint_tol', }:
+            return 0 <= value < 1
+        elif key in {'npeaks', }:
+            return 1 <= value
+        elif key in {'peak_frac', }:
+            return 0 <= value <= 1
+        elif key in {'zmin', 'flag_sconv', 'flag_iconv', 'flag_native', 'flag_lensmap',
+                     'flag_render', 'flag_finder', 'flag_shm', 'flag_stream', 'flag_bank', 'flag_snapshot'}:
             return 0 <= value
 
     def __setitem__(self, key, value):
@@ -86,6 +129,7 @@ class GleanParams(object):
         else:
             err = '{} is not a suitable value for {}.'.format(value, GleanParams.YELLOW_COLOR + key + GleanParams.CLEAR_COLOR)
             GleanParams.error(err)
+            return GleanParams.ERROR_CODE
 
     def reset(self, key):
         if key == 'all':
@@ -97,6 +141,29 @@ class GleanParams(object):
             GleanParams.error(err)
 
 
+class TemplateCache(lrucache.LRUCache):
+    """
+    A bounded LRU cache of lensed components.
+
+    Values are tuples of the convolved unit image, the unit source (a
+    FITSData2D or a render.Patch) and the multiple images found; keys are
+    quantized source positions. A change of fingerprint (lens, beam and the
+    params the templates depend on) drops every entry.
+    """
+    def __init__(self, maxbytes=lrucache.LRUCache.MAXBYTES):
+        super(TemplateCache, self).__init__(maxbytes)
+        self.fp = None
+
+    @classmethod
+    def _nbytes(cls, value):
+        return value[0].data.nbytes + value[1].data.nbytes
+
+    def validate(self, fp):
+        if fp != self.fp:
+            self.clear()
+            self.fp = fp
+
+
 class Glean(object):
     OUT_DIR = 'glean_out/'
 
@@ -106,11 +173,49 @@ class Glean(object):
     CLEAR_COLOR  = '\033[0m'
 
     ERROR_CODE   = -1
+    POOL_TIMEOUT = 1e7
+    BANK_DIR     = OUT_DIR + 'bank/'
+
+    # lens products of this many lens models are kept between runs
+    LENS_PRODUCTS = 4
+
+    # Newton iterations of the image finder on glafic, one round trip each
+    GLAFIC_NEWTON = 4
+
+    # exp(-x) is zero in double precision for x above this
+    EXP_UNDERFLOW = 746.
+
+    # keywords of the input cube carried over to the image and source planes
+    HEADER_KEYS = ['BUNIT', 'CTYPE1', 'CUNIT1', 'CRPIX1', 'CDELT1', 'CRVAL1', 'CTYPE2', 'CUNIT2', 'CRPIX2', 'CDELT2',
+                   'CRVAL2', 'BMAJ', 'BMIN', 'BPA', 'REDSHIFT']
+
+    # columns of the component table, one row per CLEAN component
+    COMPONENT_COLUMNS = ['iter', 'comp', 'x', 'y', 'sb_max', 'gain', 'conv_i', 'xsrc', 'ysrc', 'kappa', 'gamma',
+                         'phi', 'mag', 'x_img', 'y_img']
+
+    CHECKPOINT_DIR = OUT_DIR + 'checkpoint/'
+    # params which may differ between a run and its resumption
+    RESUMABLE      = {'zmin', 'zmax', 'checkpoint_step', 'glafic_timeout', 'glafic_retries', 'flag_shm'}
 
     def __init__(self, glafic_i, glafic_s, fitscls, maskcls):
         self.params            = GleanParams()
         self.glafic_i          = glafic_i
         self.glafic_s          = glafic_s
+        self.load(fitscls, maskcls)
+
+        self.lensmap   = None
+        self.workspace = None
+        self.templates = TemplateCache()
+        self.bank_dir  = Glean.BANK_DIR
+        self.resume    = False
+        # None asks before existing outputs are overwritten; True or False answers up front
+        self.overwrite = None
+
+        self.lens_products     = OrderedDict()
+        self.max_lens_products = Glean.LENS_PRODUCTS
+
+    def load(self, fitscls, maskcls):
+        """ set the data and the mask to CLEAN, keeping the params and the caches """
         self.default_fitscls   = fitscls
         self.maskcls           = maskcls
         self.beam              = beammodel.Gauss2D(self.default_fitscls.header['BMAJ'], self.default_fitscls.header['BMIN'],
@@ -134,7 +239,50 @@ class Glean(object):
     def error(self, err):
         print Glean.RED_COLOR + 'Glean error: ' + Glean.CLEAR_COLOR + err
 
-    def execute(self, phase=1):
+    def _fingerprint(self, zsrc, keys, beam=True):
+        """
+        fingerprint of the lens, the beam (unless beam is False), both glafic
+        params but the prefix of the outputs, and the params in keys
+        """
+        md5 = hashlib.md5()
+        md5.update(repr([item for item in self.glafic_i.params['all'].items() if item[0] != 'prefix']))
+        md5.update(repr([item for item in self.glafic_s.params['all'].items() if item[0] != 'prefix']))
+        for key in ['lens', 'psf']:
+            for model in self.glafic_i.models[key]:
+                md5.update(str(model))
+        beams = [self.default_fitscls.header[key] for key in ['BMAJ', 'BMIN', 'BPA']] if beam else []
+        md5.update(repr([zsrc] + beams + [self.params[key] for key in keys]))
+
+        return md5.hexdigest()
+
+    @contextlib.contextmanager
+    def _glafic_workspace(self):
+        """
+        give glafic_i and glafic_s a scratch directory of their own, removed
+        with all intermediate files at the end of the block
+        """
+        self.workspace = workspace.Workspace(shm=self.params['flag_shm'] != 0)
+        for glafic in [self.glafic_i, self.glafic_s]:
+            glafic.set_workspace(self.workspace)
+            glafic.timeout = self.params['glafic_timeout'] or None
+            glafic.retries = self.params['glafic_retries']
+        try:
+            yield self.workspace
+        finally:
+            self.glafic_i.set_workspace(None)
+            self.glafic_s.set_workspace(None)
+            self.workspace.cleanup()
+            self.workspace = None
+
+    def execute(self, phase=1, njobs=1, resume=False):
+        """ CLEAN the channels; return True if every channel was finished """
+        # each run gets its own scratch directory for glafic, removed with
+        # all intermediate files at the end
+        with self._glafic_workspace():
+            self.resume = resume
+            return self._execute(phase, njobs)
+
+    def _set_names(self):
         prefix_i = self.glafic_i.params['prefix']
         prefix_s = self.glafic_s.params['prefix']
 
@@ -143,24 +291,61 @@ class Glean(object):
         self.all_res_name  = prefix_i + '_residue_{}.fits'
         self.one_imgs_name = prefix_i + '_image_indiv_{}.fits'
         self.one_srcs_name = prefix_s + '_source_indiv_{}.fits'
+        self.comps_name    = prefix_i + '_components_{}.fits'
 
         # self.one_imgs_raw_name = prefix_i + '_image_raw_indiv_{}.fits'
         # self.one_srcs_raw_name = prefix_s + '_source_raw_indiv_{}.fits'
 
         self.reg_name      = prefix_i + '_mutliple_images_{}.reg'
 
+        # runs with other prefixes keep their checkpoints apart
+        self.checkpoint_dir = Glean.CHECKPOINT_DIR + os.path.basename(prefix_i) + '/'
+
+    def _headers(self):
+        """
+        headers of the image and source planes: both keep the keywords of the
+        input cube, whose beam is also the unit of the source plane, and the
+        source plane gets the WCS of the source grid of glafic_s
+        """
+        header     = self.default_fitscls.header
+        img_header = fits.Header([(key, header[key]) for key in Glean.HEADER_KEYS if key in header])
+        src_header = img_header.copy()
+
+        pix_ext_s = self.glafic_s.params['pix_ext']
+        for axis, key in [(1, 'xmin'), (2, 'ymin')]:
+            crval = header.get('CRVAL{}'.format(axis), 0.)
+            src_header['CRPIX{}'.format(axis)] = 0.5 - (self.glafic_s.params[key] - crval) / pix_ext_s
+            src_header['CDELT{}'.format(axis)] = pix_ext_s
+            src_header['CRVAL{}'.format(axis)] = crval
+
+        return img_header, src_header
+
+    def existing_outputs(self):
+        """ output files of a run with the current prefixes that already exist """
+        self._set_names()
+        names = [self.all_img_name, self.all_src_name, self.all_res_name, self.one_imgs_name, self.one_srcs_name,
+                 self.reg_name, self.comps_name]
+
+        return sorted(sum([glob.glob(name.replace('{}', '*')) for name in names], []))
+
+    def _execute(self, phase, njobs):
         # need to be revised
-        if glob.glob(self.all_img_name) or glob.glob(self.all_src_name) or \
-           glob.glob(self.all_res_name) or glob.glob(self.one_imgs_name.replace('{}', '*')) or \
-           glob.glob(self.one_srcs_name.replace('{}', '*')) or glob.glob(self.reg_name.replace('{}', '*')):
-            check = raw_input('Output files already exist. Continue? (y/[n]): ')
+        if self.resume:
+            pass
+        elif self.existing_outputs():
+            if self.overwrite is None:
+                check = raw_input('Output files already exist. Continue? (y/[n]): ')
+            else:
+                check = 'y' if self.overwrite else 'n'
             if check == 'y':
                 pass
             else:
-                return
+                Glean.error('Output files already exist.')
+                return False
 
+        self._set_names()
         self.glafic_i.create_input()
-        self.fitscls = deepcopy(self.default_fitscls)
+        self.fitscls = self.default_fitscls.view()
 
         zsrc = self.default_fitscls.header['REDSHIFT']
 
@@ -176,11 +361,428 @@ class Glean(object):
         ymax_s    = self.glafic_s.params['ymax']
         pix_ext_s = self.glafic_s.params['pix_ext']
 
-        one_img_name     = prefix_i + gf.Glafic.IMG_SUFFIX
-        one_src_name     = prefix_s + gf.Glafic.SRC_SUFFIX
-        one_img_inp_name = self.glafic_i.inputname
-        one_src_inp_name = self.glafic_s.inputname
-        one_point_name   = prefix_i + gf.Glafic.POINT_SUFFIX
+        zmin         = self.params['zmin']
+        zmax         = self.params['zmax']
+        flag_bank    = self.params['flag_bank']
+        flag_render  = self.params['flag_render'] or flag_bank
+        flag_finder  = self.params['flag_finder']
+
+        # image-plane responses are looked up in a bank built beforehand by bank
+        if flag_bank != 0:
+            path = beambank.BeamBank.filename(self.bank_dir, self._bank_fingerprint(zsrc))
+            try:
+                self.bank = beambank.BeamBank(path, xmin_s, ymin_s, self.params['bank_step'] * pix_ext_s)
+            except beambank.BeamBankError as e:
+                Glean.error(e.msg + ' Run bank for the current model first.')
+                return False
+
+        lens, renderer_i, renderer_s, finder = self._lens_products(zsrc)
+
+        self.zsrc    = zsrc
+        self.lens    = lens
+        self.shape_i = (int(round((ymax_i - ymin_i) / pix_ext_i)), int(round((xmax_i - xmin_i) / pix_ext_i)))
+        self.shape_s = (int(round((ymax_s - ymin_s) / pix_ext_s)), int(round((xmax_s - xmin_s) / pix_ext_s)))
+        self.img_header, self.src_header = self._headers()
+        if flag_render != 0:
+            self.renderer_i = renderer_i
+            self.renderer_s = renderer_s
+        if flag_finder != 0:
+            self.finder = finder
+
+        # templates survive between runs as long as nothing they depend on changes
+        self.templates.maxbytes = int(self.params['template_mb'] * 1024**2)
+        self.templates.validate(self._fingerprint(zsrc, ['sigma', 'flag_iconv', 'flag_native', 'flag_lensmap', 'flag_render',
+                                                         'flag_finder', 'flag_bank', 'bank_step', 'template_quantum']))
+
+        # each channel copies its final planes into the cubes once; with workers
+        # the cubes live in shared memory
+        # residuals and cubes are kept in float32 with precision 32; components
+        # and the accumulated model planes stay in float64
+        self.dtype   = np.float32 if self.params['precision'] == 32 else np.float64
+        channels     = [j for j in xrange(len(self.fitscls.data)) if zmin <= j and (zmax == -1 or j <= zmax)]
+
+        # checkpoints of an earlier run are only kept by --resume, and only if
+        # they were made with the same params
+        self.run_fp = self._fingerprint(zsrc, [key for key in self.params['all'] if key not in Glean.RESUMABLE])
+        if self.resume:
+            for name in glob.glob(os.path.join(self.checkpoint_dir, '*.npz')):
+                if np.load(name)['fp'].item() != self.run_fp:
+                    Glean.error('Checkpoints in {} were made with other params.'.format(self.checkpoint_dir))
+                    return False
+        elif os.path.isdir(self.checkpoint_dir):
+            shutil.rmtree(self.checkpoint_dir)
+        if self.params['checkpoint_step'] != 0 and not os.path.isdir(self.checkpoint_dir):
+            os.makedirs(self.checkpoint_dir)
+
+        self.all_img = fitsdata.FITSData3D.initbyshape((len(channels), ) + self.shape_i, shared=njobs > 1, dtype=self.dtype)
+        self.all_src = fitsdata.FITSData3D.initbyshape((len(channels), ) + self.shape_s, shared=njobs > 1, dtype=self.dtype)
+
+        if njobs > 1:
+            ndone, nfailed, interrupted = self._clean_channels_parallel(channels, phase, njobs)
+        else:
+            ndone, nfailed, interrupted = 0, 0, False
+            for k, j in enumerate(channels):
+                interrupted = self._clean_channel(j, phase, self.all_img.data[k], self.all_src.data[k])
+                ndone       = k + 1
+                nfailed    += self.failed
+                if interrupted:
+                    break
+
+        img_header, src_header = self._headers()
+        self.all_img.data = self.all_img.data[:ndone]
+        self.all_src.data = self.all_src.data[:ndone]
+        self.all_img.set_header(img_header)
+        self.all_img.write_fits(self.all_img_name)
+        self.all_src.set_header(src_header)
+        self.all_src.write_fits(self.all_src_name)
+
+        if all(os.path.exists(self._checkpoint_name(j, 'done')) for j in channels):
+            shutil.rmtree(self.checkpoint_dir, ignore_errors=True)
+            # the parent is removed with the checkpoints of the last prefix
+            try:
+                os.rmdir(Glean.CHECKPOINT_DIR)
+            except OSError:
+                pass
+
+        if nfailed:
+            Glean.error('{} of {} channels are unfinished because glafic failed.'.format(nfailed, len(channels)))
+
+        return not interrupted and nfailed == 0 and ndone == len(channels)
+
+    def _checkpoint_name(self, j, kind='channel'):
+        return os.path.join(self.checkpoint_dir, '{}_{}.npz'.format(kind, j + 1))
+
+    def _write_checkpoint(self, j, kind, **state):
+        """ write state to the checkpoint of channel j, replacing the last one at once """
+        name = self._checkpoint_name(j, kind)
+        with open(name + '.tmp', 'wb') as f:
+            np.savez(f, fp=self.run_fp, **state)
+        os.rename(name + '.tmp', name)
+
+    def _load_checkpoint(self, j, kind='channel'):
+        name = self._checkpoint_name(j, kind)
+        if not os.path.exists(name):
+            return None
+
+        return np.load(name)
+
+    def _save_checkpoint(self, j, i, regfile, sb_max_prev, pos_prev, noise, fluxes, flag_render, flag_stream):
+        """ save the state of channel j after iteration i """
+        regfile.flush()
+        self.comps.write_fits(self.comps_name.format(j + 1))
+        if flag_render != 0:
+            one_src = render.frame_of(self.one_src_patches, self.shape_s)
+        else:
+            one_src = self.one_src.data
+
+        cubes = [('all_res', self.all_res), ('one_imgs', self.one_imgs), ('one_srcs', self.one_srcs)]
+        if flag_stream != 0:
+            for _, cube in cubes:
+                cube.flush()
+            cubes = dict((name, cube.nframes) for name, cube in cubes)
+        else:
+            cubes = dict((name, cube.data) for name, cube in cubes)
+
+        self._write_checkpoint(j, 'channel', i=i, res=self.fitscls_p.data, img=self.all_img_p.data, src=self.all_src_p.data,
+                               one_img=self.one_img.data, one_src=one_src, sb_max_prev=sb_max_prev, pos_prev=pos_prev,
+                               noise=np.nan if noise is None else noise, fluxes=fluxes, reg=regfile.tell(), **cubes)
+
+    def _restore_checkpoint(self, j, state, flag_stream):
+        """ set channel j to a state saved by _save_checkpoint; return the open region file """
+        shape_i, shape_s = self.shape_i, self.shape_s
+
+        self.fitscls_p = fitsdata.FITSData2D.initbydata(state['res'], self.fitscls.header)
+        self.all_res_p = self.fitscls_p
+        self.all_img_p = fitsdata.FITSData2D.initbydata(state['img'], self.img_header.copy())
+        self.all_src_p = fitsdata.FITSData2D.initbydata(state['src'], self.src_header.copy())
+        self.one_img   = fitsdata.FITSData2D.initbydata(state['one_img'], {})
+        self.one_src   = fitsdata.FITSData2D.initbydata(state['one_src'], {})
+        self.one_src_patches = [render.Patch((slice(0, shape_s[0]), slice(0, shape_s[1])), self.one_src.data)]
+
+        if flag_stream != 0:
+            self.all_res  = fitsdata.FITSCubeWriter.reopen(self.all_res_name.format(j+1), shape_i, int(state['all_res']), self.dtype)
+            self.one_imgs = fitsdata.FITSCubeWriter.reopen(self.one_imgs_name.format(j+1), shape_i, int(state['one_imgs']), self.dtype)
+            self.one_srcs = fitsdata.FITSCubeWriter.reopen(self.one_srcs_name.format(j+1), shape_s, int(state['one_srcs']), self.dtype)
+        else:
+            self.all_res  = fitsdata.FITSData3D.initbydata(state['all_res'], {})
+            self.one_imgs = fitsdata.FITSData3D.initbydata(state['one_imgs'], {})
+            self.one_srcs = fitsdata.FITSData3D.initbydata(state['one_srcs'], {})
+
+        self.comps      = fitsdata.FITSTable.initbyname(self.comps_name.format(j + 1), Glean.COMPONENT_COLUMNS)
+        self.comps.rows = [row for row in self.comps.rows if row[0] <= state['i']]
+
+        regfile = open(self.reg_name.format(j + 1), 'r+')
+        regfile.truncate(int(state['reg']))
+        regfile.seek(0, 2)
+
+        return regfile
+
+    def _setup_lens(self, zsrc):
+        """ return the backend answering calcimage and deflection for the current params """
+        xmin_i    = self.glafic_i.params['xmin']
+        ymin_i    = self.glafic_i.params['ymin']
+        xmax_i    = self.glafic_i.params['xmax']
+        ymax_i    = self.glafic_i.params['ymax']
+        pix_ext_i = self.glafic_i.params['pix_ext']
+
+        # glafic stays available as the reference backend
+        if self.params['flag_native'] != 0:
+            lens = lensengine.LensEngine(self.glafic_i)
+        else:
+            lens = self.glafic_i
+
+        # the lens model is fixed during a run, so calcimage can be a lookup
+        if self.params['flag_lensmap'] != 0:
+            print '===> build lens maps'
+            self.lensmap = lensmap.LensMap(lens, zsrc, xmin_i, xmax_i, ymin_i, ymax_i, pix_ext_i)
+            for k, v in self.lensmap.check(lens).iteritems():
+                print '{:<25} = {:.3e} (median), {:.3e} (max)'.format(Glean.YELLOW_COLOR + 'error of ' + k + Glean.CLEAR_COLOR, *v)
+            print ''
+            lens = self.lensmap
+
+        return lens
+
+    def _lens_products(self, zsrc):
+        """
+        return the lens backend, the renderers and the image finder for the
+        current params; those of the last max_lens_products lens models are kept, so
+        runs on the same lens model and grids build them only once
+        """
+        xmin_i    = self.glafic_i.params['xmin']
+        ymin_i    = self.glafic_i.params['ymin']
+        xmax_i    = self.glafic_i.params['xmax']
+        ymax_i    = self.glafic_i.params['ymax']
+        pix_ext_i = self.glafic_i.params['pix_ext']
+
+        xmin_s    = self.glafic_s.params['xmin']
+        ymin_s    = self.glafic_s.params['ymin']
+        xmax_s    = self.glafic_s.params['xmax']
+        ymax_s    = self.glafic_s.params['ymax']
+        pix_ext_s = self.glafic_s.params['pix_ext']
+
+        flag_render = self.params['flag_render'] or self.params['flag_bank']
+        flag_finder = self.params['flag_finder']
+
+        # the beam does not enter the lens products
+        key = self._fingerprint(zsrc, ['flag_native', 'flag_lensmap', 'flag_render', 'flag_finder', 'flag_bank'], beam=False)
+        if key in self.lens_products:
+            print '===> reuse lens products'
+            self.lens_products[key] = self.lens_products.pop(key)
+            return self.lens_products[key]
+
+        lens = self._setup_lens(zsrc)
+        renderer_i, renderer_s, finder = None, None, None
+
+        # components are rendered in memory instead of by writeimage and writeimage_ori
+        if flag_render != 0:
+            print '===> ray-trace image plane'
+            renderer_i = render.ImageRenderer(lens, zsrc, xmin_i, xmax_i, ymin_i, ymax_i, pix_ext_i,
+                                              self.glafic_i.params['seeing_sub'], self.glafic_i.params['flag_extnorm'])
+            renderer_s = render.SourceRenderer(xmin_s, xmax_s, ymin_s, ymax_s, pix_ext_s,
+                                               self.glafic_s.params['seeing_sub'], self.glafic_s.params['flag_extnorm'])
+
+        # multiple images are found on lensed triangles instead of by findimg
+        if flag_finder != 0:
+            print '===> build image finder'
+            refiner, max_newton = None, None
+            if lens is self.glafic_i:
+                # every Newton iteration on glafic is a round trip; refine in process if possible
+                refiner    = lensengine.LensEngine(self.glafic_i)
+                refiner    = refiner if refiner.supports() else None
+                max_newton = Glean.GLAFIC_NEWTON
+            finder = imagefinder.ImageFinder(lens, zsrc, xmin_i, xmax_i, ymin_i, ymax_i, pix_ext_i,
+                                             refiner, max_newton)
+
+        self.lens_products[key] = (lens, renderer_i, renderer_s, finder)
+        while len(self.lens_products) > self.max_lens_products:
+            self.lens_products.popitem(last=False)
+
+        return self.lens_products[key]
+
+    def prepare(self):
+        """ build the lens products for the current data and params ahead of a run """
+        with self._glafic_workspace():
+            self.glafic_i.create_input()
+            self._lens_products(self.default_fitscls.header['REDSHIFT'])
+
+    def _bank_fingerprint(self, zsrc):
+        return self._fingerprint(zsrc, ['sigma', 'flag_iconv', 'flag_native', 'flag_lensmap', 'bank_step'])
+
+    def _bank_response(self, x, y):
+        """ the convolved image of a unit component at source position (x, y) """
+        gauss    = extendmodel.Gauss(self.zsrc, 1., x, y, 0, 0, self.params['sigma'], 0)
+        response = fitsdata.FITSData2D.initbydata(self.renderer_i.render(gauss), {})
+        if self.params['flag_iconv'] != 0:
+            self.beam.convolve(response, 'image')
+
+        return response.data
+
+    def build_bank(self, njobs=1):
+        """
+        render the responses of unit components on a lattice of bank_step
+        source pixels over the source plane, with njobs worker processes
+        """
+        zsrc      = self.default_fitscls.header['REDSHIFT']
+        pix_ext_s = self.glafic_s.params['pix_ext']
+        path      = beambank.BeamBank.filename(self.bank_dir, self._bank_fingerprint(zsrc))
+        if os.path.exists(path):
+            Glean.success('The bank for the current model already exists: {}'.format(path))
+            return True
+        if not os.path.isdir(self.bank_dir):
+            os.makedirs(self.bank_dir)
+
+        # the bank holds a full image per node, so its size is checked before any work
+        params_i, params_s = self.glafic_i.params, self.glafic_s.params
+        xnodes, ynodes = beambank.BeamBank.lattice(params_s['xmin'], params_s['xmax'], params_s['ymin'], params_s['ymax'],
+                                                   self.params['bank_step'] * pix_ext_s)
+        shape_i = (int(round((params_i['ymax'] - params_i['ymin']) / params_i['pix_ext'])),
+                   int(round((params_i['xmax'] - params_i['xmin']) / params_i['pix_ext'])))
+        nbytes  = beambank.BeamBank.nbytes(xnodes, ynodes, shape_i)
+        if nbytes > self.params['bank_mb'] * 1024**2:
+            Glean.error('The bank would take {:.0f} MB for {} x {} nodes, more than bank_mb; '
+                        'increase bank_step or bank_mb.'.format(nbytes / 1024.**2, len(xnodes), len(ynodes)))
+            return False
+
+        with self._glafic_workspace():
+            try:
+                self.glafic_i.create_input()
+                lens = self._setup_lens(zsrc)
+
+                print '===> ray-trace image plane'
+                self.zsrc       = zsrc
+                self.renderer_i = render.ImageRenderer(lens, zsrc, self.glafic_i.params['xmin'], self.glafic_i.params['xmax'],
+                                                       self.glafic_i.params['ymin'], self.glafic_i.params['ymax'],
+                                                       self.glafic_i.params['pix_ext'], self.glafic_i.params['seeing_sub'],
+                                                       self.glafic_i.params['flag_extnorm'])
+
+                print '===> render {} x {} responses ({:.0f} MB)'.format(len(xnodes), len(ynodes), nbytes / 1024.**2)
+                beambank.BeamBank.build(path, xnodes, ynodes, shape_i, self._bank_response, njobs)
+            except KeyboardInterrupt:
+                print '\n'
+                Glean.error('Keyboard Interrupted.')
+                return False
+
+        Glean.success('Bank written to {}'.format(path))
+
+        return True
+
+    def reconstruct(self, comps, j, iteration=-1):
+        """
+        rebuild the image-plane model, the source-plane model and the residual
+        of channel j after iteration (the last one if -1) from its component
+        table comps; all components are rendered in one pass and convolved
+        with the beam once
+        """
+        rows  = [row for row in comps.rows if iteration == -1 or row[0] <= iteration]
+        names = Glean.COMPONENT_COLUMNS
+        xsrc  = np.array([row[names.index('xsrc')] for row in rows])
+        ysrc  = np.array([row[names.index('ysrc')] for row in rows])
+        amps  = np.array([row[names.index('conv_i')] * row[names.index('gain')] for row in rows])
+        sigma = self.params['sigma']
+
+        img = fitsdata.FITSData2D.initbydata(self.renderer_i.render_sum(xsrc, ysrc, amps, sigma), {})
+        if self.params['flag_iconv'] != 0:
+            self.beam.convolve(img, 'image')
+
+        # sources are only scaled like their images with flag_sconv
+        if self.params['flag_sconv'] == 0:
+            amps = np.ones(len(rows))
+        src = self.renderer_s.render_sum(xsrc, ysrc, amps, sigma)
+        res = self.default_fitscls.data[j] - img.data
+
+        return img.data, src, res
+
+    def restore(self, iteration=-1):
+        """
+        write the models and the residual of every channel after iteration (the
+        last one if -1), reconstructed from the component tables of the last run
+        """
+        prefix_i = self.glafic_i.params['prefix']
+        prefix_s = self.glafic_s.params['prefix']
+        zsrc     = self.default_fitscls.header['REDSHIFT']
+        zmin     = self.params['zmin']
+        zmax     = self.params['zmax']
+        channels = [j for j in xrange(len(self.default_fitscls.data)) if zmin <= j and (zmax == -1 or j <= zmax)]
+        self._set_names()
+
+        with self._glafic_workspace():
+            try:
+                self.glafic_i.create_input()
+                lens = self._setup_lens(zsrc)
+
+                print '===> ray-trace image plane'
+                self.renderer_i = render.ImageRenderer(lens, zsrc, self.glafic_i.params['xmin'], self.glafic_i.params['xmax'],
+                                                       self.glafic_i.params['ymin'], self.glafic_i.params['ymax'],
+                                                       self.glafic_i.params['pix_ext'], self.glafic_i.params['seeing_sub'],
+                                                       self.glafic_i.params['flag_extnorm'])
+                self.renderer_s = render.SourceRenderer(self.glafic_s.params['xmin'], self.glafic_s.params['xmax'],
+                                                        self.glafic_s.params['ymin'], self.glafic_s.params['ymax'],
+                                                        self.glafic_s.params['pix_ext'], self.glafic_s.params['seeing_sub'],
+                                                        self.glafic_s.params['flag_extnorm'])
+
+                for j in channels:
+                    try:
+                        comps = fitsdata.FITSTable.initbyname(self.comps_name.format(j + 1), Glean.COMPONENT_COLUMNS)
+                    except fitsdata.FITSDataError as e:
+                        Glean.error(e.msg)
+                        continue
+
+                    print '===> restore channel {}'.format(j + 1)
+                    img, src, res = self.reconstruct(comps, j, iteration)
+                    niter = int(max([row[0] for row in comps.rows if iteration == -1 or row[0] <= iteration] or [0]))
+                    img_header, src_header = self._headers()
+                    img_header['ITER'] = niter
+                    src_header['ITER'] = niter
+                    fitsdata.FITSData2D.initbydata(img, img_header).write_fits(prefix_i + '_image_restore_{}.fits'.format(j + 1))
+                    fitsdata.FITSData2D.initbydata(src, src_header).write_fits(prefix_s + '_source_restore_{}.fits'.format(j + 1))
+                    fitsdata.FITSData2D.initbydata(res, img_header).write_fits(prefix_i + '_residue_restore_{}.fits'.format(j + 1))
+                    Glean.success('Channel {} restored after iteration {}.'.format(j + 1, niter))
+            except KeyboardInterrupt:
+                print '\n'
+                Glean.error('Keyboard Interrupted.')
+
+    def _clean_channels_parallel(self, channels, phase, njobs):
+        """
+        CLEAN channels in njobs forked workers with their own glafic scratch
+        directories; logs are printed in channel order as the channels finish
+        """
+        global _pool_glean
+
+        # the children of glafic sessions must not be shared with the workers
+        self.glafic_i.close()
+        self.glafic_s.close()
+        _pool_glean = (self, phase)
+
+        ndone, nfailed, interrupted = 0, 0, False
+        pool = multiprocessing.Pool(njobs, _pool_init)
+        try:
+            results = pool.imap(_pool_clean, list(enumerate(channels)))
+            for k in xrange(len(channels)):
+                log, interrupted, failed = results.next(Glean.POOL_TIMEOUT)
+                sys.stdout.write(log)
+                ndone    = k + 1
+                nfailed += failed
+                if interrupted:
+                    break
+        except KeyboardInterrupt:
+            print '\n'
+            Glean.error('Keyboard Interrupted.')
+            Glean.success('Output results of finished channels.')
+            interrupted = True
+        finally:
+            pool.terminate()
+            pool.join()
+            _pool_glean = None
+
+        return ndone, nfailed, interrupted
+
+    def _clean_channel(self, j, phase, img_plane, src_plane):
+        """
+        CLEAN channel j, write its residual, component and region files and
+        copy the accumulated image and source planes into img_plane and
+        src_plane; return True if interrupted, and set failed if glafic failed
+        """
+        self.failed = False
 
         threshold   = self.params['threshold']
         gain        = self.params['gain']
@@ -188,22 +790,78 @@ class Glean(object):
         imgstep     = self.params['imgstep']
         limit       = self.params['limit']
         sigma       = self.params['sigma']
-        zmin        = self.params['zmin']
-        zmax        = self.params['zmax']
         flag_sconv  = self.params['flag_sconv']
         flag_iconv  = self.params['flag_iconv']
-        uncertainty = self.params['uncertainty']
+        flag_bank   = self.params['flag_bank']
+        flag_render = self.params['flag_render'] or flag_bank
+        flag_finder = self.params['flag_finder']
+        flag_stream = self.params['flag_stream']
+        flag_snapshot   = self.params['flag_snapshot']
+        checkpoint_step = self.params['checkpoint_step']
+        npeaks      = self.params['npeaks']
+        peak_frac   = self.params['peak_frac']
+        nsigma_stop = self.params['nsigma_stop']
+        flux_tol    = self.params['flux_tol']
+        noise_step  = self.params['noise_step']
+        gain_max    = self.params['gain_max']
 
-        shape_i = (int(round((ymax_i - ymin_i) / pix_ext_i)), int(round((xmax_i - xmin_i) / pix_ext_i)))
-        shape_s = (int(round((ymax_s - ymin_s) / pix_ext_s)), int(round((xmax_s - xmin_s) / pix_ext_s)))
+        # peaks of one iteration are at least a beam FWHM apart
+        separation = self.beam.bmaj_i / abs(self.beam.dx_i)
+        pix_ext_s  = self.glafic_s.params['pix_ext']
 
-        self.all_img  = fitsdata.FITSData3D.initbyshape((0, shape_i[0], shape_i[1]))
-        self.all_src  = fitsdata.FITSData3D.initbyshape((0, shape_s[0], shape_s[1]))
-        for j, self.fitscls_p in enumerate(self.fitscls):
-            if j < zmin:
-                continue
-            if zmax != -1 and zmax < j:
-                continue
+        # components are snapped to a grid of this step to share templates
+        quantum = self.params['template_quantum'] * pix_ext_s
+
+        footprint_tol = self.params['footprint_tol']
+        xmin_i        = self.glafic_i.params['xmin']
+        ymin_i        = self.glafic_i.params['ymin']
+        pix_ext_i     = self.glafic_i.params['pix_ext']
+
+        # a rendered component is below footprint_tol of its peak (exactly zero
+        # by default) beyond radius_s of its source position, and the beam
+        # spreads it over pad_i more pixels; bank responses are interpolated
+        # between nodes up to a lattice diagonal away
+        log_tol  = Glean.EXP_UNDERFLOW if footprint_tol == 0 else -np.log(footprint_tol)
+        radius_s = sigma * np.sqrt(2 * log_tol)
+        if flag_bank != 0:
+            radius_s += np.sqrt(2) * self.params['bank_step'] * pix_ext_s
+        pad_i = (self.beam.xsize_i - 1) // 2 if flag_iconv != 0 else 0
+
+        zsrc    = self.zsrc
+        lens    = self.lens
+        shape_i = self.shape_i
+        shape_s = self.shape_s
+        if flag_render != 0:
+            renderer_i = self.renderer_i
+            renderer_s = self.renderer_s
+        if flag_finder != 0:
+            finder = self.finder
+
+        one_img_name = self.glafic_i.scratch_prefix() + gf.Glafic.IMG_SUFFIX
+        one_src_name = self.glafic_s.scratch_prefix() + gf.Glafic.SRC_SUFFIX
+
+        # a resumed run takes finished channels from their checkpoints
+        done = self._load_checkpoint(j, 'done') if self.resume else None
+        if done is not None:
+            img_plane[...]  = done['img']
+            src_plane[...]  = done['src']
+            self.all_img_p = fitsdata.FITSData2D.initbydata(done['img'], self.img_header.copy())
+            self.all_src_p = fitsdata.FITSData2D.initbydata(done['src'], self.src_header.copy())
+            Glean.success('Channel {} was finished before.'.format(j + 1))
+            print ''
+            return False
+
+        state = self._load_checkpoint(j) if self.resume else None
+        if state is not None:
+            regfile = self._restore_checkpoint(j, state, flag_stream)
+            i       = int(state['i'])
+            sb_max_prev, pos_prev = state['sb_max_prev'].item(), tuple(state['pos_prev'].tolist())
+            noise, fluxes         = state['noise'].item(), state['fluxes'].tolist()
+            noise                 = None if np.isnan(noise) else noise
+            Glean.success('Channel {} resumes after iteration {}.'.format(j + 1, i))
+        else:
+            # the residual is updated in place, so it must not be a view of the cube
+            self.fitscls_p = fitsdata.FITSData2D.initbydata(self.fitscls.data[j].astype(self.dtype), self.fitscls.header)
 
             regfile = open(self.reg_name.format(j + 1), 'w')
             regfile.write('# Region file format: DS9 version 4.1\n')
@@ -212,52 +870,114 @@ class Glean(object):
 
             self.all_img_p = fitsdata.FITSData2D.initbyshape(shape_i)
             self.all_src_p = fitsdata.FITSData2D.initbyshape(shape_s)
-            self.all_res   = fitsdata.FITSData3D.initbyshape((0, shape_i[0], shape_i[1]))
-            self.all_res_p = fitsdata.FITSData2D.initbyshape(shape_i)
+            self.all_img_p.set_header(self.img_header.copy())
+            self.all_src_p.set_header(self.src_header.copy())
+            self.all_res_p = fitsdata.FITSData2D.initbyshape(shape_i, dtype=self.dtype)
             self.one_img   = fitsdata.FITSData2D.initbyshape(shape_i)
             self.one_src   = fitsdata.FITSData2D.initbyshape(shape_s)
-            self.one_imgs  = fitsdata.FITSData3D.initbyshape((0, shape_i[0], shape_i[1]))
-            self.one_srcs  = fitsdata.FITSData3D.initbyshape((0, shape_s[0], shape_s[1]))
+            self.one_src_patches = []
+            self.comps           = fitsdata.FITSTable(Glean.COMPONENT_COLUMNS)
 
-            # self.one_img_raw  = fitsdata.FITSData2D.initbyshape(shape_i)
-            # self.one_src_raw  = fitsdata.FITSData2D.initbyshape(shape_s)
-            # self.one_imgs_raw = fitsdata.FITSData3D.initbyshape((0, shape_i[0], shape_i[1]))
-            # self.one_srcs_raw = fitsdata.FITSData3D.initbyshape((0, shape_s[0], shape_s[1]))
+            # snapshot cubes go straight to disk, or are kept in memory
+            if flag_stream != 0:
+                self.all_res  = fitsdata.FITSCubeWriter(self.all_res_name.format(j+1), shape_i, dtype=self.dtype)
+                self.one_imgs = fitsdata.FITSCubeWriter(self.one_imgs_name.format(j+1), shape_i, dtype=self.dtype)
+                self.one_srcs = fitsdata.FITSCubeWriter(self.one_srcs_name.format(j+1), shape_s, dtype=self.dtype)
+            else:
+                self.all_res  = fitsdata.FITSData3D.initbyshape((0, shape_i[0], shape_i[1]), dtype=self.dtype)
+                self.one_imgs = fitsdata.FITSData3D.initbyshape((0, shape_i[0], shape_i[1]), dtype=self.dtype)
+                self.one_srcs = fitsdata.FITSData3D.initbyshape((0, shape_s[0], shape_s[1]), dtype=self.dtype)
 
             i = 0
             sb_max_prev, pos_prev = None, None
-            try:
-                while True:
+            noise, fluxes         = None, [0.]
+
+        peak_index = fitsdata.PeakIndex(self.fitscls_p, self.maskcls)
+
+        # cubes in memory are preallocated for limit iterations
+        if flag_stream == 0 and flag_snapshot != 0 and limit != -1:
+            self.all_res.reserve((limit - 1) // resstep + 2)
+            self.one_imgs.reserve((limit - 1) // imgstep + 2)
+            self.one_srcs.reserve((limit - 1) // imgstep + 2)
+
+        # self.one_img_raw  = fitsdata.FITSData2D.initbyshape(shape_i)
+        # self.one_src_raw  = fitsdata.FITSData2D.initbyshape(shape_s)
+        # self.one_imgs_raw = fitsdata.FITSData3D.initbyshape((0, shape_i[0], shape_i[1]))
+        # self.one_srcs_raw = fitsdata.FITSData3D.initbyshape((0, shape_s[0], shape_s[1]))
+
+        try:
+            while True:
+                try:
+                    peaks = self.fitscls_p.findpeaks(self.maskcls, npeaks, separation, peak_frac, peak_index.findmax())
+                except fitsdata.FITSDataError as e:
+                    Glean.error(e.msg)
+                    Glean.success('Output current results.')
+                    break
+
+                # the noise of the residual changes slowly, so it is estimated
+                # every noise_step iterations
+                if nsigma_stop != 0 and (noise is None or i % noise_step == 0):
                     try:
-                        sb_max, pos = self.fitscls_p.findmax(self.maskcls)
+                        noise = self.fitscls_p.noise(self.maskcls)
                     except fitsdata.FITSDataError as e:
                         Glean.error(e.msg)
                         Glean.success('Output current results.')
                         break
+                level = threshold if nsigma_stop == 0 else max(threshold, nsigma_stop * noise)
 
-                    if sb_max == sb_max_prev and pos == pos_prev:
-                        Glean.error('Iteration error.')
-                        Glean.success('Output current results.')
-                        break
-                    if sb_max <= threshold:
-                        Glean.success('Residual max reaches the threshold.')
-                        break
-                    print '#{}_{}'.format(j + 1, i + 1)
+                sb_max, pos = peaks[0]
+                if sb_max == sb_max_prev and pos == pos_prev:
+                    Glean.error('Iteration error.')
+                    Glean.success('Output current results.')
+                    break
+                if sb_max <= threshold:
+                    Glean.success('Residual max reaches the threshold.')
+                    break
+                if sb_max <= level:
+                    Glean.success('Residual max reaches {} times the noise {}.'.format(nsigma_stop, noise))
+                    break
+                if flux_tol != 0 and len(fluxes) > noise_step and \
+                   abs(fluxes[-1] - fluxes[-1 - noise_step]) <= flux_tol * abs(fluxes[-1]):
+                    Glean.success('Model flux changed less than {} in {} iterations.'.format(flux_tol, noise_step))
+                    break
+                print '#{}_{}'.format(j + 1, i + 1)
+
+                # the lens is queried for all peaks at once; a peak is dropped if
+                # its source position is within a source pixel of a brighter one
+                srcinfos = lens.calcimage_batch(zsrc, [_pos[0] for _sb, _pos in peaks], [_pos[1] for _sb, _pos in peaks])
+                comps    = []
+                for (_sb, _pos), _srcinfo in zip(peaks, srcinfos):
+                    if all(np.hypot(_srcinfo['xsrc'] - c[2]['xsrc'], _srcinfo['ysrc'] - c[2]['ysrc']) >= pix_ext_s for c in comps):
+                        comps.append((_sb, _pos, _srcinfo))
+
+                self.one_src_patches = []
+                flux = fluxes[-1]
+                for n_comp, (sb_max, pos, srcinfo) in enumerate(comps):
                     print '{:<25} = {}'.format(Glean.YELLOW_COLOR + 'residual max' + Glean.CLEAR_COLOR, sb_max)
                     print '{:<25} = {}'.format(Glean.YELLOW_COLOR + 'image position' + Glean.CLEAR_COLOR, pos)
 
-                    srcinfo = self.glafic_i.calcimage(zsrc, *pos)
-                    xsrc    = srcinfo['xsrc']
-                    ysrc    = srcinfo['ysrc']
-                    kappa   = srcinfo['kappa']
-                    gamma   = srcinfo['gamma']
-                    phi     = srcinfo['phi']
-                    mag     = srcinfo['mag']
+                    # the loop gain grows with the height of the peak above the stopping level
+                    gain_c = max(gain, gain_max * (1 - level / sb_max))
+                    if gain_c != gain:
+                        print '{:<25} = {}'.format(Glean.YELLOW_COLOR + 'gain' + Glean.CLEAR_COLOR, gain_c)
+
+                    xsrc    = float(srcinfo['xsrc'])
+                    ysrc    = float(srcinfo['ysrc'])
+                    kappa   = float(srcinfo['kappa'])
+                    gamma   = float(srcinfo['gamma'])
+                    phi     = float(srcinfo['phi'])
+                    mag     = float(srcinfo['mag'])
                     sbsrc   = 1.
                     print '{:<25} = {}'.format(Glean.YELLOW_COLOR + 'phi' + Glean.CLEAR_COLOR, phi)
                     print '{:<25} = {}'.format(Glean.YELLOW_COLOR + 'kappa' + Glean.CLEAR_COLOR, kappa)
                     print '{:<25} = {}'.format(Glean.YELLOW_COLOR + 'gamma' + Glean.CLEAR_COLOR, gamma)
                     print '{:<25} = {}'.format(Glean.YELLOW_COLOR + 'magnification' + Glean.CLEAR_COLOR, mag)
+
+                    template = None
+                    if quantum > 0:
+                        key        = (int(round(xsrc / quantum)), int(round(ysrc / quantum)))
+                        xsrc, ysrc = key[0] * quantum, key[1] * quantum
+                        template   = self.templates.get(key)
                     print '{:<25} = ({}, {})'.format(Glean.YELLOW_COLOR + 'source position' + Glean.CLEAR_COLOR, xsrc, ysrc)
 
                     # newsigma = sigma / np.sqrt(mag)
@@ -267,39 +987,75 @@ class Glean(object):
 
                     gauss = extendmodel.Gauss(zsrc, sbsrc, xsrc, ysrc, 0, 0, sigma, 0)
                     point = pointmodel.Point(zsrc, xsrc, ysrc)
-                    self.glafic_i.models['extend'] = [gauss]
-                    self.glafic_i.models['point']  = [point]
-                    self.glafic_i.create_input()
 
-                    imginfo = self.glafic_i.findimg()
-                    n_img   = imginfo['n_img']
-                    x       = imginfo['x']
-                    y       = imginfo['y']
+                    if template is not None:
+                        print '===> reuse template'
+                        self.one_img, one_src, imginfo = template[0].copy(), template[1].copy(), template[2]
+                        if flag_render != 0:
+                            self.one_src_patch = one_src
+                        else:
+                            self.one_src = one_src
+                    else:
+                        self.glafic_i.models['extend'] = [gauss]
+                        self.glafic_i.models['point']  = [point]
+                        # the input file only changes when glafic still has work to do
+                        if flag_render == 0 or flag_finder == 0:
+                            self.glafic_i.create_input()
 
-                    print '===> output modeled image plane'
-                    self.glafic_i.writeimage([0, 0])
-                    for n in xrange(n_img):
-                        regfile.write('text({0},{1}) # text={{{2}}}\n'.format(x[n], y[n], i + 1))
+                        if flag_finder != 0:
+                            imginfo = finder.findimg(xsrc, ysrc)
+                        else:
+                            imginfo = self.glafic_i.findimg()
+
+                        print '===> output modeled image plane'
+                        if flag_bank != 0:
+                            self.one_img = fitsdata.FITSData2D.initbydata(self.bank.response(xsrc, ysrc), {})
+                        elif flag_render != 0:
+                            self.one_img = fitsdata.FITSData2D.initbydata(renderer_i.render(gauss), {})
+                        else:
+                            self.glafic_i.writeimage([0, 0])
 
-                    self.glafic_s.models['extend'] = [gauss]
-                    self.glafic_s.models['point']  = [point]
-                    self.glafic_s.create_input()
+                        self.glafic_s.models['extend'] = [gauss]
+                        self.glafic_s.models['point']  = [point]
 
-                    print '===> output modeled source plane'
-                    self.glafic_s.writeimage_ori([0, 0])
+                        print '===> output modeled source plane'
+                        if flag_render != 0:
+                            self.one_src_patch = renderer_s.render_patch(gauss)
+                        else:
+                            self.glafic_s.create_input()
+                            self.glafic_s.writeimage_ori([0, 0])
+
+                        # self.one_img_raw = fitsdata.FITSData2D.initbyname(one_img_name)
+                        if flag_render == 0:
+                            self.one_img = fitsdata.FITSData2D.initbyname(one_img_name)
+                        # dil_factor_img = self.one_img.data.max()
+                        # print 'image dilution factor = {}'.format(dil_factor_img)
+                        if flag_iconv != 0 and flag_bank == 0:
+                            print '===> convolve modeled image plane'
+                            self.beam.convolve(self.one_img, 'image')  # it may need to be revised
+
+                        # self.one_src_raw = fitsdata.FITSData2D.initbyname(one_src_name)
+                        if flag_render == 0:
+                            self.one_src = fitsdata.FITSData2D.initbyname(one_src_name)
+
+                        # components are scaled in place below, so templates are copies
+                        if quantum > 0:
+                            one_src = self.one_src_patch if flag_render != 0 else self.one_src
+                            self.templates.put(key, (self.one_img.copy(), one_src.copy(), imginfo))
+
+                    n_img = imginfo['n_img']
+                    x     = imginfo['x']
+                    y     = imginfo['y']
+                    for n in xrange(n_img):
+                        regfile.write('text({0},{1}) # text={{{2}}}\n'.format(x[n], y[n], i + 1))
 
-                    # self.one_img_raw = fitsdata.FITSData2D.initbyname(one_img_name)
-                    self.one_img     = fitsdata.FITSData2D.initbyname(one_img_name)
-                    # dil_factor_img = self.one_img.data.max()
-                    # print 'image dilution factor = {}'.format(dil_factor_img)
-                    if flag_iconv != 0:
-                        print '===> convolve modeled image plane'
-                        self.beam.convolve(self.one_img, 'image')  # it may need to be revised
                     self.conv_i   = sb_max / self.one_img.data.max()
-                    self.one_img *= self.conv_i * gain
+                    self.one_img *= self.conv_i * gain_c
+
+                    self.comps.append(iter=i + 1, comp=n_comp + 1, x=pos[0], y=pos[1], sb_max=sb_max, gain=gain_c,
+                                      conv_i=self.conv_i, xsrc=xsrc, ysrc=ysrc, kappa=kappa, gamma=gamma, phi=phi, mag=mag,
+                                      x_img=[float(_x) for _x in x[:n_img]], y_img=[float(_y) for _y in y[:n_img]])
 
-                    # self.one_src_raw = fitsdata.FITSData2D.initbyname(one_src_name)
-                    self.one_src     = fitsdata.FITSData2D.initbyname(one_src_name)
                     # dil_factor_src = self.one_src.data.max()
                     # print 'source dilution factor = {}'.format(dil_factor_src)
                     if phase == 1:
@@ -308,87 +1064,147 @@ class Glean(object):
                             print '===> convolve modeled source plane'
                             # self.beam.convolve(self.one_src, 'source')
                             self.conv_s   = self.conv_i # * (dil_factor_img / dil_factor_src)
-                            self.one_src *= self.conv_s * gain
-
-                    self.all_img_p = self.one_img + self.all_img_p	# it may need to be revised
-                    self.all_src_p = self.one_src + self.all_src_p	# it may need to be revised
-                    self.all_res_p = self.fitscls_p - self.one_img
-
-                    if i % resstep == 0:
-                        self.all_res.append_data(self.all_res_p)
-                    if i % imgstep == 0:
-                        # self.one_imgs_raw.append_data(self.one_img_raw)
-                        # self.one_srcs_raw.append_data(self.one_src_raw)
-                        self.one_imgs.append_data(self.one_img)
-                        self.one_srcs.append_data(self.one_src)
-
-                    self.fitscls_p = self.all_res_p
-                    sb_max_prev, pos_prev = sb_max, pos
-
-                    i += 1
-                    print ''
-                    if i == limit:
-                        Glean.success('The number of iteration reaches the limit.')
-                        break
+                            if flag_render != 0:
+                                self.one_src_patch.data *= self.conv_s * gain_c
+                            else:
+                                self.one_src *= self.conv_s * gain_c
 
-                regfile.close()
-                self.all_img.append_data(self.all_img_p)
-                self.all_src.append_data(self.all_src_p)
-                self.all_res.append_data(self.all_res_p)
-                self.all_res.set_header(self.all_img_p.header)
-                self.all_res.write_fits(self.all_res_name.format(j+1))
-                self.one_imgs.append_data(self.one_img)
-                self.one_imgs.set_header(self.all_img_p.header)
-                self.one_imgs.write_fits(self.one_imgs_name.format(j+1))
-                self.one_srcs.append_data(self.one_src)
-                self.one_srcs.set_header(self.all_src_p.header)
-                self.one_srcs.write_fits(self.one_srcs_name.format(j+1))
-
-                # self.one_imgs_raw.append_data(self.one_img_raw)
-                # self.one_imgs_raw.set_header(self.all_img_p.header)
-                # self.one_imgs_raw.write_fits(self.one_imgs_raw_name.format(j+1))
-                # self.one_srcs_raw.append_data(self.one_src_raw)
-                # self.one_srcs_raw.set_header(self.all_src_p.header)
-                # self.one_srcs_raw.write_fits(self.one_srcs_raw_name.format(j+1))
-                print ''
+                    # the model and the residual are only updated in place on the
+                    # footprint of the component, one patch per multiple image
+                    centres = [((_y - ymin_i) / pix_ext_i - 0.5, (_x - xmin_i) / pix_ext_i - 0.5) for _x, _y in zip(x, y)]
+                    if flag_render != 0:
+                        patches = [render.Patch(window, self.one_img.data[window])
+                                   for window in renderer_i.windows(xsrc, ysrc, radius_s, centres, pad_i)]
+                    else:
+                        patches = render.patches_of(self.one_img.data, footprint_tol, centres)
+                    for patch in patches:
+                        patch.add_to(self.all_img_p.data)
+                        patch.add_to(self.fitscls_p.data, -1.)
+                        flux += patch.data.sum()
+                    if flag_render != 0:
+                        self.one_src_patch.add_to(self.all_src_p.data)
+                        self.one_src_patches.append(self.one_src_patch)
+                    else:
+                        for patch in render.patches_of(self.one_src.data, footprint_tol):
+                            patch.add_to(self.all_src_p.data)
+                    self.all_res_p = self.fitscls_p
+                    peak_index.update(self.fitscls_p, peak_index.touched([patch.window for patch in patches]))
 
-            # This will not kill glafic, so it should be revised in future
-            except KeyboardInterrupt:
-                print '\n'
-                Glean.error('Keyboard Interrupted.')
-                Glean.success('Output current results.')
-
-                regfile.close()
-                self.all_img.append_data(self.all_img_p)
-                self.all_src.append_data(self.all_src_p)
-                self.all_res.append_data(self.all_res_p)
-                self.all_res.set_header(self.all_img_p.header)
-                self.all_res.write_fits(self.all_res_name.format(j+1))
-                self.one_imgs.append_data(self.one_img)
-                self.one_imgs.set_header(self.all_img_p.header)
-                self.one_imgs.write_fits(self.one_imgs_name.format(j+1))
-                self.one_srcs.append_data(self.one_src)
-                self.one_srcs.set_header(self.all_src_p.header)
-                self.one_srcs.write_fits(self.one_srcs_name.format(j+1))
-
-                # self.one_imgs_raw.append_data(self.one_img_raw)
-                # self.one_imgs_raw.set_header(self.all_img_p.header)
-                # self.one_imgs_raw.write_fits(self.one_imgs_raw_name.format(j+1))
-                # self.one_srcs_raw.append_data(self.one_src_raw)
-                # self.one_srcs_raw.set_header(self.all_src_p.header)
-                # self.one_srcs_raw.write_fits(self.one_srcs_raw_name.format(j+1))
+                    # snapshots hold the sum of the components of the iteration
+                    if n_comp == 0:
+                        one_img_iter, one_src_iter = self.one_img, self.one_src
+                    else:
+                        one_img_iter += self.one_img
+                        if flag_render == 0:
+                            one_src_iter += self.one_src
+
+                self.one_img, self.one_src = one_img_iter, one_src_iter
+                fluxes = (fluxes + [flux])[-1 - noise_step:]
+
+                # with flag_snapshot 0 only the final frames are written
+                if flag_snapshot != 0 and i % resstep == 0:
+                    self.all_res.append_data(self.all_res_p)
+                if flag_snapshot != 0 and i % imgstep == 0:
+                    if flag_render != 0:
+                        self.one_src = fitsdata.FITSData2D.initbydata(render.frame_of(self.one_src_patches, shape_s), {})
+                    # self.one_imgs_raw.append_data(self.one_img_raw)
+                    # self.one_srcs_raw.append_data(self.one_src_raw)
+                    self.one_imgs.append_data(self.one_img)
+                    self.one_srcs.append_data(self.one_src)
+
+                sb_max_prev, pos_prev = peaks[0]
+
+                i += 1
                 print ''
+                if i == limit:
+                    Glean.success('The number of iteration reaches the limit.')
+                    break
+                if checkpoint_step != 0 and i % checkpoint_step == 0:
+                    self._save_checkpoint(j, i, regfile, sb_max_prev, pos_prev, noise, fluxes, flag_render, flag_stream)
 
-                break
+            self._write_channel(j, regfile, img_plane, src_plane, flag_render)
 
-        self.all_img.set_header(self.all_img_p.header)
-        self.all_img.write_fits(self.all_img_name)
-        self.all_src.set_header(self.all_src_p.header)
-        self.all_src.write_fits(self.all_src_name)
+            if checkpoint_step != 0:
+                self._write_checkpoint(j, 'done', img=img_plane, src=src_plane)
+                if os.path.exists(self._checkpoint_name(j)):
+                    os.remove(self._checkpoint_name(j))
+
+        # glafic sessions kill their children on KeyboardInterrupt
+        except KeyboardInterrupt:
+            print '\n'
+            Glean.error('Keyboard Interrupted.')
+            Glean.success('Output current results.')
+
+            self._write_channel(j, regfile, img_plane, src_plane, flag_render)
+
+            return True
+
+        # the channel stays unfinished, and a resumed run starts it again from its last checkpoint
+        except (gf.GlaficTimeoutError, gf.GlaficCrashError) as e:
+            Glean.error('Channel {} failed: {}'.format(j + 1, e.message))
+            Glean.success('Output current results.')
+
+            self._write_channel(j, regfile, img_plane, src_plane, flag_render)
+            self.failed = True
+
+        return False
+
+    def _write_channel(self, j, regfile, img_plane, src_plane, flag_render):
+        """ write the current state of channel j and copy its planes into img_plane and src_plane """
+        regfile.close()
+        self.comps.write_fits(self.comps_name.format(j + 1))
+        img_plane[...] = self.all_img_p.data
+        src_plane[...] = self.all_src_p.data
+        self.all_res.append_data(self.all_res_p)
+        self.all_res.set_header(self.all_img_p.header)
+        self.all_res.write_fits(self.all_res_name.format(j+1))
+        self.one_imgs.append_data(self.one_img)
+        self.one_imgs.set_header(self.all_img_p.header)
+        self.one_imgs.write_fits(self.one_imgs_name.format(j+1))
+        if flag_render != 0:
+            self.one_src = fitsdata.FITSData2D.initbydata(render.frame_of(self.one_src_patches, self.shape_s), {})
+        self.one_srcs.append_data(self.one_src)
+        self.one_srcs.set_header(self.all_src_p.header)
+        self.one_srcs.write_fits(self.one_srcs_name.format(j+1))
+
+        # self.one_imgs_raw.append_data(self.one_img_raw)
+        # self.one_imgs_raw.set_header(self.all_img_p.header)
+        # self.one_imgs_raw.write_fits(self.one_imgs_raw_name.format(j+1))
+        # self.one_srcs_raw.append_data(self.one_src_raw)
+        # self.one_srcs_raw.set_header(self.all_src_p.header)
+        # self.one_srcs_raw.write_fits(self.one_srcs_raw_name.format(j+1))
+        print ''
+
+
+_pool_glean = None
+
+
+def _pool_init():
+    """ give a forked worker its own scratch directory and glafic children """
+    glean, phase = _pool_glean
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, _pool_exit)
+
+    glean.workspace = workspace.Workspace(root=glean.workspace.path)
+    glean.glafic_i.set_workspace(glean.workspace)
+    glean.glafic_s.set_workspace(glean.workspace)
+    glean.glafic_i.create_input()
+
+
+def _pool_exit(signum, frame):
+    gf.GlaficSession.close_all()
+    os._exit(0)
+
+
+def _pool_clean(job):
+    k, j         = job
+    glean, phase = _pool_glean
+
+    stdout, sys.stdout = sys.stdout, StringIO()
+    try:
+        interrupted = glean._clean_channel(j, phase, glean.all_img.data[k], glean.all_src.data[k])
+        log         = sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
 
-        # delete all intermediate files
-        os.system('rm -f {}'.format(one_img_name))
-        os.system('rm -f {}'.format(one_src_name))
-        os.system('rm -f {}'.format(one_img_inp_name))
-        os.system('rm -f {}'.format(one_src_inp_name))
-        os.system('rm -f {}'.format(one_point_name))
+    return log, interrupted, glean.failed
@@ -51,7 +51,9 @@ class Interpreter(object):
                           'get'     : self.get,      'set'     : self.set,      'reset' : self.reset,  'append': self.append,
                           'clear'   : self.clear,    'pwd'     : self.pwd,      'cd'    : self.cd,     'ls'    : self.ls,
                           'open'    : self.open,     'less'    : self.less,     'more'  : self.more,   'rm'    : self.rm,
-                          'read'    : self.read,     'allreset': self.allreset, 'makemask': self.makemask}
+                          'read'    : self.read,     'allreset': self.allreset, 'makemask': self.makemask,
+                          'cache'   : self.cache,    'stats'   : self.stats,    'bank'  : self.bank,
+                          'restore' : self.restore}
 
         print Interpreter.GREEN_COLOR + '''
         =========  ==         =========  ==         ==     ==
@@ -129,11 +131,67 @@ class Interpreter(object):
         else:
             return None
 
+    def extract_njobs(self, params):
+        """ the N of params [-j N] (1 if params are empty), or ERROR_CODE """
+        if len(params) == 2 and params[0] == '-j':
+            try:
+                njobs = int(params[1])
+            except ValueError:
+                njobs = 0
+            if njobs < 1:
+                Interpreter.error('{} is not a suitable number of jobs.'.format(params[1]))
+                return Interpreter.ERROR_CODE
+        elif len(params) != 0:
+            Interpreter.error('The number of arguments is bad.')
+            return Interpreter.ERROR_CODE
+        else:
+            njobs = 1
+
+        return njobs
+
     def quit(self, params):
         raise End()
 
     def go(self, params):
-        self.glean.execute(phase=1)
+        """
+        go [-j N] [--resume]: CLEAN the channels, with N worker processes if
+        given; --resume continues from the checkpoints of the last run
+        """
+        resume = '--resume' in params
+        params = [param for param in params if param != '--resume']
+        njobs  = self.extract_njobs(params)
+        if njobs == Interpreter.ERROR_CODE:
+            return Interpreter.ERROR_CODE
+
+        self.glean.execute(phase=1, njobs=njobs, resume=resume)
+
+    def bank(self, params):
+        """ bank [-j N]: render the response bank for the current model, with N worker processes if given """
+        njobs = self.extract_njobs(params)
+        if njobs == Interpreter.ERROR_CODE:
+            return Interpreter.ERROR_CODE
+
+        self.glean.build_bank(njobs=njobs)
+
+    def restore(self, params):
+        """
+        restore [iteration]: rebuild the models and the residuals after iteration
+        (the last one if not given) from the component tables of the last run
+        """
+        iteration = -1
+        if len(params) == 1:
+            try:
+                iteration = int(params[0])
+            except ValueError:
+                iteration = 0
+            if iteration < 1:
+                Interpreter.error('{} is not a suitable iteration.'.format(params[0]))
+                return Interpreter.ERROR_CODE
+        elif len(params) != 0:
+            Interpreter.error('The number of arguments is bad.')
+            return Interpreter.ERROR_CODE
+
+        self.glean.restore(iteration)
 
     def gogo(self, params):
         Interpreter.warning('Current ver. does not support this function.')
@@ -228,6 +286,37 @@ class Interpreter(object):
         else:
             Interpreter.error('The number of arguments is bad.')
 
+    def cache(self, params):
+        """ show hits and misses of the glafic and template caches; 'cache clear' empties them """
+        caches = [('image', self.glafic_i.cache), ('source', self.glafic_s.cache), ('template', self.glean.templates)]
+        if params == ['clear']:
+            for name, cache in caches:
+                cache.clear()
+        elif len(params) != 0:
+            Interpreter.error('The number of arguments is bad.')
+            return Interpreter.ERROR_CODE
+
+        for name, cache in caches:
+            stats = cache.stats()
+            print '{:<25} = {} hits, {} misses, {} entries, {} bytes'.format(Interpreter.YELLOW_COLOR + name + Interpreter.CLEAR_COLOR,
+                                                                             *stats.values())
+
+    def stats(self, params):
+        """ show the wall time of glafic commands by type; 'stats reset' clears it """
+        if params == ['reset']:
+            self.glafic_i.stats.reset()
+            self.glafic_s.stats.reset()
+        elif len(params) != 0:
+            Interpreter.error('The number of arguments is bad.')
+            return Interpreter.ERROR_CODE
+
+        print '{:<8} {:<16} {:>8} {:>10} {:>12} {:>14} {:>12}'.format('glafic', 'command', 'calls', 'commands',
+                                                                    'total [s]', 'per cmd [ms]', 'max [s]')
+        for name, glafic in [('image', self.glafic_i), ('source', self.glafic_s)]:
+            for kind, calls, commands, total, mean, longest in glafic.stats.rows():
+                print '{:<8} {:<16} {:>8} {:>10} {:>12.3f} {:>14.3f} {:>12.3f}'.format(name, kind, calls, commands,
+                                                                                    total, mean * 1e3, longest)
+
     def makemask(self, params):
         Interpreter.warning('Current ver. does not support this function.')
         if len(params) >= 2:
@@ -22,6 +22,8 @@ from lib.glafic import glafic as gf
 reload(gf)
 from lib import fitsdata
 reload(fitsdata)
+from lib import batch
+reload(batch)
 
 
 ##### define classes #####
@@ -36,7 +38,10 @@ class MainError(Exception):
 def main():
     argv = sys.argv
     argc = len(argv)
-    if argc >= 3:
+    # glean run (config) runs without the interpreter
+    if argc >= 2 and argv[1] == 'run':
+        sys.exit(batch.main(argv[2:]))
+    elif argc >= 3:
         glafic_path = argv[1]
         fitsname    = argv[2]
         maskname    = argv[3:]
@@ -73,10 +78,9 @@ def main():
         if fitscls.data[0].shape != maskcls.data.shape:
             raise MainError('Image sizes of data and mask should be the same.')
 
-    gf.Glafic.path = glafic_path
-    glafic_i       = gf.Glafic('one_image.input')
-    glafic_s       = gf.Glafic('one_source.input')
-    glean          = gl.Glean(glafic_i, glafic_s, fitscls, maskcls)
+    glafic_i = gf.Glafic('one_image.input', glafic_path)
+    glafic_s = gf.Glafic('one_source.input', glafic_path)
+    glean    = gl.Glean(glafic_i, glafic_s, fitscls, maskcls)
 
     Interpreter = interpreter.Interpreter(glafic_i, glafic_s, glean)
     Interpreter.start()
@@ -84,4 +88,5 @@ def main():
 ##### main #####
 if __name__ == '__main__':
     # run main.py (glafic path) (fitsname [2D/3D]) (maskname [optional])
+    # or main.py run (config)
     main()
@@ -0,0 +1,90 @@
+# coding:UTF-8
+import os
+import sys
+import stat
+import pytest
+
+FAKE_GLAFIC = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_glafic.py')
+
+
+@pytest.fixture
+def workdir(tmpdir, monkeypatch):
+    """ run in a fresh directory with its own glean_out/ """
+    monkeypatch.chdir(tmpdir)
+    tmpdir.mkdir('glean_out')
+
+    return tmpdir
+
+
+@pytest.fixture
+def glafic_path(tmpdir):
+    """ an executable that runs the stand-in for glafic """
+    path = tmpdir.join('glafic')
+    path.write('#!/bin/sh\nexec {} {} "$@"\n'.format(sys.executable, FAKE_GLAFIC))
+    path.chmod(path.stat().mode | stat.S_IXUSR)
+
+    return str(path)
+
+
+def make_cube(path, n=32, pix=0.1, nchan=2, noise=0.002, seed=0):
+    """ lensed Gaussian sources behind the stand-in lens, convolved with a 0.3 arcsec beam """
+    import numpy as np
+    from astropy.io import fits
+    from astropy.convolution import convolve, Gaussian2DKernel
+
+    x      = (np.arange(n) + 0.5 - n / 2.) * pix
+    X, Y   = np.meshgrid(x, x)
+    r      = np.hypot(X, Y)
+    bx, by = X - X / r, Y - Y / r
+    rng    = np.random.RandomState(seed)
+    cube   = []
+    for k in xrange(nchan):
+        img = np.exp(-((bx - 0.1 - 0.05 * k)**2 + (by - 0.05)**2) / (2 * 0.08**2))
+        img = convolve(img, Gaussian2DKernel(0.3 / 2.3548 / pix)) + rng.normal(0, noise, img.shape)
+        cube.append(img)
+
+    header = fits.Header()
+    for axis in (1, 2):
+        header['CRPIX{}'.format(axis)] = n / 2. + 0.5
+        header['CDELT{}'.format(axis)] = pix
+        header['CRVAL{}'.format(axis)] = 0.
+    header['BMAJ']     = 0.3 / 3600
+    header['BMIN']     = 0.3 / 3600
+    header['BPA']      = 0.
+    header['REDSHIFT'] = 2.
+    fits.writeto(path, np.array(cube), header)
+
+    return path
+
+
+@pytest.fixture
+def cube(tmpdir):
+    return make_cube(str(tmpdir.join('cube.fits')))
+
+
+@pytest.fixture
+def make_glean(workdir, glafic_path, cube, monkeypatch):
+    """ return a factory of Glean instances on the test cube with the stand-in lens """
+    from glean.lib import glean as gl
+    from glean.lib import fitsdata
+    from glean.lib.glafic import glafic as gf
+    monkeypatch.setattr(gf.Glafic, 'path', glafic_path)
+    # replies are pipelined when errors go to stdout
+    monkeypatch.setenv('GLAFIC_STDOUT', '1')
+
+    def make(**params):
+        fitscls = fitsdata.FITSData3D.initbyname(cube, check=True)
+        glafic_i, glafic_s = gf.Glafic('one_image.input'), gf.Glafic('one_source.input')
+        glean = gl.Glean(glafic_i, glafic_s, fitscls, None)
+        for key, value in [('xmin', -1.2), ('xmax', 1.2), ('ymin', -1.2), ('ymax', 1.2), ('pix_ext', 0.04)]:
+            glafic_s.params[key] = value
+        for glafic in [glafic_i, glafic_s]:
+            glafic.models.append('lens', ['pow', '2.0', '0', '0', '0', '0', '1.0', '2.0'])
+        glean.params['sigma'] = 0.05
+        glean.params['limit'] = 8
+        for key, value in params.iteritems():
+            glean.params[key] = value
+
+        return glean
+
+    return make
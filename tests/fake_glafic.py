@@ -0,0 +1,132 @@
+# coding:UTF-8
+"""
+A stand-in for glafic used by the tests: an SIS lens with Einstein radius B at
+the origin, Gaussian extended sources and a few test commands.
+
+    sleep (seconds)  hang before the next reply
+    crash            exit without a reply
+    quit             exit
+
+Unknown commands are reported on stderr, or on stdout when GLAFIC_STDOUT is set.
+With GLAFIC_FAIL set to crash or hang, the GLAFIC_FAIL_AT-th findimg sent to any
+of the stand-ins run in the current directory crashes or hangs; with
+GLAFIC_FAIL_PREFIX set, only those whose prefix has that basename count.
+With GLAFIC_NIMG set to 1, findimg reports only the first image.
+"""
+import os
+import sys
+import time
+import numpy as np
+
+B      = 1.
+KEYS   = ['prefix', 'xmin', 'xmax', 'ymin', 'ymax', 'pix_ext']
+STDOUT = bool(os.environ.get('GLAFIC_STDOUT'))
+FAIL   = os.environ.get('GLAFIC_FAIL')
+COUNT  = 'findimg.count'
+
+
+def read_input(inputname):
+    params, extend = {}, []
+    with open(inputname, 'r') as f:
+        for line in f:
+            words = line.split()
+            if len(words) == 2 and words[0] in KEYS:
+                params[words[0]] = words[1]
+            elif words and words[0] == 'extend':
+                extend.append([float(v) for v in words[2:]])
+
+    return params, extend
+
+
+def lens(x, y):
+    r      = np.hypot(x, y)
+    kappa  = B / (2 * r)
+    phi    = np.arctan2(y, x)
+    gamma1 = -kappa * np.cos(2 * phi)
+    gamma2 = -kappa * np.sin(2 * phi)
+
+    return B * x / r, B * y / r, kappa, gamma1, gamma2
+
+
+def calcimage(z, x, y):
+    ax, ay, kappa, gamma1, gamma2 = lens(x, y)
+    gamma = np.hypot(gamma1, gamma2)
+    mag   = 1. / ((1 - kappa)**2 - gamma**2)
+    lines = ['#', 'calcimage', 'z = {:g}'.format(z), 'x = {!r}'.format(x), 'y = {!r}'.format(y),
+             'kappa = {:.10e}'.format(kappa), 'gamma1 = {:.10e}'.format(gamma1),
+             'gamma2 = {:.10e}'.format(gamma2), 'gamma = {:.10e}'.format(gamma),
+             'mu = {:.10e}'.format(mag), 'td = 0', 'xs = {:.10e}'.format(x - ax),
+             'ys = {:.10e}'.format(y - ay), '']
+
+    return '\n'.join(lines)
+
+
+def writeimage(params, extend, suffix):
+    from astropy.io import fits
+    x0, x1, y0, y1, pix = [float(params[key]) for key in KEYS[1:]]
+    nx, ny = int(round((x1 - x0) / pix)), int(round((y1 - y0) / pix))
+    x, y   = np.meshgrid(x0 + (np.arange(nx) + 0.5) * pix, y0 + (np.arange(ny) + 0.5) * pix)
+    if suffix == '_image.fits':
+        ax, ay = lens(x, y)[:2]
+        x, y   = x - ax, y - ay
+
+    data = np.zeros_like(x)
+    for e in extend:
+        data += e[1] * np.exp(-((x - e[2])**2 + (y - e[3])**2) / (2 * e[6]**2))
+    fits.writeto(params['prefix'] + suffix, data, clobber=True)
+
+
+def fails(params):
+    """ count findimg in the current directory; True for the GLAFIC_FAIL_AT-th """
+    if FAIL is None:
+        return False
+    if os.environ.get('GLAFIC_FAIL_PREFIX', os.path.basename(params['prefix'])) != os.path.basename(params['prefix']):
+        return False
+    n = int(open(COUNT).read()) + 1 if os.path.exists(COUNT) else 1
+    with open(COUNT, 'w') as f:
+        f.write(str(n))
+
+    return n == int(os.environ.get('GLAFIC_FAIL_AT', 1))
+
+
+def main(inputname):
+    params, extend = read_input(inputname)
+    sys.stderr.write('reading {}\n'.format(inputname))
+    sys.stderr.flush()
+
+    while True:
+        line = sys.stdin.readline()
+        if not line:
+            break
+        words = line.split()
+        if not words:
+            continue
+
+        if words[0] == 'quit':
+            break
+        elif words[0] == 'calcimage':
+            sys.stdout.write(calcimage(*map(float, words[1:4])))
+        elif words[0] == 'findimg':
+            if fails(params):
+                if FAIL == 'crash':
+                    os._exit(3)
+                time.sleep(60)
+            images = [' 1 1 0.5 0 0 0.0\n', ' 2 2 -1.5 0 0 0.0\n'][:int(os.environ.get('GLAFIC_NIMG', 2))]
+            sys.stdout.write('n_img = {}\n'.format(len(images)) + ''.join(images))
+        elif words[0] == 'writeimage':
+            writeimage(params, extend, '_image.fits')
+        elif words[0] == 'writeimage_ori':
+            writeimage(params, extend, '_source.fits')
+        elif words[0] == 'sleep':
+            time.sleep(float(words[1]))
+        elif words[0] == 'crash':
+            os._exit(3)
+        else:
+            f = sys.stdout if STDOUT else sys.stderr
+            f.write('Error: command {} not supported\n'.format(words[0]))
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1])
@@ -0,0 +1,106 @@
+# coding:UTF-8
+import os
+import json
+import pytest
+
+from glean.lib import batch
+
+SOURCE = {'xmin': -1.2, 'xmax': 1.2, 'ymin': -1.2, 'ymax': 1.2, 'pix_ext': 0.04}
+MODELS = [['lens', 'pow', '2.0', '0', '0', '0', '0', '1.0', '2.0']]
+
+
+@pytest.fixture
+def make_config(workdir, glafic_path, cube, monkeypatch):
+    """ return a factory of JSON configs on the test cube with the stand-in lens """
+    monkeypatch.setenv('GLAFIC_STDOUT', '1')
+
+    def make(**config):
+        params = {'sigma': 0.05, 'limit': 4, 'flag_render': 1}
+        params.update(config.pop('params', {}))
+        base = {'glafic': glafic_path, 'data': cube, 'params': params, 'source': SOURCE, 'models': MODELS}
+        base.update(config)
+        with open('config.json', 'w') as f:
+            json.dump(base, f)
+
+        return 'config.json'
+
+    return make
+
+
+def summary():
+    with open(batch.Batch.DEFAULT_SUMMARY) as f:
+        return json.load(f)
+
+
+@pytest.mark.parametrize('njobs', [0, -1, 'two', 1.5, True])
+def test_njobs(make_config, njobs):
+    with pytest.raises(batch.BatchError):
+        batch.Batch.load_config(make_config(njobs=njobs))
+
+
+@pytest.mark.parametrize('config', [{'header': ['BMAJ']}, {'image': 3}, {'masks': 'mask.fits'},
+                                    {'jobs': [{'data': 'cube.fits', 'header': 1.}]}])
+def test_types(make_config, config):
+    with pytest.raises(batch.BatchError):
+        batch.Batch.load_config(make_config(**config))
+
+
+def test_bad_header(make_config):
+    """ an error outside GLEAN is reported in the summary instead of a traceback """
+    assert batch.Batch(make_config(header={'BMAJ': 'wide'})).run() == batch.Batch.EXIT_FAILED
+    assert summary()['message'].startswith('TypeError')
+
+
+def test_batch(make_config):
+    assert batch.Batch(make_config()).run() == batch.Batch.EXIT_OK
+    assert summary()['status'] == 'finished'
+    assert [channel['iterations'] for channel in summary()['channels']] == [4, 4]
+
+    assert batch.Batch(make_config()).run() == batch.Batch.EXIT_EXISTS
+
+
+def test_queue(make_config, cube, monkeypatch):
+    """ two jobs on two workers: b loses glafic and keeps its own checkpoints """
+    monkeypatch.setenv('GLAFIC_FAIL', 'crash')
+    monkeypatch.setenv('GLAFIC_FAIL_AT', '3')
+    monkeypatch.setenv('GLAFIC_FAIL_PREFIX', 'b')
+    config = make_config(njobs=2, params={'glafic_retries': 0, 'checkpoint_step': 1},
+                         jobs=[{'name': 'a', 'data': cube}, {'name': 'b', 'data': cube}])
+
+    assert batch.Queue(config).run() == batch.Batch.EXIT_FAILED
+    jobs = dict((job['name'], job) for job in summary()['jobs'])
+    assert jobs['a']['exit_code'] == batch.Batch.EXIT_OK
+    assert jobs['b']['exit_code'] == batch.Batch.EXIT_FAILED
+    for name in ['a', 'b']:
+        assert os.path.exists('glean_out/{}_image_all.fits'.format(name))
+    assert not os.path.exists(batch.gl.Glean.CHECKPOINT_DIR + 'a')
+    assert os.path.exists(batch.gl.Glean.CHECKPOINT_DIR + 'b/channel_1.npz')
+
+
+def test_queue_job_error(make_config, cube, monkeypatch):
+    """ a job that raises fails alone """
+    execute = batch.gl.Glean.execute
+
+    def fail(glean, *args, **kwargs):
+        if glean.glafic_i.params['prefix'].endswith('a'):
+            raise ValueError('bad job')
+        return execute(glean, *args, **kwargs)
+    monkeypatch.setattr(batch.gl.Glean, 'execute', fail)
+
+    config = make_config(jobs=[{'name': 'a', 'data': cube}, {'name': 'b', 'data': cube}])
+    assert batch.Queue(config).run() == batch.Batch.EXIT_FAILED
+    jobs = dict((job['name'], job) for job in summary()['jobs'])
+    assert jobs['a']['exit_code'] == batch.Batch.EXIT_FAILED
+    assert jobs['a']['message'] == 'ValueError: bad job'
+    assert jobs['b']['exit_code'] == batch.Batch.EXIT_OK
+
+
+def test_interrupted(make_config, monkeypatch):
+    """ a keyboard interrupt still leaves the summary """
+    def interrupt(glean, *args, **kwargs):
+        raise KeyboardInterrupt
+    monkeypatch.setattr(batch.gl.Glean, 'execute', interrupt)
+
+    assert batch.Batch(make_config()).run() == batch.Batch.EXIT_FAILED
+    assert summary()['status'] == 'unfinished'
+    assert summary()['message'] == 'Keyboard Interrupted.'
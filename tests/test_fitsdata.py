@@ -0,0 +1,204 @@
+# coding:UTF-8
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from glean.lib import fitsdata
+
+HEADER = {'CRPIX1': 35.5, 'CDELT1': 0.1, 'CRVAL1': 0., 'CRPIX2': 25.5, 'CDELT2': 0.1, 'CRVAL2': 0.}
+
+
+def test_peak_index_order():
+    """ peaks of a residual cleaned window by window come out as from findmax """
+    rng    = np.random.RandomState(3)
+    shape  = (50, 70)
+    y, x   = np.mgrid[:shape[0], :shape[1]]
+    data   = rng.normal(0., 0.01, shape)
+    for _y, _x, _a in zip(rng.uniform(5, 45, 6), rng.uniform(5, 65, 6), rng.uniform(0.5, 1., 6)):
+        data += _a * np.exp(-((x - _x)**2 + (y - _y)**2) / (2 * 2.**2))
+    mask = np.zeros(shape)
+    mask[3:-3, 3:-3] = 1.
+
+    fitscls = fitsdata.FITSData2D.initbydata(data, HEADER)
+    maskcls = fitsdata.FITSData2D.initbydata(mask, HEADER)
+    index   = fitsdata.PeakIndex(fitscls, maskcls)
+
+    for _ in xrange(60):
+        sb_max, pos = index.findmax()
+        assert (sb_max, pos) == fitscls.findmax(maskcls)
+
+        # a component of gain 0.3 is taken off within 6 pixels of the peak
+        iy, ix = int(round((pos[1] - HEADER['CRVAL2']) / HEADER['CDELT2'] + HEADER['CRPIX2'] - 1)), \
+                 int(round((pos[0] - HEADER['CRVAL1']) / HEADER['CDELT1'] + HEADER['CRPIX1'] - 1))
+        window = (slice(max(iy - 6, 0), iy + 7), slice(max(ix - 6, 0), ix + 7))
+        fitscls.data[window] -= 0.3 * sb_max * np.exp(-((x[window] - ix)**2 + (y[window] - iy)**2) / (2 * 2.**2))
+        index.update(fitscls, index.touched([window]))
+
+    # only the tiles under the windows are searched again
+    assert index.touched([(slice(10, 20), slice(40, 50))]).sum() == 4
+
+
+@pytest.mark.parametrize('images', [[[], []], [[0.5], [-1.5]], [[], [0.5, -1.5]]], ids=['none', 'one', 'mixed'])
+def test_table_lists(tmpdir, images):
+    """ list columns come back as lists, and rows can be appended to a table read back """
+    name  = str(tmpdir.join('table.fits'))
+    table = fitsdata.FITSTable(['iter', 'x_img'])
+    for k, x_img in enumerate(images):
+        table.append(iter=k + 1, x_img=x_img)
+    table.write_fits(name)
+
+    table = fitsdata.FITSTable.initbyname(name, ['iter', 'x_img'])
+    assert table.rows == [(float(k + 1), x_img) for k, x_img in enumerate(images)]
+
+    table.append(iter=3, x_img=[1., 2., 3.])
+    table.write_fits(name)
+    assert fitsdata.FITSTable.initbyname(name, ['iter', 'x_img']).rows[-1] == (3., [1., 2., 3.])
+
+
+def blobs():
+    """ narrow peaks of 1, 0.5 (4 pixels from the first), 0.6 and 0.3 """
+    y, x = np.mgrid[:50, :70]
+    data = np.zeros((50, 70))
+    for _y, _x, _a in [(20, 20, 1.), (20, 24, 0.5), (40, 10, 0.6), (10, 45, 0.3)]:
+        data += _a * np.exp(-((x - _x)**2 + (y - _y)**2) / 2.)
+    # the far tails would be flat, and be local maxima
+    data[data < 1e-6] = 0.
+
+    return fitsdata.FITSData2D.initbydata(data, HEADER)
+
+
+@pytest.mark.parametrize('params, sbs', [({'npeaks': 1}, [1.]),
+                                         ({'npeaks': 6}, [1., 0.6, 0.5, 0.3]),
+                                         ({'npeaks': 3}, [1., 0.6, 0.5]),
+                                         ({'npeaks': 4, 'separation': 6.}, [1., 0.6, 0.3]),
+                                         ({'npeaks': 4, 'frac': 0.4}, [1., 0.6, 0.5]),
+                                         ({'npeaks': 4, 'frac': 0.4, 'separation': 6.}, [1., 0.6])])
+def test_findpeaks(params, sbs):
+    """ every peak once, brightest first, with separation and frac applied """
+    fitscls = blobs()
+    peaks   = fitscls.findpeaks(**params)
+
+    assert [sb for sb, pos in peaks] == pytest.approx(sbs, abs=2e-3)
+    assert peaks[0] == fitscls.findmax()
+    assert len(set(pos for sb, pos in peaks)) == len(peaks)
+
+
+def frames(n, shape=(6, 5), seed=4):
+    return list(np.random.RandomState(seed).normal(size=(n, ) + shape))
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+def test_cube_writer(tmpdir, dtype):
+    """ a streamed cube is the file of the same cube kept in memory """
+    header = {'BUNIT': 'JY/BEAM', 'CDELT1': 0.1}
+    cube   = fitsdata.FITSData3D.initbyshape((0, 6, 5), dtype=dtype)
+    writer = fitsdata.FITSCubeWriter(str(tmpdir.join('stream.tmp')), (6, 5), dtype=dtype)
+    cube.reserve(2)
+    for frame in frames(5):
+        cube.append_data(frame)
+        writer.append_data(frame)
+    cube.set_header(header)
+    writer.set_header(header)
+    cube.write_fits(str(tmpdir.join('memory.fits')))
+    writer.write_fits(str(tmpdir.join('stream.fits')))
+
+    memory, h_memory = fits.getdata(str(tmpdir.join('memory.fits')), header=True)
+    stream, h_stream = fits.getdata(str(tmpdir.join('stream.fits')), header=True)
+    assert stream.dtype == memory.dtype
+    assert stream.dtype.itemsize == np.dtype(dtype).itemsize
+    assert np.array_equal(stream, memory)
+    assert np.array_equal(stream, np.array(frames(5), dtype=dtype))
+    for key in ['NAXIS3', 'BUNIT', 'CDELT1']:
+        assert h_stream[key] == h_memory[key]
+
+
+@pytest.mark.parametrize('finished', [False, True], ids=['unfinished', 'finished'])
+def test_cube_writer_reopen(tmpdir, finished):
+    """ a reopened cube keeps its first frames and drops the later ones """
+    name   = str(tmpdir.join('cube.fits'))
+    writer = fitsdata.FITSCubeWriter(name, (6, 5))
+    for frame in frames(5):
+        writer.append_data(frame)
+    if finished:
+        writer.write_fits()
+    else:
+        writer.flush()
+
+    writer = fitsdata.FITSCubeWriter.reopen(name, (6, 5), 3)
+    for frame in frames(2, seed=5):
+        writer.append_data(frame)
+    writer.write_fits()
+
+    assert np.array_equal(fits.getdata(name), np.array(frames(5)[:3] + frames(2, seed=5)))
+    with pytest.raises(fitsdata.FITSDataError):
+        fitsdata.FITSCubeWriter.reopen(name, (6, 5), 20)
+
+
+def test_cube_writer_long_header(tmpdir):
+    """ a header longer than the reserved block makes write_fits rewrite the file """
+    name   = str(tmpdir.join('cube.fits'))
+    writer = fitsdata.FITSCubeWriter(name, (6, 5), reserve=1)
+    for frame in frames(3):
+        writer.append_data(frame)
+    writer.set_header(dict(('KEY{}'.format(k), k) for k in xrange(60)))
+    writer.write_fits()
+
+    data, header = fits.getdata(name, header=True)
+    assert np.array_equal(data, np.array(frames(3)))
+    assert [header['KEY{}'.format(k)] for k in xrange(60)] == range(60)
+
+
+@pytest.mark.parametrize('op', ['add', 'sub', 'mul'])
+@pytest.mark.parametrize('other', [2.5, 'map'])
+def test_inplace(op, other):
+    """ in-place and out= results are those of the copying operators """
+    rng  = np.random.RandomState(6)
+    a    = fitsdata.FITSData2D.initbydata(rng.normal(size=(50, 70)), HEADER)
+    if other == 'map':
+        other = fitsdata.FITSData2D.initbydata(rng.normal(size=(50, 70)), {})
+    want = {'add': a + other, 'sub': a - other, 'mul': a * other}[op]
+
+    out = fitsdata.FITSData2D.initbyshape((50, 70))
+    assert getattr(a, op)(other, out=out) is out
+    assert np.array_equal(out.data, want.data)
+    assert out.header == a.header
+
+    data = a.data.copy()
+    b    = a.copy()
+    if op == 'add':
+        b += other
+    elif op == 'sub':
+        b -= other
+    else:
+        b *= other
+    assert np.array_equal(b.data, want.data)
+    assert np.array_equal(a.data, data)
+
+
+def test_inplace_dtype():
+    """ an out that cannot hold the result is given a new array """
+    a   = fitsdata.FITSData2D.initbydata(np.ones((4, 4)), HEADER)
+    out = fitsdata.FITSData2D.initbyshape((4, 4), dtype=np.float32)
+    a.add(0.5, out=out)
+    assert out.data.dtype == np.float64
+    assert np.all(out.data == 1.5)
+
+
+def test_view():
+    """ a view shares the data until written to, and never writes through """
+    a    = fitsdata.FITSData2D.initbydata(np.arange(12.).reshape(3, 4), HEADER)
+    view = a.view()
+    assert np.shares_memory(view.data, a.data)
+    assert not view.data.flags.writeable
+    with pytest.raises(ValueError):
+        view.data[0, 0] = 1.
+
+    view += 1.
+    view *= 2.
+    assert not np.shares_memory(view.data, a.data)
+    assert view.data.flags.writeable
+    assert np.array_equal(view.data, (np.arange(12.).reshape(3, 4) + 1.) * 2.)
+    assert np.array_equal(a.data, np.arange(12.).reshape(3, 4))
+
+    view.header['BUNIT'] = 'JY/BEAM'
+    assert 'BUNIT' not in a.header
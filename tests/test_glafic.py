@@ -0,0 +1,85 @@
+# coding:UTF-8
+import os
+import numpy as np
+import pytest
+
+from glean.lib.glafic import glafic as gf
+from glean.lib.glafic import imagefinder
+
+# the stand-in is a singular isothermal sphere of this Einstein radius
+SIS = ['pow', '2.0', '0', '0', '0', '0', '1.0', '2.0']
+
+
+@pytest.fixture(params=[False, True], ids=['stderr', 'stdout'])
+def glafic(request, workdir, glafic_path, monkeypatch):
+    if request.param:
+        monkeypatch.setenv('GLAFIC_STDOUT', '1')
+    glafic = gf.Glafic('test.input', glafic_path)
+    glafic.timeout = 30
+    glafic.models.append('lens', list(SIS))
+    glafic.create_input()
+    yield glafic
+    glafic.close()
+
+
+def test_calcimage_batch_order(glafic):
+    n    = gf.GlaficSession.BLOCK + 44
+    x, y = np.meshgrid(np.linspace(0.2, 1.8, n // 20), np.linspace(-1.3, 1.1, 20))
+    assert x.size == n and n > gf.GlaficSession.BLOCK
+
+    srcinfo = glafic.calcimage_batch(2.0, x, y)
+    r       = np.hypot(x, y)
+    assert srcinfo.shape == x.shape
+    assert np.allclose(srcinfo['xsrc'], x - x / r, rtol=0, atol=1e-9)
+    assert np.allclose(srcinfo['ysrc'], y - y / r, rtol=0, atol=1e-9)
+    assert np.allclose(srcinfo['kappa'], 0.5 / r, rtol=1e-9, atol=0)
+    assert glafic.session.pipelined == bool(os.environ.get('GLAFIC_STDOUT'))
+
+
+def test_finder_newton_rounds(glafic):
+    from glean.lib.glafic import lensengine
+    refiner = lensengine.LensEngine(glafic)
+    assert refiner.supports()
+
+    for ref, rounds in [(refiner, 2), (None, 4)]:
+        finder = imagefinder.ImageFinder(glafic, 2.0, -2.05, 1.95, -2.05, 1.95, 0.1, ref, rounds)
+        glafic.stats.reset()
+        glafic.cache.clear()
+        imginfo = finder.findimg(0.3, 0.)
+
+        assert sorted(imginfo['x']) == pytest.approx([-0.7, 1.3], abs=1e-6)
+        assert imginfo['y'] == pytest.approx([0., 0.], abs=1e-6)
+        # the Newton iterations and the final check
+        assert glafic.stats.rows()[0][1] <= rounds + 1
+
+
+def replace_lens(glafic):
+    glafic.models.reset('lens')
+    glafic.models.append('lens', ['pow', '2.0', '0', '0', '0', '0', '1.2', '2.0'])
+
+
+def append_lens(glafic):
+    glafic.models.append('lens', ['pert', '2.0', '0', '0', '0.05', '30.', '0', '0'])
+
+
+def set_param(glafic):
+    glafic.params['pix_ext'] = 0.05
+
+
+@pytest.mark.parametrize('change', [replace_lens, append_lens, set_param])
+def test_cache_invalidation(glafic, change):
+    """ a new lens or params sends calcimage and findimg to glafic again """
+    x, y = np.linspace(0.3, 1.5, 4), np.full(4, 0.2)
+
+    def sent():
+        glafic.calcimage_batch(2.0, x, y)
+        glafic.findimg()
+        return sum(row[2] for row in glafic.stats.rows())
+
+    first = sent()
+    assert sent() == first
+
+    change(glafic)
+    glafic.create_input()
+    assert sent() == 2 * first
+    assert sent() == 2 * first
@@ -0,0 +1,230 @@
+# coding:UTF-8
+import glob
+import os
+import shutil
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from glean.lib import fitsdata
+from glean.lib import glean as gl
+
+OUTPUTS = ['out_image_all', 'out_residue_1', 'out_image_indiv_1', 'out_image_restore_1']
+SOURCES = ['out_source_all', 'out_source_indiv_1', 'out_source_restore_1']
+
+
+@pytest.mark.parametrize('flags', [{'limit': 3}, {'flag_render': 1}, {'flag_render': 1, 'flag_finder': 1}],
+                         ids=['glafic', 'render', 'finder'])
+def test_headers(make_glean, cube, flags):
+    glean = make_glean(**flags)
+    assert glean.execute()
+    glean.restore()
+
+    header = fits.getheader(cube)
+    for name in OUTPUTS + SOURCES:
+        h = fits.getheader('glean_out/{}.fits'.format(name))
+        for key in ['BMAJ', 'BMIN', 'BPA', 'REDSHIFT', 'CRVAL1', 'CRVAL2']:
+            assert h[key] == header[key]
+    for name in OUTPUTS:
+        h = fits.getheader('glean_out/{}.fits'.format(name))
+        for key in ['CRPIX1', 'CRPIX2', 'CDELT1', 'CDELT2']:
+            assert h[key] == header[key]
+    for name in SOURCES:
+        h = fits.getheader('glean_out/{}.fits'.format(name))
+        assert h['CDELT1'] == h['CDELT2'] == 0.04
+        # the source grid spans -1.2 to 1.2 arcsec
+        assert h['CRPIX1'] == h['CRPIX2'] == pytest.approx(30.5)
+
+
+@pytest.mark.parametrize('mode', ['crash', 'hang'])
+def test_glafic_failure(make_glean, monkeypatch, mode):
+    """ a channel on which glafic fails is written and left unfinished, and the others run """
+    monkeypatch.setenv('GLAFIC_FAIL', mode)
+    monkeypatch.setenv('GLAFIC_FAIL_AT', '3')
+    glean = make_glean(flag_render=1, glafic_retries=0, glafic_timeout=2, checkpoint_step=1)
+    assert not glean.execute()
+
+    comps = [len(fits.getdata('glean_out/out_components_{}.fits'.format(j), 1)) for j in (1, 2)]
+    assert comps == [2, 8]
+    assert fits.getdata('glean_out/out_image_all.fits').shape[0] == 2
+    # the failed channel can be resumed from its checkpoint
+    assert os.path.exists(gl.Glean.CHECKPOINT_DIR + 'out/channel_1.npz')
+
+
+def test_checkpoint_dirs(make_glean, monkeypatch):
+    """ a run only removes the checkpoints of its own prefix """
+    monkeypatch.setenv('GLAFIC_FAIL', 'crash')
+    monkeypatch.setenv('GLAFIC_FAIL_AT', '3')
+    glean = make_glean(flag_render=1, glafic_retries=0, checkpoint_step=1, zmax=0)
+    glean.glafic_i.params['prefix'] = glean.glafic_s.params['prefix'] = 'a'
+    assert not glean.execute()
+    assert os.path.exists(gl.Glean.CHECKPOINT_DIR + 'a/channel_1.npz')
+
+    monkeypatch.delenv('GLAFIC_FAIL')
+    glean = make_glean(flag_render=1, checkpoint_step=1, zmax=0)
+    glean.glafic_i.params['prefix'] = glean.glafic_s.params['prefix'] = 'b'
+    assert glean.execute()
+    assert not os.path.exists(gl.Glean.CHECKPOINT_DIR + 'b')
+    assert os.path.exists(gl.Glean.CHECKPOINT_DIR + 'a/channel_1.npz')
+
+
+def test_bank(make_glean):
+    glean = make_glean(flag_render=1, flag_native=1, flag_bank=1, bank_step=4, bank_mb=0.1)
+    assert not glean.build_bank()
+    assert not glob.glob(gl.Glean.BANK_DIR + '*.npy')
+
+    glean.params['bank_mb'] = 64
+    assert glean.build_bank()
+    assert len(glob.glob(gl.Glean.BANK_DIR + '*.npy')) == 1
+    assert glean.execute()
+
+
+def test_workspace_removed(make_glean, monkeypatch):
+    paths = []
+    glean = make_glean(flag_render=1, limit=2)
+    execute = glean._execute
+
+    def record(phase, njobs):
+        paths.append(glean.workspace.path)
+        assert glean.glafic_i.inputname.startswith(glean.workspace.path)
+        return execute(phase, njobs)
+    monkeypatch.setattr(glean, '_execute', record)
+
+    assert glean.execute()
+    assert glean.workspace is None
+    assert glean.glafic_i.inputname == gl.Glean.OUT_DIR + 'one_image.input'
+    assert not glob.glob(paths[0])
+
+
+def test_precision(make_glean):
+    """ a float32 residual picks the same components as a float64 one, to float32 precision """
+    comps = {}
+    for precision in (64, 32):
+        assert make_glean(flag_render=1, precision=precision).execute()
+        comps[precision] = [fits.getdata('glean_out/out_components_{}.fits'.format(j), 1) for j in (1, 2)]
+        shutil.rmtree('glean_out')
+        os.mkdir('glean_out')
+
+    for comps64, comps32 in zip(comps[64], comps[32]):
+        assert len(comps64) == len(comps32)
+        # peaks to the float32 resolution, positions to well below a pixel
+        for name in ['sb_max', 'conv_i']:
+            assert np.allclose(comps32[name], comps64[name], rtol=2e-7, atol=0)
+        for name in ['x', 'y', 'xsrc', 'ysrc']:
+            assert np.allclose(comps32[name], comps64[name], rtol=0, atol=1e-6)
+
+
+def test_restore(make_glean):
+    """ the component tables give back the models and the residuals of the run """
+    glean = make_glean(flag_render=1, resstep=1)
+    assert glean.execute()
+
+    # residual snapshots are taken after every iteration, the last one twice
+    img = fits.getdata('glean_out/out_image_all.fits')
+    res = [fits.getdata('glean_out/out_residue_{}.fits'.format(j)) for j in (1, 2)]
+    for iteration, frame in [(-1, -1), (3, 2)]:
+        glean.restore(iteration)
+        for j in (1, 2):
+            restored = fits.getdata('glean_out/out_residue_restore_{}.fits'.format(j))
+            assert np.allclose(restored, res[j - 1][frame], rtol=0, atol=1e-12)
+            if iteration == -1:
+                restored = fits.getdata('glean_out/out_image_restore_{}.fits'.format(j))
+                assert np.allclose(restored, img[j - 1], rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize('params, message', [({'nsigma_stop': 3., 'noise_step': 1}, 'times the noise'),
+                                             ({'flux_tol': 1e-2, 'noise_step': 2}, 'Model flux changed')],
+                         ids=['noise', 'flux'])
+def test_stopping(make_glean, capsys, params, message):
+    """ the run stops on the noise of the residual or the flux of the model well before the limit """
+    glean = make_glean(flag_render=1, flag_finder=1, limit=300, **params)
+    assert glean.execute()
+
+    out = capsys.readouterr()[0]
+    assert out.count(message) == 2
+    for j in (1, 2):
+        assert 10 < len(fits.getdata('glean_out/out_components_{}.fits'.format(j), 1)) < 300
+    if 'nsigma_stop' in params:
+        # the noise is measured on the final residual with noise_step = 1
+        residual = glean.fitscls_p
+        assert residual.findmax()[0] <= 3. * residual.noise()
+
+
+@pytest.mark.parametrize('nimg', ['1', '2'])
+@pytest.mark.parametrize('flag_stream', [0, 1], ids=['memory', 'stream'])
+def test_resume(make_glean, monkeypatch, nimg, flag_stream):
+    """ a run that glafic breaks off and is resumed gives the outputs of an unbroken run """
+    monkeypatch.setenv('GLAFIC_NIMG', nimg)
+    names = ['out_image_all', 'out_source_all', 'out_residue_1', 'out_residue_2', 'out_image_indiv_1']
+
+    def outputs():
+        data = dict((name, fits.getdata('glean_out/{}.fits'.format(name))) for name in names)
+        for j in (1, 2):
+            data['comps_{}'.format(j)] = fitsdata.FITSTable.initbyname('glean_out/out_components_{}.fits'.format(j),
+                                                                       gl.Glean.COMPONENT_COLUMNS).rows
+        return data
+
+    params = dict(flag_render=1, checkpoint_step=1, glafic_retries=0, resstep=1, imgstep=1, flag_stream=flag_stream, limit=5)
+    assert make_glean(**params).execute()
+    unbroken = outputs()
+    shutil.rmtree('glean_out')
+    os.mkdir('glean_out')
+
+    # channel 1 is broken off in its third iteration
+    monkeypatch.setenv('GLAFIC_FAIL', 'crash')
+    monkeypatch.setenv('GLAFIC_FAIL_AT', '3')
+    assert not make_glean(**params).execute()
+    monkeypatch.delenv('GLAFIC_FAIL')
+    assert make_glean(**params).execute(resume=True)
+
+    resumed = outputs()
+    for name in names:
+        assert np.array_equal(resumed[name], unbroken[name])
+    for j in (1, 2):
+        assert resumed['comps_{}'.format(j)] == unbroken['comps_{}'.format(j)]
+    assert not os.path.exists(gl.Glean.CHECKPOINT_DIR)
+
+
+@pytest.mark.parametrize('flags', [{'flag_render': 1}, {'flag_render': 1, 'flag_stream': 1}, {'limit': 2}],
+                         ids=['render', 'stream', 'glafic'])
+def test_parallel(make_glean, flags):
+    """ channels cleaned by two workers give the outputs of a serial run """
+    names = ['out_image_all', 'out_source_all', 'out_residue_1', 'out_residue_2', 'out_image_indiv_2']
+    runs  = []
+    for njobs in (1, 2):
+        assert make_glean(**flags).execute(njobs=njobs)
+        runs.append(dict((name, fits.getdata('glean_out/{}.fits'.format(name))) for name in names))
+        for j in (1, 2):
+            runs[-1][j] = fitsdata.FITSTable.initbyname('glean_out/out_components_{}.fits'.format(j),
+                                                        gl.Glean.COMPONENT_COLUMNS).rows
+        shutil.rmtree('glean_out')
+        os.mkdir('glean_out')
+
+    serial, parallel = runs
+    for key in serial:
+        assert np.array_equal(parallel[key], serial[key])
+
+
+def test_lens_products(make_glean):
+    """ lens maps are built again for a new lens model or params, and reused otherwise """
+    glean = make_glean(flag_lensmap=1, flag_render=1)
+    glean.prepare()
+    maps = [glean.lensmap]
+    glean.prepare()
+    assert glean.lensmap is maps[0] and len(glean.lens_products) == 1
+
+    glean.glafic_i.models.reset('lens')
+    glean.glafic_i.models.append('lens', ['pow', '2.0', '0', '0', '0', '0', '1.2', '2.0'])
+    glean.prepare()
+    maps.append(glean.lensmap)
+
+    glean.glafic_i.models.append('lens', ['pert', '2.0', '0', '0', '0.05', '30.', '0', '0'])
+    glean.prepare()
+    maps.append(glean.lensmap)
+
+    glean.glafic_i.params['seeing_sub'] = 2
+    glean.prepare()
+    maps.append(glean.lensmap)
+
+    assert len(set(map(id, maps))) == 4
+    assert len(glean.lens_products) == min(4, glean.max_lens_products)
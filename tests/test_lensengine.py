@@ -0,0 +1,115 @@
+# coding:UTF-8
+import numpy as np
+import pytest
+
+from glean.lib.glafic import glafic as gf
+from glean.lib.glafic import imagefinder
+from glean.lib.glafic import lensengine
+
+ZS    = 2.0
+SIGMA = 250.
+E     = 0.3
+THETA = 30.
+
+
+def engine(*models):
+    glafic = gf.Glafic('test.input')
+    for model in models:
+        glafic.models.append('lens', [str(v) for v in model])
+
+    return lensengine.LensEngine(glafic)
+
+
+def einstein_radius(engine):
+    """ b of an SIE with velocity dispersion SIGMA, in arcsec """
+    return 4 * np.pi * (SIGMA / lensengine.C_LIGHT)**2 * engine.dratio(ZS) * lensengine.RAD_ARCSEC
+
+
+def rotate(x, y):
+    """ to the frame whose x-axis is the major axis """
+    ang = (THETA + 90.) * np.pi / 180.
+    return np.cos(ang) * x + np.sin(ang) * y, -np.sin(ang) * x + np.cos(ang) * y
+
+
+@pytest.fixture
+def grid():
+    x, y = np.meshgrid(np.linspace(-2.1, 1.9, 21), np.linspace(-1.7, 2.3, 21))
+    return x, y
+
+
+def test_sis(grid):
+    lens   = engine(['sie', SIGMA, 0., 0., 0., 0., 0., 0.])
+    b      = einstein_radius(lens)
+    x, y   = grid
+    ax, ay = lens.deflection(ZS, x, y)
+
+    assert 0.5 < b < 2.
+    assert np.allclose(np.hypot(ax, ay), b, rtol=1e-12, atol=0)
+    assert np.allclose(ax * y - ay * x, 0., rtol=0, atol=1e-12)
+    assert np.all(lens.deflection(0.2, x, y)[0] == 0.)
+
+
+def test_sie_axes():
+    """ the deflection of a singular SIE is constant along each axis """
+    lens = engine(['sie', SIGMA, 0.1, -0.2, E, THETA, 0., 0.])
+    b, q = einstein_radius(lens), 1. - E
+    qq   = np.sqrt(1 - q**2)
+    r    = np.linspace(0.1, 3., 11)
+    ang  = (THETA + 90.) * np.pi / 180.
+
+    ax, ay = lens.deflection(ZS, 0.1 + r * np.cos(ang), -0.2 + r * np.sin(ang))
+    assert np.allclose(np.hypot(ax, ay), b * np.sqrt(q) / qq * np.arctan(qq / q), rtol=1e-12, atol=0)
+
+    ax, ay = lens.deflection(ZS, 0.1 - r * np.sin(ang), -0.2 + r * np.cos(ang))
+    assert np.allclose(np.hypot(ax, ay), b * np.sqrt(q) / qq * np.arctanh(qq), rtol=1e-12, atol=0)
+
+
+def test_sie_kappa(grid):
+    """ kappa from the derivatives of the deflection is b / 2 / sqrt(q x^2 + y^2 / q) """
+    lens    = engine(['sie', SIGMA, 0., 0., E, THETA, 0., 0.])
+    b, q    = einstein_radius(lens), 1. - E
+    x, y    = grid
+    xr, yr  = rotate(x, y)
+    srcinfo = lens.calcimage_batch(ZS, x, y)
+
+    assert np.allclose(srcinfo['kappa'], b / 2 / np.sqrt(q * xr**2 + yr**2 / q), rtol=1e-6, atol=0)
+
+
+def test_pow_isothermal(grid):
+    """ pow at gamma = 2 is the singular SIE of the same Einstein radius """
+    sie  = engine(['sie', SIGMA, 0.1, -0.2, E, THETA, 0., 0.])
+    pow_ = engine(['pow', ZS, 0.1, -0.2, E, THETA, einstein_radius(sie), 2.])
+    x, y = grid
+
+    for a, b in zip(sie.deflection(ZS, x, y), pow_.deflection(ZS, x, y)):
+        assert np.allclose(a, b, rtol=0, atol=1e-10)
+    for key in ['kappa', 'gamma', 'mag']:
+        assert np.allclose(sie.calcimage_batch(ZS, x, y)[key], pow_.calcimage_batch(ZS, x, y)[key],
+                           rtol=1e-6, atol=0)
+
+
+class Singular(object):
+    """ lens whose deflection is not finite at the origin, as glafic reports for a singular centre """
+    def __init__(self, lens):
+        self.lens = lens
+
+    def deflection(self, redshift, x, y):
+        centre = (x == 0) & (y == 0)
+        return tuple(np.where(centre, np.nan, a) for a in self.lens.deflection(redshift, x, y))
+
+    def calcimage_batch(self, redshift, x, y):
+        return self.lens.calcimage_batch(redshift, x, y)
+
+
+def test_finder_singular_node():
+    """ triangles on a singular node are dropped instead of collapsing the index into one bucket """
+    lens     = engine(['sie', SIGMA, 0., 0., 0., 0., 0., 0.])
+    b        = einstein_radius(lens)
+    singular = imagefinder.ImageFinder(Singular(lens), ZS, -2., 2., -2., 2., 0.125)
+
+    assert np.all(np.isfinite(singular.src))
+    assert len(singular.src) == 2 * 32**2 - 6
+    assert np.count_nonzero(np.diff(singular.start)) > singular.nb**2 / 2
+
+    imginfo = singular.findimg(0.3, 0.)
+    assert sorted(imginfo['x']) == pytest.approx([0.3 - b, 0.3 + b], abs=1e-8)
@@ -0,0 +1,67 @@
+# coding:UTF-8
+import numpy as np
+import pytest
+
+from glean.lib.glafic import glafic as gf
+from glean.lib.glafic import lensengine
+from glean.lib.glafic import lensmap
+
+ZS = 2.0
+
+
+@pytest.fixture
+def engine():
+    glafic = gf.Glafic('test.input')
+    glafic.models.append('lens', ['sie', '250.', '0.03', '-0.02', '0.3', '30.', '0.', '0.'])
+
+    return lensengine.LensEngine(glafic)
+
+
+def points(n=500, rmin=0.3, rmax=1.8, seed=1):
+    """ random points of an annulus, away from the singular centre """
+    rng = np.random.RandomState(seed)
+    r   = rng.uniform(rmin, rmax, n)
+    phi = rng.uniform(0, 2 * np.pi, n)
+
+    return r * np.cos(phi), r * np.sin(phi)
+
+
+def errors(lens, engine, x, y):
+    lookup = lens.calcimage_batch(ZS, x, y)
+    direct = engine.calcimage_batch(ZS, x, y)
+
+    return (np.max(np.hypot(lookup['xsrc'] - direct['xsrc'], lookup['ysrc'] - direct['ysrc'])),
+            np.max(np.abs(lookup['kappa'] - direct['kappa'])))
+
+
+def test_pixel_centres(engine):
+    lens   = lensmap.LensMap(engine, ZS, -2., 2., -2., 2., 0.05)
+    x, y   = np.meshgrid(lens.x[3:-3:7], lens.y[5:-5:9])
+    lookup = lens.calcimage_batch(ZS, x, y)
+    direct = engine.calcimage_batch(ZS, x, y)
+
+    for key in ['xsrc', 'ysrc', 'kappa', 'gamma1', 'gamma2', 'mag']:
+        assert np.allclose(lookup[key], direct[key], rtol=1e-12, atol=1e-12)
+
+
+def test_accuracy(engine):
+    """ bilinear lookups are accurate to O(pix^2) away from the centre """
+    x, y   = points()
+    coarse = errors(lensmap.LensMap(engine, ZS, -2., 2., -2., 2., 0.04), engine, x, y)
+    fine   = errors(lensmap.LensMap(engine, ZS, -2., 2., -2., 2., 0.02), engine, x, y)
+
+    # source positions within 2e-3 arcsec, kappa within 5e-3 at pix = 0.02 arcsec
+    assert fine[0] < 2e-3
+    assert fine[1] < 5e-3
+    for e_coarse, e_fine in zip(coarse, fine):
+        assert 2.5 < e_coarse / e_fine < 6
+
+
+def test_check_and_redshift(engine):
+    lens   = lensmap.LensMap(engine, ZS, -2., 2., -2., 2., 0.02)
+    errors = lens.check(engine, seed=0)
+
+    assert list(errors) == ['xsrc', 'ysrc', 'kappa', 'gamma1', 'gamma2', 'mag']
+    assert errors['xsrc'][0] < 1e-3
+    with pytest.raises(gf.GlaficError):
+        lens.calcimage_batch(1.0, 0.5, 0.5)
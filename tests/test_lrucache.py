@@ -0,0 +1,50 @@
+# coding:UTF-8
+import numpy as np
+
+from glean.lib.glafic import glafic as gf
+from glean.lib.glafic import lrucache
+
+
+class BytesCache(lrucache.LRUCache):
+    @classmethod
+    def _nbytes(cls, value):
+        return len(value)
+
+
+def test_eviction():
+    cache = BytesCache(maxbytes=10)
+    cache.put('a', 'xxxx')
+    cache.put('b', 'xxxx')
+    assert cache.get('a') == 'xxxx'
+    cache.put('c', 'xxxx')
+
+    # b was the least recently used
+    assert cache.get('b') is None
+    assert list(cache.entries) == ['a', 'c']
+    assert cache.nbytes == 8
+    assert cache.stats().items() == [('hits', 1), ('misses', 1), ('entries', 2), ('bytes', 8)]
+
+    cache.put('a', 'xx')
+    assert cache.nbytes == 6 and list(cache.entries) == ['c', 'a']
+    cache.put('d', 'x' * 20)
+    assert len(cache) == 0 and cache.nbytes == 0
+
+
+def test_glafic_cache_keeps_newest():
+    cache = gf.GlaficCache(maxbytes=10)
+    cache.put('a', ('reply', ))
+    cache.put('b', ('reply', 'x' * 20))
+
+    assert list(cache.entries) == ['b']
+    assert cache.nbytes == 25
+
+
+def test_default_size():
+    """ arrays count their bytes, other values one each """
+    cache = lrucache.LRUCache(maxbytes=100)
+    cache.put('a', np.zeros(8))
+    cache.put('b', 'x' * 50)
+    assert cache.nbytes == 65
+
+    cache.put('c', np.zeros(5))
+    assert list(cache.entries) == ['b', 'c'] and cache.nbytes == 41
@@ -0,0 +1,64 @@
+# coding:UTF-8
+import numpy as np
+import pytest
+from astropy.convolution import convolve
+
+from glean.lib.glafic import glafic as gf
+from glean.lib.glafic import extendmodel
+from glean.lib.glafic import lensengine
+from glean.lib.glafic import render
+
+ZS    = 2.0
+SIGMA = 0.05
+PAD   = 2
+
+
+@pytest.fixture(scope='module')
+def renderer():
+    glafic = gf.Glafic('test.input')
+    glafic.models.append('lens', ['sie', '250.', '0.', '0.', '0.2', '30.', '0.', '0.'])
+
+    return render.ImageRenderer(lensengine.LensEngine(glafic), ZS, -6.4, 6.4, -6.4, 6.4, 0.1, nsub=2)
+
+
+def footprint(renderer, xs, ys):
+    """
+    the rendered and convolved image of a component at (xs, ys), with its
+    brightest pixel and the pixel opposite to it about the lens as centres
+    """
+    gauss = extendmodel.Gauss(ZS, 1., xs, ys, 0, 0, SIGMA, 0)
+    frame = convolve(renderer.render(gauss), np.ones((2 * PAD + 1, 2 * PAD + 1)) / (2 * PAD + 1)**2)
+    iy, ix = np.nonzero(frame == frame.max())
+
+    return frame, [(iy[0], ix[0]), (frame.shape[0] - 1 - iy[0], frame.shape[1] - 1 - ix[0])]
+
+
+@pytest.mark.parametrize('xs, ys', [(0.05, 0.02), (0.6, -0.4), (1.8, 1.5)])
+def test_windows_lossless(renderer, xs, ys):
+    """ with the underflow radius the windows hold every non-zero pixel """
+    frame, centres = footprint(renderer, xs, ys)
+    windows = renderer.windows(xs, ys, SIGMA * np.sqrt(2 * 746.), centres, PAD)
+
+    inside = np.zeros(frame.shape, dtype=bool)
+    for window in windows:
+        assert not inside[window].any()
+        inside[window] = True
+
+    assert not frame[~inside].any()
+    assert inside.sum() < frame.size
+
+
+def test_windows_tol(renderer):
+    """ a tolerance keeps what is above it and the windows shrink """
+    xs, ys = 0.05, 0.02
+    frame, centres = footprint(renderer, xs, ys)
+    windows = renderer.windows(xs, ys, SIGMA * np.sqrt(2 * -np.log(1e-6)), centres, PAD)
+    exact   = renderer.windows(xs, ys, SIGMA * np.sqrt(2 * 746.), centres, PAD)
+
+    kept = render.frame_of([render.Patch(window, frame[window]) for window in windows], frame.shape)
+    assert np.all(np.abs(frame - kept) <= 1e-6 * frame.max())
+    assert sum(kept[window].size for window in windows) < sum(kept[window].size for window in exact)
+
+
+def test_windows_empty(renderer):
+    assert renderer.windows(50., 50., 0.1) == []
@@ -0,0 +1,103 @@
+# coding:UTF-8
+import time
+import pytest
+
+from glean.lib.glafic import glafic as gf
+
+
+def write_input(path, text='### fake input ###\n'):
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+@pytest.fixture(params=[False, True], ids=['stderr', 'stdout'])
+def session(request, workdir, glafic_path, monkeypatch):
+    """ a session whose glafic reports unknown commands on stderr or stdout """
+    if request.param:
+        monkeypatch.setenv('GLAFIC_STDOUT', '1')
+    inputname = str(workdir.join('test.input'))
+    write_input(inputname)
+    session   = gf.GlaficSession(glafic_path, inputname, timeout=10)
+    yield session
+    session.close()
+
+
+def calcimage(x, y):
+    return 'calcimage 2.0 {!r} {!r}'.format(x, y)
+
+
+def reply_x(reply):
+    return float(reply.split('\n')[3].split()[2])
+
+
+def test_framing(session):
+    replies = session.communicate_many([calcimage(0.5, 0.), 'unknown', 'findimg', calcimage(-1.5, 0.)])
+
+    assert len(replies) == 4
+    assert reply_x(replies[0]) == 0.5
+    assert replies[1] == ('Error: command unknown not supported\n' if session.pipelined else '')
+    assert 'Error' not in replies[2]
+    assert replies[2].split('\n')[0] == 'n_img = 2'
+    assert reply_x(replies[3]) == -1.5
+    for reply in replies:
+        assert gf.GlaficSession.SENTINEL not in reply
+
+
+def test_restart_on_input_change(session):
+    session.communicate(calcimage(1., 1.))
+    pid = session.proc.pid
+    session.communicate(calcimage(1., 2.))
+    assert session.proc.pid == pid
+
+    write_input(session.inputname, '### fake input, edited ###\n')
+    reply = session.communicate(calcimage(1., 3.))
+    assert session.proc.pid != pid
+    assert reply_x(reply) == 1.
+
+
+def test_pipelining_blocks(session):
+    blocks = []
+    write  = session._write
+
+    def record(commands):
+        blocks.append(len(commands))
+        write(commands)
+    session._write = record
+
+    n       = 2 * gf.GlaficSession.BLOCK + 10
+    xs      = [0.1 + 0.01 * i for i in xrange(n)]
+    replies = session.communicate_many([calcimage(x, 0.3) for x in xs])
+
+    assert [reply_x(reply) for reply in replies] == xs
+    if session.pipelined:
+        assert blocks == [0, gf.GlaficSession.BLOCK, gf.GlaficSession.BLOCK, 10]
+    else:
+        assert blocks == [0] + [1] * n
+
+
+def test_timeout(session):
+    session.timeout = 0.5
+    start = time.time()
+    with pytest.raises(gf.GlaficTimeoutError):
+        session.communicate('sleep 30')
+    assert time.time() - start < 10
+    assert not session.is_alive()
+
+    session.timeout = 10
+    assert reply_x(session.communicate(calcimage(2., 0.))) == 2.
+
+
+def test_crash(session):
+    with pytest.raises(gf.GlaficCrashError):
+        session.communicate('crash')
+    assert not session.is_alive()
+    assert reply_x(session.communicate(calcimage(2., 0.))) == 2.
+
+
+def test_glafic_retries_crash(workdir, glafic_path):
+    glafic = gf.Glafic('test.input', glafic_path)
+    glafic.create_input()
+    glafic.retries = 0
+    with pytest.raises(gf.GlaficCrashError):
+        glafic.communicate('crash')
+    glafic.close()